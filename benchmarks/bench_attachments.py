@@ -0,0 +1,102 @@
+"""bench_attachments.py
+
+Benchmark building attachment libraries and filtering them.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import pytest
+
+from victoria_smoke.attachments import AttachmentLibrary
+from victoria_smoke.index_cache import IndexCache
+
+from synthetic import synthetic_library
+
+
+@pytest.mark.benchmark(group="construction")
+def test_scan(benchmark, library_tree):
+    library = benchmark.pedantic(AttachmentLibrary, ([library_tree], ),
+                                 rounds=3)
+    assert len(library) > 0
+
+
+@pytest.mark.benchmark(group="construction")
+def test_scan_parallel(benchmark, library_tree):
+    library = benchmark.pedantic(AttachmentLibrary, ([library_tree], ),
+                                 {"workers": 8},
+                                 rounds=3)
+    assert len(library) > 0
+
+
+@pytest.mark.benchmark(group="construction")
+def test_scan_cached(benchmark, library_tree, tmp_path):
+    cache_path = str(tmp_path / "index.pickle")
+    AttachmentLibrary([library_tree], IndexCache(cache_path))
+
+    def build():
+        return AttachmentLibrary([library_tree], IndexCache(cache_path))
+
+    library = benchmark.pedantic(build, rounds=3)
+    assert len(library) > 0
+
+
+@pytest.mark.benchmark(group="construction")
+def test_from_attachments(benchmark, request):
+    size = request.config.getoption("--library-size")
+    library = benchmark.pedantic(synthetic_library, (size, ), rounds=3)
+    assert len(library) == size
+
+
+@pytest.mark.benchmark(group="construction")
+def test_build_indexes(benchmark, request):
+    library = synthetic_library(request.config.getoption("--library-size"))
+
+    def build():
+        library.columns._indexed = False
+        library.columns._build_indexes()
+
+    benchmark.pedantic(build, rounds=3)
+
+
+@pytest.mark.benchmark(group="filter")
+def test_get_filename(benchmark, library):
+    benchmark(library.get_filename, "invoice_1234.pdf")
+
+
+@pytest.mark.benchmark(group="filter")
+def test_get_like(benchmark, library):
+    benchmark(library.get_like, "invoice")
+
+
+@pytest.mark.benchmark(group="filter")
+def test_get_filetype(benchmark, library):
+    assert len(benchmark(library.get_filetype, "pdf")) > 0
+
+
+@pytest.mark.benchmark(group="filter")
+def test_get_directory(benchmark, library):
+    assert len(benchmark(library.get_directory, "malware")) > 0
+
+
+@pytest.mark.benchmark(group="filter")
+def test_get_filesize(benchmark, library):
+    assert len(benchmark(library.get_filesize, 1024 * 1024, 1024)) > 0
+
+
+@pytest.mark.benchmark(group="filter")
+def test_random_choice(benchmark, library):
+    benchmark(library.random_choice, 5, 1337)
+
+
+@pytest.mark.benchmark(group="filter")
+def test_random_choice_weighted(benchmark, library):
+    benchmark(library.random_choice, 5, 1337, "size")
+
+
+@pytest.mark.benchmark(group="filter")
+def test_chained_filters(benchmark, library):
+    def chained():
+        return library.query().get_filetype("pdf").get_directory(
+            "malware").get_filesize(1024 * 1024).random_choice(5, 1337)
+
+    benchmark(chained)
@@ -0,0 +1,34 @@
+"""bench_import.py
+
+Benchmark importing the plugin, which Victoria does on every command.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import pytest
+
+from victoria_smoke.importtime import import_times
+
+IMPORT_BUDGET = 0.05
+"""The most importing the plugin can take, in seconds, not counting Victoria
+and its dependencies."""
+
+
+def import_seconds() -> float:
+    """Import the plugin in a new interpreter, returning the seconds taken.
+    Victoria is imported first, so only the plugin's own import is counted.
+    """
+    times = import_times("import victoria.plugin, marshmallow, click; "
+                         "import victoria_smoke")
+    if "victoria_smoke" not in times:
+        raise AssertionError("victoria_smoke wasn't imported")
+    return times["victoria_smoke"] / 1e6
+
+
+@pytest.mark.benchmark(group="import")
+def test_import(benchmark):
+    seconds = []
+    benchmark.pedantic(lambda: seconds.append(import_seconds()), rounds=5)
+    # the best of the rounds, to smooth out noise
+    benchmark.extra_info["import_seconds"] = min(seconds)
+    assert min(seconds) < IMPORT_BUDGET
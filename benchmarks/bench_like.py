@@ -0,0 +1,44 @@
+"""bench_like.py
+
+Benchmark the 'like' filter with and without the trigram index.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import pytest
+
+from victoria_smoke.trigram import TrigramIndex
+
+from synthetic import synthetic_library
+
+SEARCH_TERMS = ["invoice", "macro", "report_1234", "2019", "zz"]
+
+
+@pytest.fixture(scope="module")
+def like_library(request):
+    """A synthetic library of its own, as the benchmarks swap its trigram
+    index in and out."""
+    return synthetic_library(request.config.getoption("--library-size"))
+
+
+@pytest.fixture(scope="module")
+def trigrams(like_library):
+    return TrigramIndex(like_library.columns.paths)
+
+
+@pytest.mark.benchmark(group="trigram")
+def test_build_trigram_index(benchmark, like_library):
+    benchmark.pedantic(TrigramIndex, (like_library.columns.paths, ),
+                       rounds=3)
+
+
+@pytest.mark.parametrize("indexed", [False, True],
+                         ids=["linear", "trigram"])
+@pytest.mark.parametrize("term", SEARCH_TERMS)
+def test_like(benchmark, like_library, trigrams, term, indexed):
+    benchmark.group = f"like({term!r})"
+    like_library.columns.trigrams = trigrams if indexed else None
+    try:
+        benchmark(like_library.get_like, term)
+    finally:
+        like_library.columns.trigrams = None
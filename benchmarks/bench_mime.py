@@ -0,0 +1,74 @@
+"""bench_mime.py
+
+Benchmark loading specs and rendering them to MIME.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import io
+import os
+
+import pytest
+
+from victoria_smoke.attachment_cache import EncodedAttachmentCache
+from victoria_smoke import spec as spc
+
+SPEC = """headers:
+  To:
+  - "Sam Gibson <sgibson@glasswallsolutions.com>"
+  From:
+  - "Sam Gibson <sgibson@glasswallsolutions.com>"
+  Subject: "Smoke test"
+  Date: "Wed, 01 Jan 2020 00:00:00 +0000"
+body: "{body}"
+attach:
+{attach}
+"""
+
+ATTACHMENT_SIZES = [64 * 1024, 4 * 1024 * 1024]
+"""The sizes of the attachments to benchmark with, in bytes."""
+
+BOUNDARY = "===============1337=="
+
+
+@pytest.fixture(params=ATTACHMENT_SIZES, ids=["64kib", "4mib"])
+def spec(request, tmp_path) -> spc.Spec:
+    """A spec with a body and three attachments of random bytes."""
+    attach = []
+    for i, filetype in enumerate(["pdf", "docx", "png"]):
+        file_path = tmp_path / f"attachment_{i}.{filetype}"
+        file_path.write_bytes(os.urandom(request.param))
+        attach.append(f"- {file_path}")
+    return spc.parse(
+        SPEC.format(body="hello " * 1000, attach="\n".join(attach)))
+
+
+@pytest.mark.benchmark(group="spec")
+def test_parse(benchmark, spec):
+    templated = SPEC.format(body="hello " * 1000,
+                            attach="\n".join(f"- {attachment}"
+                                             for attachment in spec.attach))
+    benchmark(spc.parse, templated)
+
+
+@pytest.mark.benchmark(group="mime")
+def test_as_mime(benchmark, spec):
+    benchmark(lambda: spec.as_mime(BOUNDARY).as_string())
+
+
+@pytest.mark.benchmark(group="mime")
+def test_write_mime(benchmark, spec):
+    benchmark(lambda: spec.write_mime(io.BytesIO(), BOUNDARY))
+
+
+@pytest.mark.benchmark(group="mime")
+def test_write_mime_cached(benchmark, spec):
+    cache = EncodedAttachmentCache(64 * 1024 * 1024)
+    benchmark(lambda: spec.write_mime(io.BytesIO(), BOUNDARY, cache=cache))
+
+
+@pytest.mark.benchmark(group="mime")
+def test_serialize(benchmark, spec):
+    cache = EncodedAttachmentCache(64 * 1024 * 1024)
+    message = spec.serialize(BOUNDARY, "\r\n", cache)
+    benchmark(message.as_bytes, {"From": "smoke@glasswallsolutions.com"})
@@ -0,0 +1,98 @@
+"""bench_template.py
+
+Benchmark templating specs and generating fake text.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+from datetime import datetime
+
+import pytest
+
+from victoria_smoke import faker_pool
+from victoria_smoke import spec as spc
+from victoria_smoke import template
+
+CHAINED_FILTERS = """{{ library | filetype("pdf") | directory("malware") \
+| like("invoice") | filesize(maximum="1mb") | randomly_pick(5) | to_array }}"""
+
+SPEC_TEMPLATE = """headers:
+  To:
+  - "{{ fake.name() }} <{{ fake.email() }}>"
+  From:
+  - "{{ fake.name() }} <{{ fake.email() }}>"
+  Subject: "{{ fake.sentence() }}"
+  Date: "{{ datetime.now().strftime('%a, %d %b %Y %H:%M:%S +0000') }}"
+body: {{ fake.paragraph(20) | tojson }}
+attach:
+{{ library | filetype("docx") | filesize(minimum="1kb", maximum="1mb") \
+| randomly_pick(3) | to_array }}
+"""
+
+ALL_PDFS_TEMPLATE = SPEC_TEMPLATE.split("attach:")[0] + """attach:
+{{ library | filetype("pdf") | to_array }}
+"""
+"""A spec attaching every pdf in the library, to measure loading attachments.
+"""
+
+NOW = datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def fake():
+    return faker_pool.create_faker()
+
+
+@pytest.mark.benchmark(group="template")
+def test_chained_filters(benchmark, library, fake):
+    compiled = template.compile_template(CHAINED_FILTERS)
+    benchmark(template.render, compiled, library, fake, 1337, NOW)
+
+
+@pytest.mark.benchmark(group="template")
+def test_process(benchmark, library, fake):
+    result = benchmark(template.process, SPEC_TEMPLATE, library, fake, 1337,
+                       NOW)
+    assert result.startswith("headers:")
+
+
+@pytest.mark.benchmark(group="template")
+def test_process_uncompiled(benchmark, library, fake):
+    # a template that isn't in the compiled template cache
+    sources = (f"{SPEC_TEMPLATE}# {i}" for i in range(1000000))
+    benchmark(lambda: template.process(next(sources), library, fake, 1337,
+                                       NOW))
+
+
+@pytest.mark.benchmark(group="text")
+@pytest.mark.parametrize("length", [100, 10000])
+def test_unicode(benchmark, fake, length):
+    assert len(benchmark(fake.unicode, length)) == length
+
+
+@pytest.mark.benchmark(group="text")
+def test_unicode_many(benchmark, fake):
+    benchmark(fake.unicode_many, 100, 100)
+
+
+@pytest.mark.benchmark(group="text")
+@pytest.mark.parametrize("mode", ["ascii", "printable", "control"])
+@pytest.mark.parametrize("length", [100, 10000])
+def test_ascii(benchmark, fake, mode, length):
+    assert len(benchmark(fake.ascii, length, mode)) == length
+
+
+@pytest.mark.benchmark(group="spec")
+@pytest.mark.parametrize("structured", [False, True],
+                         ids=["text", "structured"])
+def test_render_spec(benchmark, library, fake, structured):
+    compiled = template.compile_template(ALL_PDFS_TEMPLATE)
+
+    def render_spec():
+        if structured:
+            return spc.load(
+                template.render_structured(compiled, library, fake, 1337,
+                                           NOW))
+        return spc.parse(template.render(compiled, library, fake, 1337, NOW))
+
+    assert len(benchmark(render_spec).attach) > 0
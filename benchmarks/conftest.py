@@ -0,0 +1,35 @@
+import pytest
+
+from victoria_smoke.attachments import AttachmentLibrary
+
+from synthetic import synthetic_library, write_library
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("victoria_smoke benchmarks")
+    group.addoption("--library-size",
+                    type=int,
+                    default=10000,
+                    help="the number of files in the in-memory synthetic "
+                    "library (default: 10000)")
+    group.addoption("--scan-size",
+                    type=int,
+                    default=10000,
+                    help="the number of files in the synthetic library "
+                    "written to disk to benchmark scanning (default: 10000)")
+
+
+@pytest.fixture(scope="session")
+def library(request) -> AttachmentLibrary:
+    """A synthetic in-memory library, with its indexes already built."""
+    library = synthetic_library(request.config.getoption("--library-size"))
+    library.columns._build_indexes()
+    return library
+
+
+@pytest.fixture(scope="session")
+def library_tree(request, tmp_path_factory) -> str:
+    """The root of a synthetic library written to disk."""
+    root = str(tmp_path_factory.mktemp("library"))
+    write_library(root, request.config.getoption("--scan-size"))
+    return root
@@ -0,0 +1,85 @@
+"""synthetic.py
+
+Generates synthetic attachment libraries for the benchmarks: plausible paths
+and sizes, either in memory or as a tree of sparse files on disk.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import os
+import random
+from typing import List
+
+from victoria_smoke.attachments import Attachment, AttachmentLibrary
+
+WORDS = [
+    "samples", "malware", "clean", "office", "archive", "invoice", "report",
+    "macro", "embedded", "2019", "2020", "quarantine", "regression", "fuzz"
+]
+FILETYPES = ["pdf", "docx", "xlsx", "pptx", "zip", "png", "jpg", "txt"]
+
+MAX_SIZE = 16 * 1024 * 1024
+"""The largest synthetic file, in bytes."""
+
+
+def synthetic_paths(num_files: int,
+                    seed: int = 1337,
+                    root: str = "library") -> List[str]:
+    """Generate a list of plausible attachment paths.
+
+    Args:
+        num_files (int): The number of paths to generate.
+        seed (int): The seed to generate the paths with.
+        root (str): The directory the paths are in.
+
+    Returns:
+        List[str]: The paths.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(num_files):
+        dirs = rng.sample(WORDS, k=rng.randint(2, 5))
+        name = f"{rng.choice(WORDS)}_{i}.{rng.choice(FILETYPES)}"
+        paths.append(os.path.join(root, *dirs, name))
+    return paths
+
+
+def synthetic_sizes(num_files: int, seed: int = 1337) -> List[int]:
+    """Generate a list of file sizes, skewed towards small files like a real
+    library."""
+    rng = random.Random(seed)
+    return [
+        min(int(rng.lognormvariate(11, 2)), MAX_SIZE)
+        for _ in range(num_files)
+    ]
+
+
+def synthetic_library(num_files: int, seed: int = 1337) -> AttachmentLibrary:
+    """Generate an in-memory attachment library of 'num_files' files."""
+    return AttachmentLibrary.from_attachments([
+        Attachment(file_path, size)
+        for file_path, size in zip(synthetic_paths(num_files, seed),
+                                   synthetic_sizes(num_files, seed))
+    ])
+
+
+def write_library(root: str, num_files: int, seed: int = 1337) -> List[str]:
+    """Write a synthetic library to disk.
+
+    The files are sparse, so a large library takes up little disk space and
+    is quick to write.
+
+    Args:
+        root (str): The directory to write the library into.
+        num_files (int): The number of files to write.
+        seed (int): The seed to generate the library with.
+
+    Returns:
+        List[str]: The paths of the files written.
+    """
+    paths = synthetic_paths(num_files, seed, root)
+    for file_path, size in zip(paths, synthetic_sizes(num_files, seed)):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file_handle:
+            file_handle.truncate(size)
+    return paths
@@ -9,7 +9,8 @@ from setuptools import setup, find_packages
 
 setup(
     dependency_links=[],
-    install_requires=["victoria", "click", "marshmallow"],
+    install_requires=["victoria", "click", "marshmallow", "appdirs",
+                      "aiosmtplib", "azure-identity"],
     name="victoria_smoke",
     version="#{TAG_NAME}#",
     description="Victoria plugin to perform smoke tests",
@@ -0,0 +1,128 @@
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import socket
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+import pytest
+
+
+class RecordingHandler:
+    """An aiosmtpd handler that records every message it receives, taking
+    'delay' seconds to accept each one."""
+    def __init__(self, delay: float = 0):
+        self.envelopes = []
+        self.sessions = set()
+        self.delay = delay
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.envelopes.append(envelope)
+        self.sessions.add(id(session))
+        return "250 Message accepted for delivery"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_servers():
+    """A factory starting local stand-ins for clusters' SMTP endpoints. Each
+    returns the handler recording the messages the server receives and the
+    port it's listening on."""
+    controllers = []
+
+    def start(delay: float = 0):
+        handler = RecordingHandler(delay)
+        controller = Controller(handler,
+                                hostname="127.0.0.1",
+                                port=_free_port())
+        controller.start()
+        controllers.append(controller)
+        return handler, controller.port
+
+    yield start
+    for controller in controllers:
+        controller.stop()
+
+
+class LogAnalyticsStandIn:
+    """A local stand-in for the log analytics query API. Transactions are
+    added by From address, and only show up in queries once they're visible.
+    """
+    def __init__(self):
+        self.transactions = {}
+        self.queries = []
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def add(self, from_address: str, transaction_id: str,
+            status: str = "Success", delay: float = 0) -> None:
+        self.transactions[from_address] = (transaction_id, status,
+                                           time.monotonic() + delay)
+
+    def respond(self, query: str):
+        with self.lock:
+            self.queries.append(query)
+            if self.failures:
+                self.failures -= 1
+                return 500, {"error": "try again"}
+        senders = re.search(r"in \((.*?)\)", query).group(1)
+        rows = []
+        for from_address in json.loads(f"[{senders}]"):
+            transaction = self.transactions.get(from_address)
+            if transaction and transaction[2] <= time.monotonic():
+                rows.append([from_address, transaction[0], transaction[1]])
+        return 200, {
+            "tables": [{
+                "name": "PrimaryResult",
+                "columns": [{
+                    "name": "Sender",
+                    "type": "string"
+                }, {
+                    "name": "TransactionId",
+                    "type": "string"
+                }, {
+                    "name": "Status",
+                    "type": "string"
+                }],
+                "rows": rows
+            }]
+        }
+
+
+@pytest.fixture
+def log_analytics():
+    """A local stand-in for the log analytics API, yielding the stand-in and
+    the endpoint it's listening on."""
+    stand_in = LogAnalyticsStandIn()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            status, response = stand_in.respond(json.loads(body)["query"])
+            data = json.dumps(response).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield stand_in, f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
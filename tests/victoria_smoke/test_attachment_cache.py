@@ -0,0 +1,176 @@
+import base64
+import io
+import mmap
+import os
+
+import pytest
+
+from victoria_smoke import attachment_cache
+from victoria_smoke.attachment_cache import EncodedAttachmentCache
+from victoria_smoke.config import SmokeConfig
+from victoria_smoke.mime_writer import BufferList, MimeWriter
+
+
+@pytest.fixture
+def attachment(tmp_path):
+    file_path = tmp_path / "attachment.pdf"
+    file_path.write_bytes(os.urandom(1000))
+    return str(file_path)
+
+
+def encoded_bytes(file_path):
+    with open(file_path, "rb") as attachment_file:
+        return base64.encodebytes(attachment_file.read())
+
+
+def test_get_encodes(attachment):
+    cache = EncodedAttachmentCache(1 << 20)
+    encoded = cache.get(attachment)
+    with open(attachment, "rb") as attachment_file:
+        assert encoded == base64.encodebytes(attachment_file.read())
+    assert cache.get(attachment, "\r\n") == encoded.replace(b"\n", b"\r\n")
+    assert len(encoded) == attachment_cache._encoded_size(1000, "\n")
+
+
+def test_get_hit(attachment):
+    cache = EncodedAttachmentCache(1 << 20)
+    first = cache.get(attachment)
+    assert cache.get(attachment) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_get_modified(attachment):
+    cache = EncodedAttachmentCache(1 << 20)
+    first = cache.get(attachment)
+    with open(attachment, "ab") as attachment_file:
+        attachment_file.write(b"more")
+    assert cache.get(attachment) != first
+    assert cache.misses == 2
+
+
+def test_lru_eviction(tmp_path):
+    files = []
+    for i in range(3):
+        file_path = tmp_path / f"file-{i}.bin"
+        file_path.write_bytes(bytes(570))
+        files.append(str(file_path))
+    # room for two encoded files
+    encoded_size = attachment_cache._encoded_size(570, "\n")
+    cache = EncodedAttachmentCache(2 * encoded_size)
+    cache.get(files[0])
+    cache.get(files[1])
+    cache.get(files[0])
+    cache.get(files[2])
+    assert cache.size <= cache.max_size
+
+    # file 1 was least recently used, so was evicted
+    cache.get(files[0])
+    cache.get(files[1])
+    assert cache.misses == 4
+
+
+def test_too_large(attachment):
+    assert EncodedAttachmentCache(100).get(attachment) is None
+
+
+def test_disk_store(attachment, tmp_path):
+    store = tmp_path / "store"
+    cache = EncodedAttachmentCache(100, str(store))
+    encoded = cache.get(attachment)
+    assert isinstance(encoded, mmap.mmap)
+    assert len(os.listdir(store)) == 1
+
+    # a new cache with the same store doesn't need to encode again
+    other = EncodedAttachmentCache(100, str(store))
+    assert other.get(attachment)[:] == encoded[:]
+    assert other.misses == 0
+
+
+def test_disk_store_spill(attachment, tmp_path):
+    other_attachment = tmp_path / "other.pdf"
+    other_attachment.write_bytes(os.urandom(1000))
+    store = tmp_path / "store"
+    # room for one encoded file
+    cache = EncodedAttachmentCache(attachment_cache._encoded_size(1000, "\n"),
+                                   str(store))
+    encoded = cache.get(attachment)
+    assert os.listdir(store) == []
+
+    # the first attachment is evicted and spilled to disk
+    cache.get(str(other_attachment))
+    assert len(os.listdir(store)) == 1
+    assert cache.get(attachment)[:] == encoded
+    assert cache.misses == 2
+
+
+def test_writer_uses_cache(attachment):
+    cache = EncodedAttachmentCache(1 << 20)
+    outputs = []
+    for _ in range(2):
+        stream = io.BytesIO()
+        writer = MimeWriter(stream, "boundary", cache=cache)
+        writer.write_attachment(attachment)
+        writer.close()
+        assert writer.bytes_written == len(stream.getvalue())
+        outputs.append(stream.getvalue())
+    assert outputs[0] == outputs[1]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_from_config(tmp_path):
+    cfg = SmokeConfig([], attachment_cache_size="1kib",
+                      attachment_cache_dir=str(tmp_path / "store"))
+    cache = EncodedAttachmentCache.from_config(cfg)
+    assert cache.max_size == 1024
+    assert cache.directory == str(tmp_path / "store")
+
+
+def test_disk_store_mappings_closed(attachment, tmp_path):
+    cache = EncodedAttachmentCache(100, str(tmp_path / "store"))
+    mapped = []
+
+    def get(*args):
+        mapped.append(EncodedAttachmentCache.get(cache, *args))
+        return mapped[-1]
+
+    cache.get = get
+    stream = io.BytesIO()
+    writer = MimeWriter(stream, "boundary", cache=cache)
+    for _ in range(2):
+        writer.write_attachment(attachment)
+    writer.close()
+    assert mapped[0] is not mapped[1]
+    assert all(mapping.closed for mapping in mapped)
+    assert stream.getvalue().count(encoded_bytes(attachment)) == 2
+
+    # a BufferList keeps large mappings, so they're left open
+    large_attachment = tmp_path / "large.pdf"
+    large_attachment.write_bytes(os.urandom(1 << 20))
+    writer = MimeWriter(BufferList(), "boundary", cache=cache)
+    writer.write_attachment(str(large_attachment))
+    assert not mapped[-1].closed
+
+
+def test_disk_store_removes_stale(attachment, tmp_path):
+    store = tmp_path / "store"
+    cache = EncodedAttachmentCache(100, str(store))
+    cache.get(attachment)
+    with open(attachment, "ab") as attachment_file:
+        attachment_file.write(b"more")
+    assert cache.get(attachment)[:] == encoded_bytes(attachment)
+    # only the latest version is kept
+    store_dir, = os.listdir(store)
+    assert len(os.listdir(store / store_dir)) == 1
+
+
+def test_disk_store_failed_write(attachment, tmp_path, monkeypatch):
+    def fail(file_path, stream, linesep):
+        stream.write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(attachment_cache.mime_writer, "encode_file", fail)
+    store = tmp_path / "store"
+    cache = EncodedAttachmentCache(100, str(store))
+    with pytest.raises(OSError):
+        cache.get(attachment)
+    assert [files for _, _, files in os.walk(store)] == [[], []]
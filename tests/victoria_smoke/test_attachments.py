@@ -4,6 +4,7 @@ import contextlib
 import io
 import os
 import os.path
+import random
 
 import pytest
 
@@ -140,4 +141,135 @@ def test_random_choice(library):
     assert get_filenames(files) == [
         os.path.normpath(f".{os.sep}pdf_file.pdf"),
         os.path.normpath(f".{os.sep}big_file.txt")
-    ]
\ No newline at end of file
+    ]
+
+
+def test_filtered_library_is_view(library):
+    files = library.get_filetype("txt").get_filesize(max_bytes=1500)
+    assert files.columns is library.columns
+    assert list(files.rows) == [0, 1, 2, 3]
+
+
+def test_from_attachments():
+    attachments = [
+        Attachment(os.path.normpath(f"subdir{os.sep}a.pdf"), 10),
+        Attachment(os.path.normpath(f"other{os.sep}b.txt"), 20)
+    ]
+    library = AttachmentLibrary.from_attachments(attachments)
+    assert library.index == attachments
+    assert get_filenames(library.get_directory("other")) == [
+        os.path.normpath(f"other{os.sep}b.txt")
+    ]
+
+
+def test_filter_keeps_view_order(library):
+    files = library.random_choice(count=4, seed=1337).get_filesize(
+        max_bytes=1500)
+    expected = [
+        item.path for item in library.random_choice(count=4, seed=1337).index
+        if item.size <= 1500
+    ]
+    assert get_filenames(files) == expected
+
+
+def test_secondary_indexes_rebuilt_after_append():
+    library = AttachmentLibrary.from_attachments(
+        [Attachment(os.path.normpath(f"a{os.sep}b{os.sep}c.pdf"), 10)])
+    assert len(library.get_directory("b")) == 1
+
+    library.columns.append(os.path.normpath(f"b{os.sep}d.pdf"), 20)
+    full = AttachmentLibrary.from_rows(library.columns, [0, 1])
+    assert len(full.get_directory("b")) == 2
+    assert len(full.get_filetype("pdf").get_filesize(max_bytes=15)) == 1
+
+
+def test_query_matches_eager(library):
+    eager = library.get_like("file").get_filetype("txt").get_filesize(
+        max_bytes=1500).get_directory("subdir")
+    query = library.query().get_like("file").get_filetype(
+        "txt").get_filesize(max_bytes=1500).get_directory("subdir")
+    assert query.index == eager.index
+
+
+def test_query_plan(library):
+    query = library.query().get_like("file").get_filetype("pdf")
+    candidates, residual = query._plan()
+    assert get_filenames(candidates) == [os.path.normpath("pdf_file.pdf")]
+    assert [predicate.kind for predicate in residual] == ["like"]
+
+
+def test_query_plan_looks_up_driver_only(library, monkeypatch):
+    columns = library.columns
+    lookups = []
+    for name in ("rows_in_directory", "rows_with_size", "rows_like"):
+        lookup = getattr(columns, name)
+        monkeypatch.setattr(
+            columns, name,
+            lambda *args, n=name, f=lookup: lookups.append(n) or f(*args))
+    query = library.query().get_directory("subdir").get_filesize(
+        max_bytes=1500).get_like("file")
+    eager = library.get_directory("subdir").get_filesize(
+        max_bytes=1500).get_like("file")
+    lookups.clear()
+    assert query.index == eager.index
+    assert len(lookups) == 1
+
+
+def test_query_random_choice(library):
+    files = library.query().get_filetype("txt").get_like("sub").random_choice(
+        count=1, seed=1337)
+    assert len(files) == 1
+    assert "subfile" in get_filenames(files)[0]
+
+    with pytest.raises(ValueError):
+        library.query().get_like("sub").get_filetype("txt").random_choice(
+            count=3)
+
+
+def test_directory_trie():
+    attachments = [
+        Attachment(os.path.normpath(f"{os.sep}lib{os.sep}a{os.sep}x.pdf"), 1),
+        Attachment(
+            os.path.normpath(f"{os.sep}lib{os.sep}a{os.sep}b{os.sep}y.pdf"),
+            2),
+        Attachment(os.path.normpath(f"{os.sep}lib{os.sep}c{os.sep}z.pdf"), 3),
+        Attachment("root.txt", 4)
+    ]
+    library = AttachmentLibrary.from_attachments(attachments)
+    assert library.index == attachments
+    assert library.columns.names == ["x.pdf", "y.pdf", "z.pdf", "root.txt"]
+
+    # the directories are shared between attachments
+    assert len(library.columns.dir_table) == 5
+    assert [item.size for item in library.get_directory("a")] == [1, 2]
+    assert [item.size for item in library.get_directory("lib")] == [1, 2, 3]
+
+
+def test_random_choice_keeps_global_state(library):
+    random.seed(42)
+    expected = random.random()
+    random.seed(42)
+    library.random_choice(count=2, seed=1337)
+    assert random.random() == expected
+
+
+def test_random_choice_weighted(library):
+    files = library.random_choice(count=1, seed=1337, weights={"pdf": 1})
+    assert get_filenames(files) == [os.path.normpath(f".{os.sep}pdf_file.pdf")]
+
+    files = library.random_choice(count=6, seed=1337, weights="size")
+    assert sorted(get_filenames(files)) == sorted(get_filenames(library))
+
+    assert get_filenames(library.random_choice(count=0, weights="size")) == []
+    assert get_filenames(library.query().get_filetype("txt").random_choice(
+        count=0, weights={"txt": 1})) == []
+
+
+def test_query_random_choice_sparse_matches():
+    library = AttachmentLibrary.from_attachments(
+        [Attachment(f"file_{i}.txt", i) for i in range(1000)])
+    files = library.query().get_filetype("txt").get_like("99").random_choice(
+        count=5, seed=1337)
+    names = [item.path for item in files]
+    assert len(set(names)) == 5
+    assert all("99" in name for name in names)
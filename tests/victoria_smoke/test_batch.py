@@ -0,0 +1,151 @@
+from datetime import datetime, timezone
+import email
+import os
+
+import pytest
+
+from victoria_smoke import batch
+from victoria_smoke.config import SmokeConfig
+
+SPEC = """headers:
+  To:
+  - "Test <test@example.com>"
+  From:
+  - "Test <test@example.com>"
+  Date: "Wed, 01 Jan 2020 00:00:00 +0000"
+body: "{{ fake.paragraph(2) }}"
+attach:
+{{ library | filetype("pdf") | to_array }}
+"""
+
+SEEDED_SPEC = """headers:
+  To:
+  - "{{ fake.name() }} <{{ fake.email() }}>"
+  From:
+  - "Test <test@example.com>"
+  Date: "{{ datetime.now().strftime('%a, %d %b %Y %H:%M:%S %z') }}"
+body: {{ (uuid.uuid4() ~ " " ~ fake.ascii(20, "printable")) | tojson }}
+attach:
+{{ library | randomly_pick(2) | to_array }}
+"""
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+    (library_dir / "attachment.pdf").write_text("an attachment")
+    for i in range(10):
+        (library_dir / f"other-{i}.pdf").write_text(f"attachment {i}")
+    return SmokeConfig([str(library_dir)],
+                       index_cache_path=str(tmp_path / "index.pickle"))
+
+
+@pytest.fixture
+def spec_file(tmp_path):
+    spec_path = tmp_path / "spec.yaml"
+    spec_path.write_text(SPEC)
+    return str(spec_path)
+
+
+def test_render_batch(cfg, spec_file, tmp_path):
+    output_dir = tmp_path / "output"
+    result = batch.render_batch(cfg, [spec_file],
+                                count=5,
+                                output_dir=str(output_dir),
+                                workers=2)
+    assert result.messages == 5
+    files = sorted(os.listdir(output_dir))
+    assert files == [f"000-spec-{i:06d}.eml" for i in range(5)]
+    contents = (output_dir / files[0]).read_text()
+    assert "attachment.pdf" in contents
+    assert result.bytes_written == sum(
+        os.path.getsize(output_dir / name) for name in files)
+
+
+def test_render_batch_unseeded_workers(cfg, spec_file, tmp_path):
+    output_dir = tmp_path / "output"
+    batch.render_batch(cfg, [spec_file],
+                       count=8,
+                       output_dir=str(output_dir),
+                       workers=4)
+    bodies = {
+        email.message_from_bytes(
+            (output_dir / name).read_bytes()).get_payload()[-1].get_payload()
+        for name in os.listdir(output_dir)
+    }
+    # each worker generates its own random messages
+    assert len(bodies) == 8
+
+
+def test_render_batch_same_filenames(cfg, tmp_path):
+    spec_files = []
+    for directory in ["one", "two"]:
+        (tmp_path / directory).mkdir()
+        spec_path = tmp_path / directory / "spec.yaml"
+        spec_path.write_text(SPEC)
+        spec_files.append(str(spec_path))
+    spec_files.append(spec_files[0])
+
+    output_dir = tmp_path / "output"
+    result = batch.render_batch(cfg,
+                                spec_files,
+                                count=2,
+                                output_dir=str(output_dir),
+                                workers=1)
+    files = sorted(os.listdir(output_dir))
+    assert result.messages == len(files) == 6
+    assert files[:2] == ["000-spec-000000.eml", "000-spec-000001.eml"]
+    assert files[-1] == "002-spec-000001.eml"
+    assert result.bytes_written == sum(
+        os.path.getsize(output_dir / name) for name in files)
+
+
+def _render_contents(cfg, spec_file, output_dir, **kwargs):
+    batch.render_batch(cfg, [spec_file],
+                       count=6,
+                       output_dir=str(output_dir),
+                       run_seed=1337,
+                       now=datetime(2020, 1, 1, tzinfo=timezone.utc),
+                       **kwargs)
+    return {
+        name: (output_dir / name).read_bytes()
+        for name in os.listdir(output_dir)
+    }
+
+
+def test_render_batch_seeded(cfg, tmp_path):
+    spec_path = tmp_path / "seeded.yaml"
+    spec_path.write_text(SEEDED_SPEC)
+
+    serial = _render_contents(cfg, str(spec_path), tmp_path / "serial",
+                              workers=1)
+    parallel = _render_contents(cfg, str(spec_path), tmp_path / "parallel",
+                                workers=2)
+    assert len(serial) == 6
+    assert serial == parallel
+    assert len(set(serial.values())) == 6
+    assert b"Wed, 01 Jan 2020 00:00:00 +0000" in serial["000-seeded-000000.eml"]
+
+    sharded = {}
+    for shard_index in range(3):
+        sharded.update(
+            _render_contents(cfg, str(spec_path),
+                             tmp_path / f"shard-{shard_index}",
+                             workers=1,
+                             shard=(shard_index, 3)))
+    assert sharded == serial
+
+
+def test_render_batch_invalid_shard(cfg, spec_file, tmp_path):
+    with pytest.raises(ValueError):
+        batch.render_batch(cfg, [spec_file],
+                           count=1,
+                           output_dir=str(tmp_path),
+                           shard=(3, 3))
+
+
+def test_derive_seed():
+    assert batch.derive_seed(1337, 0) == batch.derive_seed(1337, 0)
+    assert batch.derive_seed(1337, 0) != batch.derive_seed(1337, 1)
+    assert batch.derive_seed(1337, 0) != batch.derive_seed(1338, 0)
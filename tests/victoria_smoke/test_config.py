@@ -0,0 +1,28 @@
+from marshmallow import ValidationError
+import pytest
+
+from victoria_smoke.config import ClusterConfigSchema
+
+
+def test_cluster_config_connections():
+    schema = ClusterConfigSchema()
+    cluster = schema.load({
+        "smtp_host": "localhost",
+        "connections": 8,
+        "min_connections": 2,
+        "initial_connections": 4
+    })
+    assert (cluster.min_connections, cluster.initial_connections,
+            cluster.connections) == (2, 4, 8)
+    assert schema.load({"smtp_host": "localhost"}).initial_connections == 1
+
+
+@pytest.mark.parametrize("connections,field", [
+    ({"connections": 2, "initial_connections": 3}, "initial_connections"),
+    ({"connections": 2, "min_connections": 3}, "min_connections"),
+    ({"min_connections": 3, "initial_connections": 2}, "initial_connections"),
+])
+def test_cluster_config_connections_invalid(connections, field):
+    with pytest.raises(ValidationError) as err:
+        ClusterConfigSchema().load({"smtp_host": "localhost", **connections})
+    assert field in err.value.messages
@@ -0,0 +1,22 @@
+import threading
+
+from victoria_smoke import faker_pool
+
+
+def test_get_faker_reused():
+    assert faker_pool.get_faker() is faker_pool.get_faker()
+    assert hasattr(faker_pool.get_faker(), "unicode")
+
+
+def test_get_faker_per_thread():
+    fakers = []
+    thread = threading.Thread(
+        target=lambda: fakers.append(faker_pool.get_faker()))
+    thread.start()
+    thread.join()
+    assert fakers[0] is not faker_pool.get_faker()
+
+
+def test_get_faker_seeded():
+    first = faker_pool.get_faker(1337).name()
+    assert faker_pool.get_faker(1337).name() == first
@@ -1,8 +1,11 @@
+from collections import Counter
+
 from faker import Faker
 import pytest
 import unicodedata
 
-from victoria_smoke.faker_text_provider import TextProvider
+from victoria_smoke.faker_text_provider import (ASCII_MODES, CONTROL_CHARS,
+                                                 TextProvider)
 
 
 @pytest.fixture
@@ -19,4 +22,63 @@ def test_fake_unicode(faker):
 
 def test_fake_ascii(faker):
     result = faker.ascii(1000)
-    assert len(result) == 1000
\ No newline at end of file
+    assert len(result) == 1000
+
+
+def test_fake_unicode_reproducible(faker):
+    faker.seed_instance(1337)
+    first = faker.unicode(100)
+    faker.seed_instance(1337)
+    assert faker.unicode(100) == first
+
+
+def test_fake_unicode_many(faker):
+    result = faker.unicode_many(10, 50)
+    assert len(result) == 10
+    assert all(len(text) == 50 for text in result)
+
+
+@pytest.mark.parametrize("mode,allowed", [
+    ("ascii", set(range(128))),
+    ("printable", set(range(0x20, 0x7f))),
+    ("control", set(range(128))),
+])
+def test_fake_ascii_modes(faker, mode, allowed):
+    result = faker.ascii_bytes(1000, mode=mode)
+    assert len(result) == 1000
+    assert set(result) <= allowed
+
+
+def test_fake_ascii_control_heavy(faker):
+    result = faker.ascii_bytes(1000, mode="control")
+    controls = sum(1 for b in result if b < 0x20 or b == 0x7f)
+    assert controls > 300
+
+
+def test_fake_ascii_line_length(faker):
+    result = faker.ascii(100, mode="printable", line_length=30)
+    assert [len(line) for line in result.split("\r\n")] == [30, 30, 30, 10]
+
+
+def test_fake_ascii_reproducible(faker):
+    faker.seed_instance(1337)
+    first = faker.ascii(100)
+    faker.seed_instance(1337)
+    assert faker.ascii(100) == first
+
+
+def test_fake_ascii_unknown_mode(faker):
+    with pytest.raises(ValueError):
+        faker.ascii(10, mode="unknown")
+
+
+@pytest.mark.parametrize("mode", ["ascii", "printable", "control"])
+def test_fake_ascii_uniform(mode):
+    table, rejected = ASCII_MODES[mode]
+    accepted = [b for b in range(256) if b not in rejected]
+    counts = Counter(table[b] for b in accepted)
+    # every control character comes from as many bytes, as does every other
+    # character
+    assert len({counts[c] for c in counts if c in CONTROL_CHARS}) <= 1
+    assert len({counts[c] for c in counts if c not in CONTROL_CHARS}) == 1
+    assert len(bytes(range(256)).translate(table, rejected)) == len(accepted)
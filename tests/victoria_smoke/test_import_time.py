@@ -0,0 +1,14 @@
+from victoria_smoke.importtime import import_times
+
+HEAVY_MODULES = [
+    "aiosmtplib", "asyncio", "faker", "jinja2", "sremail", "yaml",
+    "victoria_smoke.batch", "victoria_smoke.run", "victoria_smoke.run_store",
+    "victoria_smoke.send", "victoria_smoke.spec", "victoria_smoke.template"
+]
+"""Modules that should only be imported when a command runs."""
+
+
+def test_heavy_modules_not_imported():
+    imported = import_times("import victoria_smoke")
+    assert "victoria_smoke.cli" in imported
+    assert [module for module in HEAVY_MODULES if module in imported] == []
@@ -0,0 +1,142 @@
+import os
+import time
+
+import pytest
+
+from victoria_smoke.attachments import AttachmentLibrary, Attachment
+from victoria_smoke.index_cache import IndexCache
+
+
+@pytest.fixture
+def library_dir(tmp_path):
+    (tmp_path / "subdir").mkdir()
+    (tmp_path / "root_file.txt").write_text("Regular file")
+    (tmp_path / "subdir" / "subfile.txt").write_text("MUCH LONGER FILE!!!")
+    # modified long enough ago that the cached records are trusted
+    for directory in [tmp_path / "subdir", tmp_path]:
+        os.utime(directory, (time.time() - 60, time.time() - 60))
+    return tmp_path
+
+
+@pytest.fixture
+def cache_path(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("cache") / "index.pickle")
+
+
+def bump_mtime(directory):
+    stat = os.stat(directory)
+    os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+
+def test_walk(library_dir, cache_path):
+    cache = IndexCache(cache_path)
+    files = sorted(cache.walk(str(library_dir)))
+    assert files == [(str(library_dir / "root_file.txt"), 12),
+                     (str(library_dir / "subdir" / "subfile.txt"), 19)]
+    assert cache.rescanned == 2
+
+
+def test_save_and_load(library_dir, cache_path):
+    cache = IndexCache(cache_path)
+    list(cache.walk(str(library_dir)))
+    cache.save()
+
+    loaded = IndexCache(cache_path)
+    assert loaded.libraries == cache.libraries
+    assert loaded.stats(str(library_dir)) == (2, 2, 31)
+
+
+def test_incremental_rescan(library_dir, cache_path):
+    cache = IndexCache(cache_path)
+    list(cache.walk(str(library_dir)))
+    cache.save()
+
+    cache = IndexCache(cache_path)
+    list(cache.walk(str(library_dir)))
+    assert cache.rescanned == 0
+
+    (library_dir / "subdir" / "new_file.txt").write_text("new")
+    bump_mtime(library_dir / "subdir")
+    files = [file_path for file_path, _ in cache.walk(str(library_dir))]
+    assert str(library_dir / "subdir" / "new_file.txt") in files
+    assert cache.rescanned == 1
+
+
+def test_racy_rescan(library_dir, cache_path):
+    subdir = library_dir / "subdir"
+    # the directory was modified just before it's scanned
+    os.utime(subdir)
+    cache = IndexCache(cache_path)
+    list(cache.walk(str(library_dir)))
+
+    # a file added in the same mtime tick leaves the mtime as it was
+    stat = os.stat(subdir)
+    (subdir / "new_file.txt").write_text("new")
+    os.utime(subdir, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    cache.rescanned = 0
+    files = [file_path for file_path, _ in cache.walk(str(library_dir))]
+    assert str(subdir / "new_file.txt") in files
+    assert cache.rescanned == 1
+
+
+def test_corrupt_cache(cache_path):
+    with open(cache_path, "wb") as cache_file:
+        cache_file.write(b"not a pickle")
+    cache = IndexCache(cache_path)
+    assert cache.libraries == {}
+
+
+def test_library_with_cache(library_dir, cache_path):
+    library = AttachmentLibrary([str(library_dir)], IndexCache(cache_path))
+    assert sorted(library.index) == [
+        Attachment(os.path.normpath(str(library_dir / "root_file.txt")), 12),
+        Attachment(
+            os.path.normpath(str(library_dir / "subdir" / "subfile.txt")), 19)
+    ]
+    assert os.path.exists(cache_path)
+
+
+def test_parallel_walk_matches_serial(library_dir, cache_path):
+    serial = list(IndexCache(cache_path).walk(str(library_dir)))
+    parallel = list(IndexCache(cache_path).walk(str(library_dir), workers=4))
+    assert parallel == serial
+
+
+def test_library_parallel(library_dir):
+    library = AttachmentLibrary([str(library_dir)], workers=4)
+    assert sorted(library.index) == [
+        Attachment(os.path.normpath(str(library_dir / "root_file.txt")), 12),
+        Attachment(
+            os.path.normpath(str(library_dir / "subdir" / "subfile.txt")), 19)
+    ]
+
+
+def _make_tree(root, names):
+    root.mkdir()
+    for subdir in sorted(["a", "b", "c"], reverse=names[0] > names[-1]):
+        (root / subdir).mkdir()
+        for name in names:
+            (root / subdir / f"{name}.pdf").write_text(name)
+    for name in names:
+        (root / f"{name}.pdf").write_text(name)
+
+
+def test_library_order_canonical(tmp_path, cache_path):
+    names = [f"file_{i:02d}" for i in range(20)]
+    trees = [tmp_path / "forwards", tmp_path / "backwards"]
+    # the same tree, created in a different order
+    _make_tree(trees[0], names)
+    _make_tree(trees[1], names[::-1])
+
+    picks = []
+    for root in trees:
+        for library in [
+                AttachmentLibrary([str(root)]),
+                AttachmentLibrary([str(root)], workers=4),
+                AttachmentLibrary([str(root)], IndexCache(cache_path))
+        ]:
+            picked = library.random_choice(count=5, seed=1337)
+            picks.append([
+                os.path.relpath(item.path, str(root)) for item in picked
+            ])
+    assert all(pick == picks[0] for pick in picks)
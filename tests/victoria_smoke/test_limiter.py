@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from victoria_smoke import limiter as lim
+from victoria_smoke.limiter import AimdLimiter
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_slow_start():
+    async def run():
+        limiter = AimdLimiter(1, 8, 1, target_latency=1)
+        for _ in range(10):
+            await limiter.acquire()
+            await limiter.release(0.01)
+        return limiter
+
+    limiter = _run(run())
+    assert limiter.limit == 8
+    assert limiter.in_flight == 0
+
+
+def test_error_backoff():
+    async def run():
+        limiter = AimdLimiter(1, 8, 8, target_latency=1)
+        await limiter.acquire()
+        await limiter.release(0.01, failed=True)
+        assert limiter.limit == 8 * lim.ERROR_BACKOFF
+
+        # a burst of failures within one round trip only backs off once
+        limiter.latency = 60
+        await limiter.acquire()
+        await limiter.release(0.01, failed=True)
+        assert limiter.limit == 8 * lim.ERROR_BACKOFF
+
+        # additive increase after backing off
+        limiter.latency = 0
+        await limiter.acquire()
+        await limiter.release(0.01)
+        assert limiter.limit == pytest.approx(4.25)
+        return limiter
+
+    limiter = _run(run())
+    assert limiter.error_rate > 0
+
+
+def test_latency_backoff():
+    async def run():
+        limiter = AimdLimiter(2, 8, 4, target_latency=0.5)
+        await limiter.acquire()
+        await limiter.release(1.0)
+        assert limiter.limit == 4 * lim.LATENCY_BACKOFF
+        for _ in range(20):
+            limiter._last_decrease = float("-inf")
+            await limiter.acquire()
+            await limiter.release(1.0)
+        assert limiter.limit == 2
+
+    _run(run())
+
+
+def test_acquire_waits():
+    async def run():
+        limiter = AimdLimiter(1, 2, 2, target_latency=1)
+        await limiter.acquire()
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        await limiter.release(0.01)
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.in_flight == 2
+
+    _run(run())
@@ -0,0 +1,118 @@
+import email
+from email import policy
+import io
+
+import pytest
+
+from victoria_smoke import mime_writer
+from victoria_smoke.spec import Spec
+
+HEADERS = {
+    "To": ["Test <test@example.com>"],
+    "From": ["Test <test@example.com>"],
+    "Date": "Wed, 01 Jan 2020 00:00:00 +0000",
+}
+
+
+@pytest.fixture
+def attachments(tmp_path):
+    small = tmp_path / "small.pdf"
+    small.write_bytes(b"a small attachment")
+    large = tmp_path / "large file.bin"
+    large.write_bytes(bytes(range(256)) * 1000)
+    empty = tmp_path / "empty.docx"
+    empty.write_bytes(b"")
+    return [str(small), str(large), str(empty)]
+
+
+def _parse(data: bytes) -> email.message.EmailMessage:
+    return email.message_from_bytes(data, policy=policy.default)
+
+
+@pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_write_mime(attachments, linesep, monkeypatch):
+    # make sure attachments span several chunks
+    monkeypatch.setattr(mime_writer, "CHUNK_SIZE", 57 * 10)
+    spec = Spec(HEADERS, "the body", attachments)
+    stream = io.BytesIO()
+    written = spec.write_mime(stream, boundary="boundary", linesep=linesep)
+
+    data = stream.getvalue()
+    assert written == len(data)
+    assert data.endswith(f"--boundary--{linesep}".encode("ascii"))
+    if linesep == "\r\n":
+        assert b"\n" not in data.replace(b"\r\n", b"")
+
+    parsed = _parse(data)
+    assert parsed["To"] == "Test <test@example.com>"
+    assert parsed["Date"] == "Wed, 01 Jan 2020 00:00:00 +0000"
+    assert parsed.get_boundary() == "boundary"
+    parts = list(parsed.iter_parts())
+    assert len(parts) == 4
+    for part, file_path in zip(parts, attachments):
+        with open(file_path, "rb") as attachment_file:
+            assert part.get_content() == attachment_file.read()
+    assert parts[0].get_content_type() == "application/pdf"
+    assert parts[1].get_filename() == "large file.bin"
+    assert parts[1].get_content_type() == "application/octet-stream"
+    assert parts[3].get_content().strip() == "the body"
+
+
+def test_write_mime_matches_as_mime(attachments):
+    spec = Spec(HEADERS, "the body", attachments[:2])
+    stream = io.BytesIO()
+    spec.write_mime(stream)
+    streamed = _parse(stream.getvalue())
+    in_memory = _parse(spec.as_mime().as_bytes())
+
+    assert streamed.items()[2:] == in_memory.items()[2:]
+    for streamed_part, part in zip(streamed.iter_parts(),
+                                   in_memory.iter_parts()):
+        assert streamed_part.get_content() == part.get_content()
+        assert streamed_part.get_filename() == part.get_filename()
+
+
+def test_make_boundary():
+    assert mime_writer.make_boundary() != mime_writer.make_boundary()
+
+
+def test_serialize(attachments):
+    spec = Spec(HEADERS, "the body", attachments)
+    stream = io.BytesIO()
+    spec.write_mime(stream, boundary="boundary")
+    serialized = spec.serialize(boundary="boundary")
+    assert serialized.as_bytes() == stream.getvalue()
+
+
+def test_serialize_overrides(attachments):
+    serialized = Spec(HEADERS, "the body", attachments).serialize()
+    first = serialized.buffers({
+        "From": "Cluster 1 <one@example.com>",
+        "Message-ID": "<1@example.com>"
+    })
+    second = serialized.buffers({"from": "Cluster 2 <two@example.com>"})
+
+    # the payload is shared between every message
+    assert all(a is b for a, b in zip(first[1:], second[1:]))
+
+    parsed = _parse(b"".join(first))
+    assert parsed["From"] == "Cluster 1 <one@example.com>"
+    assert parsed["Message-ID"] == "<1@example.com>"
+    assert parsed["To"] == "Test <test@example.com>"
+    assert len(list(parsed.iter_parts())) == 4
+    parsed = _parse(b"".join(second))
+    assert parsed["From"] == "Cluster 2 <two@example.com>"
+    assert parsed.get_all("From") == ["Cluster 2 <two@example.com>"]
+
+
+def test_buffer_list(monkeypatch):
+    monkeypatch.setattr(mime_writer, "COALESCE_SIZE", 8)
+    large = b"a large buffer"
+    buffers = mime_writer.BufferList()
+    buffers.write(b"abc")
+    buffers.write(b"def")
+    buffers.write(large)
+    buffers.write(b"ghi")
+    result = buffers.getbuffers()
+    assert [bytes(buffer) for buffer in result] == [b"abcdef", large, b"ghi"]
+    assert result[1].obj is large
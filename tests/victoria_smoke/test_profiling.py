@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from victoria_smoke import profiling
+
+
+@pytest.fixture
+def enabled():
+    profiling.enable()
+    yield
+    profiling.disable()
+
+
+def test_disabled():
+    profiling.disable()
+    assert not profiling.is_enabled()
+    with profiling.timed("stage") as timer:
+        assert timer is None
+    profiling.count("counter")
+
+    profiling.enable()
+    profiling.disable()
+    profile = profiling.snapshot()
+    assert profile.stages == {}
+    assert profile.counters == {}
+
+
+def test_timed(enabled):
+    for _ in range(3):
+        with profiling.timed("outer"):
+            with profiling.timed("outer.inner"):
+                pass
+    with pytest.raises(ValueError):
+        with profiling.timed("failed"):
+            raise ValueError("stage failed")
+
+    profile = profiling.snapshot()
+    assert profile.stages["outer"].calls == 3
+    assert profile.stages["outer.inner"].calls == 3
+    assert profile.stages["outer"].seconds >= \
+        profile.stages["outer.inner"].seconds
+    assert profile.stages["outer"].max_seconds <= \
+        profile.stages["outer"].seconds
+    assert profile.stages["failed"].calls == 1
+
+
+def test_count(enabled):
+    profiling.count("messages")
+    profiling.count("messages", 2)
+    profiling.count("send.bytes", 1024)
+    assert profiling.snapshot().counters == {
+        "messages": 3,
+        "send.bytes": 1024
+    }
+
+
+def test_enable_resets():
+    profiling.enable()
+    profiling.count("messages")
+    profiling.enable()
+    profiling.disable()
+    assert profiling.snapshot().counters == {}
+
+
+@pytest.fixture
+def profile():
+    return profiling.Profile(
+        {
+            "spec.yaml": profiling.StageStats(2, 0.5, 0.3),
+            "scan": profiling.StageStats(1, 1.0, 1.0)
+        }, {"send.bytes": 2048}, 2.0)
+
+
+def test_report(profile):
+    lines = profiling.report(profile)
+    assert lines[1].split() == ["scan", "1", "1.000", "1000.000", "1000.000",
+                                "50.0%"]
+    assert lines[2].split() == ["spec.yaml", "2", "0.500", "250.000",
+                                "300.000", "25.0%"]
+    assert lines[-1].split() == ["send.bytes", "2048"]
+
+
+def test_to_json(profile):
+    assert json.loads(profiling.to_json(profile)) == {
+        "seconds": 2.0,
+        "stages": {
+            "scan": {
+                "calls": 1,
+                "seconds": 1.0,
+                "max_seconds": 1.0
+            },
+            "spec.yaml": {
+                "calls": 2,
+                "seconds": 0.5,
+                "max_seconds": 0.3
+            }
+        },
+        "counters": {
+            "send.bytes": 2048
+        }
+    }
+
+
+def test_to_prometheus(profile):
+    lines = profiling.to_prometheus(profile).splitlines()
+    assert "# TYPE victoria_smoke_stage_seconds_total counter" in lines
+    assert 'victoria_smoke_stage_seconds_total{stage="spec.yaml"} 0.5' in lines
+    assert 'victoria_smoke_stage_calls_total{stage="scan"} 1' in lines
+    assert "# TYPE victoria_smoke_stage_max_seconds gauge" in lines
+    assert "victoria_smoke_send_bytes_total 2048" in lines
+
+
+def test_write_metrics(profile, tmp_path):
+    metrics_path = str(tmp_path / "metrics.prom")
+    profiling.write_metrics(metrics_path, "prometheus", profile)
+    with open(metrics_path) as metrics_file:
+        assert metrics_file.read() == profiling.to_prometheus(profile)
+
+    with pytest.raises(ValueError):
+        profiling.write_metrics(metrics_path, "xml", profile)
@@ -0,0 +1,126 @@
+from datetime import datetime
+import sqlite3
+
+import pytest
+
+from victoria_smoke.run_store import RunStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    with RunStore(str(tmp_path / "runs.sqlite3")) as run_store:
+        yield run_store
+
+
+def _record_run(store, run_id):
+    store.start_run(run_id, ["one", "two"], run_seed=1337)
+    for number in range(3):
+        store.add_spec(run_id, number, "spec.yaml", number, f"spec {number}")
+        store.add_spec(run_id, number, "spec.yaml", number, "ignored")
+        for cluster in ("one", "two"):
+            failed = number == 1 and cluster == "two"
+            store.add_result(run_id,
+                             number,
+                             cluster,
+                             "send",
+                             error="refused" if failed else None)
+            if not failed:
+                store.add_result(
+                    run_id,
+                    number,
+                    cluster,
+                    "trace",
+                    error="never traced" if number == 2 else None)
+    store.commit()
+
+
+def test_failures(store):
+    _record_run(store, "run-1")
+    _record_run(store, "run-2")
+
+    failures = store.failures("run-1")
+    assert [(failure.number, failure.cluster, failure.error)
+            for failure in failures] == [(1, "two", "refused"),
+                                         (2, "one", "never traced"),
+                                         (2, "two", "never traced")]
+    assert failures[0].templated == "spec 1"
+    assert failures[0].seed == 1
+
+    assert len(store.failures()) == 6
+    assert len(store.failures(cluster="two")) == 4
+    assert len(store.failures("run-2", error="traced")) == 2
+    assert store.failures("run-3") == []
+
+
+def _record_replay(store, run_id, replay_of, failed):
+    store.start_run(run_id, ["one"], replay_of=replay_of)
+    store.add_spec(run_id, 0, "spec.yaml", 1, "spec 1", origin=(replay_of, 1))
+    store.add_result(run_id,
+                     0,
+                     "one",
+                     "send",
+                     error="refused again" if failed else None)
+    store.commit()
+
+
+def test_failures_replayed(store):
+    store.start_run("run-1", ["one"])
+    store.add_spec("run-1", 1, "spec.yaml", 1, "spec 1")
+    store.add_result("run-1", 1, "one", "send", error="refused")
+    store.commit()
+
+    _record_replay(store, "run-2", "run-1", failed=True)
+    # only the latest attempt is replayed
+    failures = store.failures()
+    assert [(failure.run_id, failure.error)
+            for failure in failures] == [("run-2", "refused again")]
+    assert (failures[0].origin_run_id, failures[0].origin_number) == \
+        ("run-1", 1)
+    assert len(store.failures("run-1")) == 1
+
+    _record_replay(store, "run-3", "run-1", failed=False)
+    assert store.failures() == []
+    assert store.failures("run-1") == []
+    assert store.failures("run-2") == []
+
+
+def test_failures_first_stage(store):
+    store.start_run("run-1", ["one"])
+    store.add_spec("run-1", 0, "spec.yaml", 0, "spec 0")
+    store.add_result("run-1", 0, "one", "send", error="refused")
+    store.add_result("run-1", 0, "one", "trace", error="never traced")
+    store.commit()
+
+    failure, = store.failures()
+    assert (failure.stage, failure.error) == ("send", "refused")
+
+
+def test_migrate(tmp_path):
+    store_path = str(tmp_path / "runs.sqlite3")
+    # a store from before specs recorded their origin
+    with sqlite3.connect(store_path) as db:
+        db.executescript(
+            "CREATE TABLE specs (run_id TEXT NOT NULL, number INTEGER NOT "
+            "NULL, spec_name TEXT NOT NULL, seed INTEGER, templated TEXT NOT "
+            "NULL, PRIMARY KEY (run_id, number)); "
+            "INSERT INTO specs VALUES ('run-1', 0, 'spec.yaml', 0, 'spec 0');")
+    db.close()
+
+    with RunStore(store_path) as store:
+        store.start_run("run-1", ["one"], now=datetime(2020, 1, 1))
+        assert store.run("run-1").frozen_time == datetime(2020, 1, 1)
+        store.add_result("run-1", 0, "one", "send", error="refused")
+        failure, = store.failures()
+        assert (failure.origin_run_id, failure.origin_number) == ("run-1", 0)
+
+
+def test_runs(tmp_path):
+    with RunStore(str(tmp_path / "runs.sqlite3")) as store:
+        _record_run(store, "run-1")
+
+    # the store persists between runs
+    with RunStore(str(tmp_path / "runs.sqlite3")) as reopened:
+        (run_id, _, clusters, failures), = reopened.runs()
+        assert run_id == "run-1"
+        assert clusters == ["one", "two"]
+        assert failures == 3
@@ -0,0 +1,58 @@
+from collections import Counter
+import random
+
+import pytest
+
+from victoria_smoke import sampling
+
+
+@pytest.mark.parametrize("count", [0, 1, 5, 100])
+def test_reservoir_sample(count):
+    rng = random.Random(1337)
+    result = sampling.reservoir_sample(iter(range(100)), count, rng)
+    assert len(result) == count
+    assert len(set(result)) == count
+
+
+def test_reservoir_sample_too_few():
+    with pytest.raises(ValueError):
+        sampling.reservoir_sample(iter(range(3)), 4, random.Random())
+
+
+def test_reservoir_sample_uniform():
+    rng = random.Random(1337)
+    counts = Counter()
+    for _ in range(2000):
+        counts.update(sampling.reservoir_sample(iter(range(10)), 2, rng))
+    assert all(300 < counts[i] < 500 for i in range(10))
+
+
+def test_reservoir_sample_deterministic():
+    first = sampling.reservoir_sample(range(1000), 10, random.Random(1))
+    second = sampling.reservoir_sample(range(1000), 10, random.Random(1))
+    assert first == second
+
+
+def test_weighted_sample():
+    rng = random.Random(1337)
+    counts = Counter()
+    for _ in range(2000):
+        counts.update(
+            sampling.weighted_sample(["a", "b", "c"], {
+                "a": 1,
+                "b": 3,
+                "c": 0
+            }.get, 1, rng))
+    assert counts["c"] == 0
+    assert 2.5 < counts["b"] / counts["a"] < 3.5
+
+
+def test_weighted_sample_none():
+    assert sampling.weighted_sample([1, 2], lambda item: item, 0,
+                                    random.Random()) == []
+
+
+def test_weighted_sample_too_few():
+    with pytest.raises(ValueError):
+        sampling.weighted_sample([1, 2], lambda item: item - 1, 2,
+                                 random.Random())
@@ -0,0 +1,319 @@
+import asyncio
+import email
+from email import policy
+import json
+import sys
+import time
+
+from click.testing import CliRunner
+import pytest
+
+from victoria_smoke import cli
+from victoria_smoke import run as rn
+from victoria_smoke import send
+from victoria_smoke import tracing
+from victoria_smoke.config import (ClusterConfig, LogAnalyticsConfig,
+                                   SmokeConfig)
+from victoria_smoke.run_store import RunStore
+
+SPEC = """headers:
+  To:
+  - "Test <test@example.com>"
+  From:
+  - "Smoke <smoke@example.com>"
+  Date: "Wed, 01 Jan 2020 00:00:00 +0000"
+body: "{{ fake.paragraph(2) }}"
+attach:
+{{ library | filetype("pdf") | to_array }}
+"""
+
+
+@pytest.fixture
+def spec_file(tmp_path):
+    spec_path = tmp_path / "spec.yaml"
+    spec_path.write_text(SPEC)
+    return str(spec_path)
+
+
+@pytest.fixture
+def cfg(tmp_path, spec_file):
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+    (library_dir / "attachment.pdf").write_bytes(b"an attachment")
+    return SmokeConfig([str(library_dir)],
+                       index_cache_path=str(tmp_path / "index.pickle"),
+                       specs=[spec_file],
+                       run_store_path=str(tmp_path / "runs.sqlite3"))
+
+
+def _send_all(cfg, clusters, count):
+    async def run():
+        messages = send.render_outgoing(cfg, cfg.specs, count, run_seed=1)
+        return [
+            result
+            async for result in send.send_all(messages, clusters, "run")
+        ]
+
+    return asyncio.run(run())
+
+
+def test_send_all(cfg, smtp_servers):
+    (handler_1, port_1), (handler_2, port_2) = smtp_servers(), smtp_servers()
+    clusters = {
+        "one": ClusterConfig("127.0.0.1", port_1, connections=2),
+        "two": ClusterConfig("127.0.0.1", port_2, connections=3),
+    }
+    results = _send_all(cfg, clusters, count=10)
+
+    assert len(results) == 20
+    assert all(result.error is None for result in results)
+    for name, handler in (("one", handler_1), ("two", handler_2)):
+        assert len(handler.envelopes) == 10
+        # messages are sent over a few persistent connections
+        assert len(handler.sessions) <= clusters[name].connections
+        senders = {envelope.mail_from for envelope in handler.envelopes}
+        assert senders == {
+            send.unique_sender("run", name, i, "example.com")
+            for i in range(10)
+        }
+
+    parsed = email.message_from_bytes(handler_1.envelopes[0].content,
+                                      policy=policy.default)
+    assert parsed["From"].addresses[0].display_name == "Smoke"
+    assert parsed["Message-ID"]
+    # the spec's Date is replaced with the time the message was sent
+    assert len(parsed.get_all("Date")) == 1
+    sent_at = parsed["Date"].datetime.timestamp()
+    assert abs(sent_at - time.time()) < 60
+    attachment = next(parsed.iter_attachments())
+    assert attachment.get_content() == b"an attachment"
+
+
+def test_send_all_reconnects(cfg, smtp_servers):
+    handler, port = smtp_servers()
+    clusters = {
+        "one": ClusterConfig("127.0.0.1",
+                             port,
+                             connections=1,
+                             messages_per_connection=2)
+    }
+    results = _send_all(cfg, clusters, count=5)
+    assert all(result.error is None for result in results)
+    assert len(handler.sessions) == 3
+
+
+def test_send_all_failure(cfg, smtp_servers):
+    handler, port = smtp_servers()
+    clusters = {
+        "up": ClusterConfig("127.0.0.1", port),
+        "down": ClusterConfig("127.0.0.1", 1, timeout=1),
+    }
+    results = _send_all(cfg, clusters, count=3)
+    assert len(results) == 6
+    assert {result.cluster for result in results if result.error} == {"down"}
+    assert len(handler.envelopes) == 3
+
+
+def test_test_command(cfg, smtp_servers):
+    handler, port = smtp_servers()
+    cfg.clusters = {"local": ClusterConfig("127.0.0.1", port)}
+    runner = CliRunner()
+    result = runner.invoke(cli.smoke, ["test", "local", "-n", "2"], obj=cfg)
+    assert result.exit_code == 0, result.output
+    assert len(handler.envelopes) == 2
+
+    result = runner.invoke(cli.smoke, ["test", "missing"], obj=cfg)
+    assert result.exit_code != 0
+
+
+def test_test_command_profile(cfg, smtp_servers, tmp_path):
+    _, port = smtp_servers()
+    cfg.clusters = {"local": ClusterConfig("127.0.0.1", port)}
+    metrics_path = tmp_path / "metrics.json"
+    args = [
+        "test", "local", "-n", "2", "--profile", "--metrics-file",
+        str(metrics_path)
+    ]
+    result = CliRunner().invoke(cli.smoke, args, obj=cfg)
+    assert result.exit_code == 0, result.output
+
+    metrics = json.loads(metrics_path.read_text())
+    for stage in [
+            "scan", "template.render", "spec.yaml", "spec.load",
+            "spec.load.headers", "mime.serialize", "send", "send.connect"
+    ]:
+        assert metrics["stages"][stage]["calls"] > 0, stage
+    assert metrics["stages"]["send"]["calls"] == 2
+    assert metrics["counters"]["send.messages"] == 2
+
+
+def test_test_command_seed(cfg, smtp_servers, spec_file):
+    handler, port = smtp_servers()
+    cfg.clusters = {"local": ClusterConfig("127.0.0.1", port)}
+    with open(spec_file, "w") as spec:
+        spec.write(
+            SPEC.replace('"Wed, 01 Jan 2020 00:00:00 +0000"',
+                         "\"{{ datetime.now().strftime('%a, %d %b %Y "
+                         "%H:%M:%S +0000') }}\""))
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(cli.smoke, ["test", "local", "--seed", "5"],
+                               obj=cfg)
+        assert result.exit_code == 0, result.output
+
+    # the time is frozen and recorded, so the run can be reproduced
+    with RunStore(cfg.run_store_path) as store:
+        first, second = (store.run(run[0]) for run in store.runs())
+    assert first.run_seed == 5
+    assert first.frozen_time is not None
+    timestamp = second.frozen_time.isoformat()
+    for _ in range(2):
+        result = runner.invoke(
+            cli.smoke,
+            ["test", "local", "--seed", "5", "--timestamp", timestamp],
+            obj=cfg)
+        assert result.exit_code == 0, result.output
+
+    messages = [
+        email.message_from_bytes(envelope.content, policy=policy.default)
+        for envelope in handler.envelopes[2:]
+    ]
+    assert messages[0]["Date"] == messages[1]["Date"]
+    assert messages[0]["Date"].datetime == second.frozen_time
+    assert messages[0].get_body().get_content() == \
+        messages[1].get_body().get_content()
+
+    result = runner.invoke(cli.smoke, ["test", "local", "--timestamp", "x"],
+                           obj=cfg)
+    assert result.exit_code != 0
+
+
+def test_send_all_adapts(cfg, smtp_servers):
+    _, fast_port = smtp_servers()
+    _, slow_port = smtp_servers(delay=0.05)
+    clusters = {
+        "fast": ClusterConfig("127.0.0.1", fast_port, connections=4),
+        "slow": ClusterConfig("127.0.0.1",
+                              slow_port,
+                              connections=4,
+                              target_latency=0.01),
+    }
+
+    async def run():
+        rendered = 0
+
+        def messages():
+            nonlocal rendered
+            for outgoing in send.render_outgoing(cfg, cfg.specs, 20):
+                rendered += 1
+                yield outgoing
+
+        limiters = {}
+        sent = 0
+        ahead = 0
+        async for result in send.send_all(messages(), clusters, "run",
+                                          limiters):
+            assert result.error is None
+            sent += 1
+            ahead = max(ahead, rendered - sent // len(clusters))
+        return limiters, ahead
+
+    limiters, ahead = asyncio.run(run())
+    assert limiters["fast"].limit == 4
+    assert limiters["slow"].limit < 4
+    # rendering is held back by the slow cluster's queue
+    assert ahead <= 2 * clusters["slow"].connections + 2
+
+
+def test_run_smoke_test(cfg, smtp_servers, log_analytics):
+    stand_in, endpoint = log_analytics
+    _, port = smtp_servers()
+    cfg.log_analytics = LogAnalyticsConfig("workspace",
+                                           endpoint=endpoint,
+                                           poll_interval=0.01,
+                                           deadline=0.5)
+    clusters = {"local": ClusterConfig("127.0.0.1", port)}
+    for i in range(3):
+        stand_in.add(send.unique_sender("run", "local", i, "example.com"),
+                     f"tx-{i}",
+                     status="Failed" if i == 2 else "Success")
+
+    messages = send.render_outgoing(cfg, cfg.specs, 4)
+    summary = asyncio.run(
+        rn.run_smoke_test(cfg, clusters, messages, "run", None,
+                           tracing.LogAnalyticsClient(cfg.log_analytics)))
+    assert summary.sent == 4
+    assert summary.send_failures == 0
+    assert summary.traced == 2
+    # one transaction failed and one was never found
+    assert summary.trace_failures == 2
+
+
+def test_run_smoke_test_default_client(cfg, smtp_servers, log_analytics):
+    stand_in, endpoint = log_analytics
+    _, port = smtp_servers()
+    cfg.log_analytics = LogAnalyticsConfig("workspace",
+                                           endpoint=endpoint,
+                                           auth="none",
+                                           poll_interval=0.01,
+                                           deadline=0.5)
+    clusters = {"local": ClusterConfig("127.0.0.1", port)}
+    for i in range(2):
+        stand_in.add(send.unique_sender("run", "local", i, "example.com"),
+                     f"tx-{i}")
+
+    messages = send.render_outgoing(cfg, cfg.specs, 2)
+    summary = asyncio.run(rn.run_smoke_test(cfg, clusters, messages, "run"))
+    assert summary.traced == 2
+
+
+def test_test_command_no_azure_identity(cfg, smtp_servers, monkeypatch):
+    handler, port = smtp_servers()
+    cfg.clusters = {"local": ClusterConfig("127.0.0.1", port)}
+    cfg.log_analytics = LogAnalyticsConfig("workspace")
+    # azure-identity isn't installed
+    monkeypatch.setitem(sys.modules, "azure.identity", None)
+
+    result = CliRunner().invoke(cli.smoke, ["test", "local"], obj=cfg)
+    assert result.exit_code != 0
+    assert "azure-identity" in result.output
+    # it fails before sending anything
+    assert handler.envelopes == []
+
+    messages = send.render_outgoing(cfg, cfg.specs, 1)
+    with pytest.raises(ImportError):
+        asyncio.run(rn.run_smoke_test(cfg, cfg.clusters, messages, "run"))
+    assert handler.envelopes == []
+
+
+def test_replay_command(cfg, smtp_servers):
+    handler, port = smtp_servers()
+    cfg.clusters = {
+        "up": ClusterConfig("127.0.0.1", port),
+        "down": ClusterConfig("127.0.0.1", 1, timeout=1),
+    }
+    runner = CliRunner()
+    result = runner.invoke(cli.smoke, ["test", "up", "down", "-n", "3"],
+                           obj=cfg)
+    assert result.exit_code != 0
+    assert len(handler.envelopes) == 3
+
+    with RunStore(cfg.run_store_path) as store:
+        (run_id, _, clusters, failures), = store.runs()
+        assert sorted(clusters) == ["down", "up"]
+        assert failures == 3
+        assert {failure.cluster for failure in store.failures()} == {"down"}
+
+    # the cluster has recovered, so the replay succeeds
+    cfg.clusters["down"] = ClusterConfig("127.0.0.1", port)
+    result = runner.invoke(cli.smoke, ["replay", "--run", run_id], obj=cfg)
+    assert result.exit_code == 0, result.output
+    assert len(handler.envelopes) == 6
+
+    with RunStore(cfg.run_store_path) as store:
+        runs = store.runs()
+        assert len(runs) == 2
+        assert store.failures(runs[0][0]) == []
+        # the replayed failures are fixed
+        assert store.failures(run_id) == []
+        assert store.failures() == []
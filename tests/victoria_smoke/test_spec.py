@@ -0,0 +1,84 @@
+from marshmallow import ValidationError
+import pytest
+import yaml
+
+from victoria_smoke import spec
+from victoria_smoke import template
+
+from test_attachments import library, mock_open, mock_os_funcs
+
+SPEC = """headers:
+  To:
+  - "Test <test@example.com>"
+  From:
+  - "Smoke <smoke@example.com>"
+  Date: "Wed, 01 Jan 2020 00:00:00 +0000"
+body: "hello"
+attach:
+"""
+
+
+def render(library, attach: str) -> template.RenderedTemplate:
+    return template.render_structured(
+        template.compile_template(SPEC + attach), library)
+
+
+@pytest.mark.parametrize("attach", [
+    '{{ library | filetype("txt") | to_array }}',
+    '- ./extra.pdf\n{{ library | filetype("txt") | to_array }}\n- last.pdf',
+    '{{ library | like("root") | to_array }}\n'
+    '{{ library | like("sub") | to_array }}',
+    '{{ library | filetype("png") | to_array }}\n- only.pdf',
+    '- literal.pdf',
+])
+def test_load(library, attach):
+    rendered = render(library, attach)
+    assert rendered.text == template.process(SPEC + attach, library)
+
+    loaded = spec.load(rendered)
+    parsed = spec.parse(rendered.text)
+    assert loaded.attach == parsed.attach
+    assert loaded.headers == parsed.headers
+    assert loaded.body == parsed.body
+
+
+def test_load_skips_yaml(library):
+    rendered = render(library, '{{ library | filetype("txt") | to_array }}')
+    assert rendered.source.endswith(f"- {template.ARRAY_TAG} 0")
+    assert len(rendered.arrays[0]) == 5
+    assert spec.load(rendered).attach == rendered.arrays[0]
+
+
+def test_load_array_outside_attachments(library):
+    body = "{{ library | filetype('pdf') | to_array }}"
+    rendered = template.render_structured(
+        template.compile_template(
+            SPEC.replace('"hello"', f'"{body}"') + "- literal.pdf"), library)
+    assert rendered.arrays
+    loaded = spec.load(rendered)
+    assert loaded.body == template.process(body, library)
+    assert loaded.attach == ["literal.pdf"]
+
+
+def test_render_structured_transformed_array(library):
+    # the array's placeholder isn't in the text, so it's rendered as text
+    rendered = render(library, '- "{{ library | to_array | length }}"')
+    assert rendered.arrays == []
+    assert spec.load(rendered).attach == [
+        str(len(template.process("{{ library | to_array }}", library)))
+    ]
+
+
+def test_load_no_attachments(library):
+    rendered = render(library, '{{ library | filetype("png") | to_array }}')
+    with pytest.raises(ValidationError):
+        spec.parse(rendered.text)
+    with pytest.raises(ValidationError):
+        spec.load(rendered)
+
+
+def test_spec_loader():
+    if yaml.__with_libyaml__:
+        assert issubclass(spec.SpecLoader, yaml.CSafeLoader)
+    with pytest.raises(yaml.constructor.ConstructorError):
+        yaml.load("!!python/name:os.system", Loader=spec.SpecLoader)
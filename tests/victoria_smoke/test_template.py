@@ -1,3 +1,4 @@
+from datetime import datetime
 import os
 
 import pytest
@@ -92,3 +93,63 @@ def test_randomly_pick(library):
     # we need to specify the seed here to make the test deterministic
     result = template.randomly_pick(library, 2, seed=1337)
     assert get_filenames(result) == ["pdf_file.pdf", "big_file.txt"]
+
+
+def test_chained_filters(library):
+    result = template.filesize(template.filetype(library, "txt"),
+                               maximum="1.5kb")
+    assert type(result) == template.AttachmentQuery
+    assert get_filenames(result) == [
+        "root_file_1.txt", "root_file_2.txt", f"subdir{os.sep}subfile_1.txt",
+        f"subdir{os.sep}subfile_2.txt"
+    ]
+
+
+def test_to_ascii_high_bytes():
+    result = template.to_ascii(bytes([0x80 + ord("h"), ord("i")]))
+    assert result == "hi"
+
+
+def test_compile_template_cached():
+    compiled = template.compile_template("{{ 1 + 1 }}")
+    assert template.compile_template("{{ 1 + 1 }}") is compiled
+    assert template.compile_template("{{ 1 + 2 }}") is not compiled
+    assert compiled.render() == "2"
+
+
+def test_bytecode_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(template.template_env, "bytecode_cache", None)
+    template.enable_bytecode_cache(str(tmp_path))
+    template.template_env.cache.clear()
+    template.compile_template("{{ 'bytecode' }}")
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_process_seeded(library):
+    EMAIL_TEMPLATE = """{{ fake.name() }} {{ fake.unicode(10) }}"""
+    first = template.process(EMAIL_TEMPLATE, library, seed=1337)
+    assert template.process(EMAIL_TEMPLATE, library, seed=1337) == first
+
+
+def test_process_with_faker(library):
+    class FakeFaker:
+        def name(self):
+            return "Sam"
+
+    result = template.process("{{ fake.name() }}", library, fake=FakeFaker())
+    assert result == "Sam"
+
+
+def test_process_seeded_everything(library):
+    EMAIL_TEMPLATE = ("{{ uuid.uuid4() }} {{ datetime.now().isoformat() }} "
+                      "{{ library | randomly_pick(3) | to_array }}")
+    now = datetime(2020, 1, 1)
+    first = template.process(EMAIL_TEMPLATE, library, seed=1337, now=now)
+    assert template.process(EMAIL_TEMPLATE, library, seed=1337,
+                            now=now) == first
+    assert "2020-01-01T00:00:00" in first
+    assert template.process(EMAIL_TEMPLATE, library, seed=1338,
+                            now=now) != first
+
+    # the render's generator is only used within the render
+    assert template._render_random.get() is None
@@ -0,0 +1,69 @@
+import asyncio
+
+from victoria_smoke import tracing
+from victoria_smoke.config import LogAnalyticsConfig
+
+
+def _config(endpoint, **kwargs):
+    return LogAnalyticsConfig("workspace",
+                              endpoint=endpoint,
+                              poll_interval=0.01,
+                              max_poll_interval=0.05,
+                              **kwargs)
+
+
+def _trace(from_addresses, cfg):
+    async def run():
+        client = tracing.LogAnalyticsClient(cfg)
+        return [
+            result async for result in tracing.trace(from_addresses, cfg,
+                                                     client)
+        ]
+
+    return asyncio.run(run())
+
+
+def test_build_query():
+    cfg = LogAnalyticsConfig("workspace")
+    query = tracing.build_query(cfg, ["a@example.com", 'b"@example.com'])
+    assert '"a@example.com", "b\\"@example.com"' in query
+
+
+def test_trace(log_analytics):
+    stand_in, endpoint = log_analytics
+    addresses = [f"smoke-{i}@example.com" for i in range(25)]
+    for i, address in enumerate(addresses):
+        # some transactions take a while to turn up
+        stand_in.add(address, f"tx-{i}", delay=0.1 if i % 2 else 0)
+    results = _trace(addresses, _config(endpoint, batch_size=10))
+
+    assert sorted(result.from_address for result in results) == \
+        sorted(addresses)
+    assert all(result.status == "Success" for result in results)
+    assert {result.transaction_id for result in results} == \
+        {f"tx-{i}" for i in range(25)}
+    # the first poll is batched
+    assert len(stand_in.queries) >= 3
+    assert all(query.count("@") <= 10 for query in stand_in.queries)
+
+
+def test_trace_deadline(log_analytics):
+    stand_in, endpoint = log_analytics
+    stand_in.add("found@example.com", "tx")
+    results = _trace(["found@example.com", "missing@example.com"],
+                     _config(endpoint, deadline=0.2))
+    assert results == [
+        tracing.TraceResult("found@example.com", "tx", "Success"),
+        tracing.TraceResult("missing@example.com", None, None),
+    ]
+
+
+def test_trace_retries(log_analytics):
+    stand_in, endpoint = log_analytics
+    stand_in.add("found@example.com", "tx", status="Failed")
+    stand_in.failures = 2
+    results = _trace(["found@example.com"], _config(endpoint))
+    assert results == [
+        tracing.TraceResult("found@example.com", "tx", "Failed")
+    ]
+    assert len(stand_in.queries) == 3
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from victoria_smoke import attachments
+from victoria_smoke.attachments import AttachmentLibrary, Attachment
+from victoria_smoke.index_cache import IndexCache
+from victoria_smoke.trigram import TrigramIndex
+
+paths = [
+    os.path.normpath(f"samples{os.sep}report.pdf"),
+    os.path.normpath(f"samples{os.sep}invoice.pdf"),
+    os.path.normpath(f"other{os.sep}report.docx"),
+]
+
+
+@pytest.mark.parametrize("term,expected", [("report", [0, 2]),
+                                           ("voice", [1]),
+                                           ("missing", []),
+                                           (".pdf", [0, 1])])
+def test_candidates(term, expected):
+    index = TrigramIndex(paths)
+    candidates = index.candidates(term)
+    assert [row for row in candidates if term in paths[row]] == expected
+
+
+def test_short_term():
+    index = TrigramIndex(paths)
+    assert index.candidates("re") is None
+    assert index.estimate("re") is None
+
+
+def test_library_like_with_index(monkeypatch):
+    # the test library is tiny, so make sure the index is always used
+    monkeypatch.setattr(attachments, "LIKE_SCAN_RATIO", 1)
+    library = AttachmentLibrary.from_attachments(
+        [Attachment(file_path, 1) for file_path in paths])
+    expected = library.get_like("report").index
+    expected_short = library.get_like("re").index
+    library.columns.trigrams = TrigramIndex(paths)
+    assert library.columns.rows_like("report") == [0, 2]
+    assert library.get_like("report").index == expected
+    assert library.query().get_like("report").index == expected
+    assert library.get_like("re").index == expected_short
+
+
+def test_index_cache_persists_trigrams(tmp_path):
+    cache_path = str(tmp_path / "index.pickle")
+    cache = IndexCache(cache_path)
+    index = cache.trigram_index(paths)
+    cache.save()
+
+    loaded = IndexCache(cache_path)
+    assert loaded.trigram_index(paths).postings == index.postings
+    assert loaded.trigram_index(paths[:2]).fingerprint != index.fingerprint
@@ -1,5 +1,7 @@
 from contextlib import nullcontext as does_not_raise
+import inspect
 import os
+import sys
 
 import pytest
 
@@ -29,6 +31,7 @@ def test_scantree(monkeypatch):
     class MockDirEntry:
         def __init__(self, path, file):
             self.path = path
+            self.name = path.rsplit("/", 1)[-1]
             self.file = file
 
         def is_dir(self, *args, **kwargs):
@@ -37,9 +40,9 @@ def test_scantree(monkeypatch):
     def mock_scandir(directory, *args, **kwargs):
         for entry in {
                 "dir_a": [
-                    MockDirEntry("dir_a/file_a.txt", True),
                     MockDirEntry("dir_a/file_b.txt", True),
-                    MockDirEntry("dir_a/dir_b", False)
+                    MockDirEntry("dir_a/dir_b", False),
+                    MockDirEntry("dir_a/file_a.txt", True)
                 ],
                 "dir_a/dir_b": [MockDirEntry("dir_a/dir_b/file_c.txt", True)]
         }[directory]:
@@ -51,3 +54,40 @@ def test_scantree(monkeypatch):
     assert files == [
         "dir_a/file_a.txt", "dir_a/file_b.txt", "dir_a/dir_b/file_c.txt"
     ]
+
+
+def test_scantree_deep(tmp_path):
+    depth = 300
+    directory = tmp_path
+    for i in range(depth):
+        directory = directory / f"d{i}"
+    directory.mkdir(parents=True)
+    (directory / "deep_file.txt").write_text("deep")
+
+    # nest deeper than the recursion limit allows from here, so recursing
+    # into each directory would fail
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack()) + depth // 2)
+    try:
+        files = [entry.path for entry in util.scantree(str(tmp_path))]
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    assert files == [str(directory / "deep_file.txt")]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_walk_parallel(workers):
+    tree = {
+        "dir_a": ["dir_a/dir_b", "dir_a/dir_c"],
+        "dir_a/dir_b": ["dir_a/dir_b/dir_d"],
+        "dir_a/dir_b/dir_d": [],
+        "dir_a/dir_c": []
+    }
+
+    def scan(directory):
+        return directory.upper(), tree[directory]
+
+    results = list(util.walk_parallel("dir_a", scan, workers))
+    assert results == [("dir_a", "DIR_A"), ("dir_a/dir_b", "DIR_A/DIR_B"),
+                       ("dir_a/dir_b/dir_d", "DIR_A/DIR_B/DIR_D"),
+                       ("dir_a/dir_c", "DIR_A/DIR_C")]
@@ -0,0 +1,218 @@
+"""attachment_cache.py
+
+A cache of base64-encoded attachments, so that rendering the same attachment
+into many messages only reads and encodes the file once.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+from collections import OrderedDict
+import hashlib
+import io
+import mmap
+import os
+from os import path
+import threading
+from typing import BinaryIO, Callable, Optional, Tuple, Union
+
+from .config import SmokeConfig
+from . import mime_writer
+from . import util
+
+Buffer = Union[bytes, mmap.mmap]
+"""Encoded attachment bytes, either in memory or mapped from the disk store."""
+
+CacheKey = Tuple[str, int, int, str]
+"""An attachment's path, size, st_mtime_ns and the line separator it was
+encoded with."""
+
+
+def _encoded_size(size: int, linesep: str) -> int:
+    """Get the size of a file of a given size once base64-encoded."""
+    lines = -(-size // 57)
+    return -(-size // 3) * 4 + lines * len(linesep)
+
+
+class EncodedAttachmentCache:
+    """EncodedAttachmentCache holds the base64-encoded body of attachments,
+    ready to be spliced into MIME messages.
+
+    Entries are keyed by the attachment's path, size and mtime, so a file
+    that changes is re-encoded. The most recently used entries are kept in
+    memory up to a total size. If a directory is given, entries evicted from
+    memory (or too large to be held in memory at all) are spilled to it, and
+    read back by memory-mapping them. Each attachment's entries are kept in
+    a subdirectory of their own, and storing a new version of an attachment
+    removes its older versions, so the directory holds at most one entry per
+    attachment and line separator, but it isn't otherwise limited in size.
+
+    Attributes:
+        max_size (int): The maximum total size in bytes of the entries held
+            in memory.
+        directory (str): The directory of the on-disk store, if any.
+        size (int): The total size in bytes of the entries held in memory.
+        hits (int): The number of lookups served from the cache.
+        misses (int): The number of lookups that had to encode the file.
+    """
+    def __init__(self, max_size: int, directory: str = None) -> None:
+        """Create an empty cache.
+
+        Args:
+            max_size (int): The maximum total size in bytes of the entries
+                held in memory.
+            directory (str): If given, the directory to spill entries to.
+        """
+        self.max_size = max_size
+        self.directory = directory
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cfg: SmokeConfig) -> "EncodedAttachmentCache":
+        """Create a cache from the plugin config."""
+        return cls(util.filesize_str_to_bytes(cfg.attachment_cache_size),
+                   cfg.attachment_cache_dir)
+
+    def _store_dir(self, key: CacheKey) -> str:
+        """Get the directory holding every version of an entry in the on-disk
+        store."""
+        file_path, _, _, linesep = key
+        name = repr((file_path, linesep)).encode("utf-8", "surrogateescape")
+        return path.join(self.directory,
+                         hashlib.blake2b(name, digest_size=16).hexdigest())
+
+    def _store_path(self, key: CacheKey) -> str:
+        _, size, mtime_ns, _ = key
+        return path.join(self._store_dir(key), f"{size}-{mtime_ns}.b64")
+
+    def _tmp_path(self, store_path: str) -> str:
+        # unique to this thread, so concurrent writers don't collide
+        return f"{store_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def _load_stored(self, key: CacheKey) -> Optional[Buffer]:
+        """Map an entry from the on-disk store, if it's there."""
+        if self.directory is None:
+            return None
+        try:
+            with open(self._store_path(key), "rb") as stored_file:
+                if os.fstat(stored_file.fileno()).st_size == 0:
+                    # empty files can't be mapped
+                    return b""
+                return mmap.mmap(stored_file.fileno(),
+                                 0,
+                                 access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def _write_stored(self, key: CacheKey,
+                      write: Callable[[BinaryIO], None]) -> None:
+        """Write an entry to the on-disk store, removing its older versions.
+        """
+        store_path = self._store_path(key)
+        os.makedirs(self._store_dir(key), exist_ok=True)
+        # write to a temporary file first so a concurrent reader never sees
+        # a partially written entry
+        tmp_path = self._tmp_path(store_path)
+        try:
+            with open(tmp_path, "wb") as stored_file:
+                write(stored_file)
+            os.replace(tmp_path, store_path)
+        finally:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._remove_stale(key)
+
+    def _remove_stale(self, key: CacheKey) -> None:
+        """Remove the other versions of an entry from the on-disk store."""
+        store_dir = self._store_dir(key)
+        current = path.basename(self._store_path(key))
+        for name in os.listdir(store_dir):
+            if name.endswith(".b64") and name != current:
+                try:
+                    os.remove(path.join(store_dir, name))
+                except FileNotFoundError:
+                    # removed by another writer
+                    pass
+
+    def _store(self, key: CacheKey, encoded: Buffer) -> None:
+        """Write an entry to the on-disk store."""
+        if path.exists(self._store_path(key)):
+            return
+        self._write_stored(key,
+                           lambda stored_file: stored_file.write(encoded))
+
+    def _store_from_file(self, key: CacheKey, file_path: str) -> None:
+        """Encode a file straight into the on-disk store, a chunk at a time."""
+        self._write_stored(
+            key, lambda stored_file: mime_writer.encode_file(
+                file_path, stored_file, key[3]))
+
+    def _remember(self, key: CacheKey, encoded: bytes) -> None:
+        """Add an entry to the in-memory LRU, evicting (and spilling) the
+        least recently used entries to make room."""
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = encoded
+            self.size += len(encoded)
+            evicted = []
+            while self.size > self.max_size:
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self.size -= len(evicted_entry)
+                evicted.append((evicted_key, evicted_entry))
+        if self.directory is not None:
+            for evicted_key, evicted_entry in evicted:
+                self._store(evicted_key, evicted_entry)
+
+    def get(self, file_path: str, linesep: str = "\n") -> Optional[Buffer]:
+        """Get the base64-encoded contents of a file, encoding it if it isn't
+        cached.
+
+        Args:
+            file_path (str): The path to the file.
+            linesep (str): The line separator between lines of base64.
+
+        Returns:
+            Optional[Buffer]: The encoded contents, or None if the file is too
+                large to cache and there's no on-disk store, in which case it
+                should be encoded as it's written. Entries read from the
+                on-disk store are mapped just for the caller, who should
+                close them once written.
+        """
+        stat = os.stat(file_path)
+        key = (file_path, stat.st_size, stat.st_mtime_ns, linesep)
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+
+        stored = self._load_stored(key)
+        if stored is not None:
+            self.hits += 1
+            return stored
+
+        self.misses += 1
+        if _encoded_size(stat.st_size, linesep) > self.max_size:
+            if self.directory is None:
+                return None
+            self._store_from_file(key, file_path)
+            return self._load_stored(key)
+
+        encoded_stream = io.BytesIO()
+        mime_writer.encode_file(file_path, encoded_stream, linesep)
+        encoded = encoded_stream.getvalue()
+        self._remember(key, encoded)
+        return encoded
+
+    def clear(self) -> None:
+        """Remove every entry held in memory."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -6,38 +6,435 @@ Author:
     Sam Gibson <sgibson@glasswallsolutions.com>
 """
 from __future__ import annotations
-from collections import namedtuple
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from itertools import compress
 import logging
 import os
 from os import path
 import random
-from typing import List, Callable, Union
-
+from typing import (Dict, Iterable, Iterator, List, Callable, Optional,
+                    Sequence, Tuple, Union)
+from collections.abc import Sequence as SequenceABC
+
+from .config import SmokeConfig
+from .index_cache import IndexCache, scan_directory
+from . import profiling
+from .sampling import reservoir_sample, weighted_sample
+from .trigram import TrigramIndex
 from . import util
 
 Attachment = namedtuple("Attachment", ["path", "size"])
 
+Weights = Union[str, Dict[str, float], Callable[[Attachment], float]]
+"""How to weight attachments when picking them at random: 'size' to weight by
+file size, a dict of file type to weight, or a function of an attachment."""
+
+SHUFFLE_REJECTIONS = 8
+"""When randomly picking from a query, how many candidates per pick can fail
+to match before switching from a lazy shuffle to reservoir sampling."""
+
+LIKE_SCAN_RATIO = 8
+"""The trigram index is only used for a search term if it narrows the search
+down to less than 1/LIKE_SCAN_RATIO of the attachments."""
+
+
+class DirectoryNode:
+    """A directory in the directory trie of an AttachmentColumns.
+
+    Attributes:
+        name (str): The name of this path component.
+        parent (DirectoryNode): The parent directory, None for the root.
+        children (Dict[str, DirectoryNode]): The subdirectories, by name.
+        code (int): The code of this directory in the columns.
+    """
+    __slots__ = ("name", "parent", "children", "code")
+
+    def __init__(self, name: str, parent: Optional[DirectoryNode],
+                 code: int) -> None:
+        self.name = name
+        self.parent = parent
+        self.children: Dict[str, DirectoryNode] = {}
+        self.code = code
+
+    def walk(self) -> Iterator[DirectoryNode]:
+        """Yield this directory and every directory below it."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+
+class PathSequence(SequenceABC):
+    """A read-only sequence of the full paths of the attachments in an
+    AttachmentColumns. Paths are built when they're accessed, rather than
+    being stored for every attachment."""
+    def __init__(self, columns: AttachmentColumns) -> None:
+        self._columns = columns
+
+    def __len__(self) -> int:
+        return len(self._columns.names)
+
+    def __getitem__(self, row: int) -> str:
+        columns = self._columns
+        return columns.dir_prefixes[columns.dirs[row]] + columns.names[row]
+
+
+class AttachmentColumns:
+    """AttachmentColumns stores the attachments of a library column-wise.
+
+    Sizes are kept in a flat integer array, and file types and directories are
+    interned into tables and stored as integer codes, so filters can compare
+    integers instead of re-parsing each path. The columns are shared between
+    a library and every library filtered from it.
+
+    Only the filename of each attachment is stored. Directories are stored
+    once each in a trie, so the long prefixes shared by most paths aren't
+    repeated, and full paths are built on demand through 'paths'.
+
+    Secondary indexes for filename, file type, directory and size lookups are
+    built the first time they are needed, and rebuilt if attachments are added
+    afterwards. Each index maps a key to the ascending rows that have it.
+
+    Attributes:
+        names (List[str]): The filename of each attachment.
+        paths (PathSequence): The normalised path of each attachment.
+        sizes (array): The size in bytes of each attachment.
+        exts (array): The code of each attachment's file type.
+        dirs (array): The code of each attachment's directory.
+        ext_table (List[str]): File types, indexed by code.
+        dir_table (List[DirectoryNode]): Directories, indexed by code.
+        dir_paths (List[str]): The path of each directory, indexed by code.
+        dir_prefixes (List[str]): The path of each directory with a trailing
+            separator, so it can be prepended to a filename.
+        trigrams (TrigramIndex): An optional trigram index over the paths,
+            used for substring searches. Cleared if attachments are added.
+    """
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self.paths = PathSequence(self)
+        self.sizes = array("q")
+        self.exts = array("l")
+        self.dirs = array("l")
+        self.ext_table: List[str] = []
+        self.dir_table: List[DirectoryNode] = []
+        self.dir_paths: List[str] = []
+        self.dir_prefixes: List[str] = []
+        self._ext_codes: Dict[str, int] = {}
+        self._dir_codes: Dict[str, int] = {}
+        self._dir_root = DirectoryNode("", None, -1)
+        self._indexed = False
+        self.trigrams: Optional[TrigramIndex] = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def append(self, file_path: str, size: int) -> None:
+        """Add an attachment to the columns.
+
+        Args:
+            file_path (str): The normalised path to the attachment.
+            size (int): The size of the attachment in bytes.
+        """
+        self._indexed = False
+        self.trigrams = None
+        dirname, name = path.split(file_path)
+        self.names.append(name)
+        self.sizes.append(size)
+        self.exts.append(
+            self._intern(path.splitext(name)[1][1:], self.ext_table,
+                         self._ext_codes))
+        self.dirs.append(self._intern_dir(dirname))
+
+    def ext_code(self, filetype: str) -> int:
+        """Get the code of a file type, or -1 if no attachment has it."""
+        return self._ext_codes.get(filetype, -1)
+
+    def weight_func(self, weights: Weights) -> Callable[[int], float]:
+        """Get a function that gives the weight of a row.
+
+        Args:
+            weights (Weights): How to weight the rows.
+
+        Raises:
+            ValueError: If the weights are not valid.
+
+        Returns:
+            Callable[[int], float]: Function of a row to its weight.
+        """
+        if weights == "size":
+            return self.sizes.__getitem__
+        elif isinstance(weights, dict):
+            exts = self.exts
+            ext_weights = [weights.get(ext, 0) for ext in self.ext_table]
+            return lambda row: ext_weights[exts[row]]
+        elif callable(weights):
+            paths, sizes = self.paths, self.sizes
+            return lambda row: weights(Attachment(paths[row], sizes[row]))
+        raise ValueError(f"Invalid weights '{weights}'")
+
+    def like_estimate(self, search_term: str) -> Optional[int]:
+        """Estimate the number of attachments containing a search term using
+        the trigram index.
+
+        Returns:
+            Optional[int]: The estimate, or None if there's no trigram index,
+                the term is too short, or the term is so common that scanning
+                every path would be quicker than using the index.
+        """
+        if self.trigrams is None:
+            return None
+        estimate = self.trigrams.estimate(search_term)
+        if estimate is None or estimate * LIKE_SCAN_RATIO > len(self.names):
+            return None
+        return estimate
+
+    def rows_like(self, search_term: str) -> Optional[Sequence[int]]:
+        """Get the rows of all attachments containing a search term, using
+        the trigram index.
+
+        Returns:
+            Optional[Sequence[int]]: The matching rows in ascending order, or
+                None if the index can't be used (see like_estimate).
+        """
+        if self.like_estimate(search_term) is None:
+            return None
+        candidates = self.trigrams.candidates(search_term)
+        return list(
+            filter(self.like_test(search_term, len(candidates)), candidates))
+
+    def like_test(self, search_term: str,
+                  num_rows: int = None) -> Callable[[int], bool]:
+        """Get a function that tests whether the path of a row contains a
+        search term.
+
+        Args:
+            search_term (str): The term to search for.
+            num_rows (int): Roughly how many rows will be tested. Defaults to
+                every row.
+        """
+        prefixes, dirs, names = self.dir_prefixes, self.dirs, self.names
+        if num_rows is None:
+            num_rows = len(names)
+        if path.sep in search_term or len(prefixes) > num_rows:
+            return lambda row: search_term in prefixes[dirs[row]] + names[row]
+
+        # a term without a separator can't span the separator between the
+        # directory and the filename, so check each directory once and only
+        # check the filename of each row
+        dir_hits = [search_term in prefix for prefix in prefixes]
+        return lambda row: dir_hits[dirs[row]] or search_term in names[row]
+
+    def rows_with_filename(self, filename: str) -> Sequence[int]:
+        """Get the rows of all attachments with a filename."""
+        self._build_indexes()
+        return self._by_name.get(filename, ())
+
+    def rows_with_filetype(self, filetype: str) -> Sequence[int]:
+        """Get the rows of all attachments with a file type."""
+        self._build_indexes()
+        code = self.ext_code(filetype)
+        return self._by_ext[code] if code >= 0 else ()
+
+    def dirs_with_component(self, directory: str) -> Sequence[int]:
+        """Get the codes of all directories with a directory component.
+
+        These are the subtrees of the trie below every directory with the
+        component as its name.
+        """
+        self._build_indexes()
+        codes = {
+            node.code
+            for top in self._dirs_by_name.get(directory, ())
+            for node in top.walk()
+        }
+        return sorted(codes)
+
+    def count_in_directory(self, directory: str) -> int:
+        """Count the attachments with a directory component, from the sizes
+        of the directory buckets rather than by collecting their rows."""
+        return sum(
+            len(self._by_dir[code])
+            for code in self.dirs_with_component(directory))
+
+    def rows_in_directory(self, directory: str) -> Sequence[int]:
+        """Get the rows of all attachments with a directory component."""
+        codes = self.dirs_with_component(directory)
+        if len(codes) == 1:
+            return self._by_dir[codes[0]]
+        return sorted(row for code in codes for row in self._by_dir[code])
+
+    def rows_with_size(self, low: float, high: float,
+                       include_low: bool = True) -> Sequence[int]:
+        """Get the rows of all attachments with a size within bounds.
+
+        Args:
+            low (float): The lower bound of the size.
+            high (float): The upper bound of the size (inclusive).
+            include_low (bool): Whether the lower bound is inclusive.
+
+        Returns:
+            Sequence[int]: The matching rows, in ascending order.
+        """
+        start, end = self.size_range(low, high, include_low)
+        return sorted(self._by_size[start:end])
+
+    def size_range(self, low: float, high: float,
+                   include_low: bool = True) -> Tuple[int, int]:
+        """Find the range of the size index within size bounds. The length of
+        the range is the number of attachments within the bounds.
+
+        Args:
+            low (float): The lower bound of the size.
+            high (float): The upper bound of the size (inclusive).
+            include_low (bool): Whether the lower bound is inclusive.
+
+        Returns:
+            Tuple[int, int]: The start and end of the range.
+        """
+        self._build_indexes()
+        bisect_low = bisect_left if include_low else bisect_right
+        start = bisect_low(self._sorted_sizes, low)
+        end = bisect_right(self._sorted_sizes, high)
+        return start, max(start, end)
+
+    def _build_indexes(self) -> None:
+        """Build the secondary indexes, if they're out of date."""
+        if self._indexed:
+            return
+
+        by_name = defaultdict(lambda: array("l"))
+        by_ext = [array("l") for _ in self.ext_table]
+        by_dir = [array("l") for _ in self.dir_table]
+        for row, name in enumerate(self.names):
+            by_name[name].append(row)
+            by_ext[self.exts[row]].append(row)
+            by_dir[self.dirs[row]].append(row)
+
+        dirs_by_name = defaultdict(list)
+        for node in self.dir_table:
+            dirs_by_name[node.name].append(node)
+
+        self._by_name = dict(by_name)
+        self._by_ext = by_ext
+        self._by_dir = by_dir
+        self._dirs_by_name = dict(dirs_by_name)
+        self._by_size = array("l",
+                              sorted(range(len(self.sizes)),
+                                     key=self.sizes.__getitem__))
+        self._sorted_sizes = array("q",
+                                   (self.sizes[row] for row in self._by_size))
+        self._indexed = True
+
+    def _intern_dir(self, dirname: str) -> int:
+        """Get the code of a directory, adding it and any of its parents that
+        are missing to the trie."""
+        code = self._dir_codes.get(dirname)
+        if code is not None:
+            return code
+
+        node = self._dir_root
+        components = dirname.split(path.sep)
+        for i, component in enumerate(components):
+            child = node.children.get(component)
+            if child is None:
+                child = DirectoryNode(component, node, len(self.dir_table))
+                node.children[component] = child
+                self.dir_table.append(child)
+                dir_path = path.sep.join(components[:i + 1])
+                self.dir_paths.append(dir_path)
+                self.dir_prefixes.append(path.join(dir_path, ""))
+            node = child
+        self._dir_codes[dirname] = node.code
+        return node.code
+
+    @staticmethod
+    def _intern(value: str, table: List[str], codes: Dict[str, int]) -> int:
+        code = codes.get(value)
+        if code is None:
+            code = len(table)
+            codes[value] = code
+            table.append(value)
+        return code
+
 
 class AttachmentLibrary:
     """AttachmentLibrary is used to load attachments and filter by various
     factors.
 
+    A library is a view over a set of shared AttachmentColumns: it holds the
+    row numbers of the attachments it contains, so filtering a library only
+    builds a new array of row numbers rather than copying the attachments.
+
     Attributes:
-        index (List[str]): The list of attachments in the library.
+        columns (AttachmentColumns): The columns this library is a view over.
+        rows (array): The rows of the columns in this library, in index order.
+        ordered (bool): Whether the rows are in ascending order.
     """
-    def __init__(self, libraries: List[str]) -> None:
+    def __init__(self,
+                 libraries: List[str],
+                 index_cache: IndexCache = None,
+                 workers: int = 1,
+                 trigram_index: bool = False) -> None:
         """Create an attachment library from a list of folders.
 
         Args:
             libraries (List[str]): The list of folders to use as libraries.
+            index_cache (IndexCache): A persistent cache to read the index
+                from. Only directories that changed since they were cached
+                will be rescanned. If not given, every library is walked.
+            workers (int): The number of threads to scan directories with.
+            trigram_index (bool): Whether to build a trigram index to speed up
+                substring searches. If an index cache is given, the trigram
+                index is persisted with it.
         """
-        self.index: List[str] = []
+        self.columns = AttachmentColumns()
         for library in libraries:
             if not path.exists(library):
                 logging.warning(
                     f"library path '{library}' did not exist, skipping")
                 continue
-            self._index(library)
+            if index_cache is not None:
+                self._index_cached(library, index_cache, workers)
+            elif workers > 1:
+                self._index_parallel(library, workers)
+            else:
+                self._index(library)
+        self.rows = array("l", range(len(self.columns)))
+        self.ordered = True
+        self._row_set = None
+
+        if trigram_index:
+            if index_cache is not None:
+                self.columns.trigrams = index_cache.trigram_index(
+                    self.columns.paths)
+            else:
+                self.columns.trigrams = TrigramIndex(self.columns.paths)
+
+        if index_cache is not None:
+            index_cache.save()
+
+    @classmethod
+    def from_config(cls, cfg: SmokeConfig) -> AttachmentLibrary:
+        """Load the attachment libraries in a config, using the index cache.
+
+        Args:
+            cfg (SmokeConfig): The plugin config.
+
+        Returns:
+            AttachmentLibrary: The loaded attachment library.
+        """
+        with profiling.timed("scan"):
+            index_cache = IndexCache(cfg.index_cache_path)
+            library = cls(cfg.attachment_libraries, index_cache,
+                          cfg.scan_workers, cfg.trigram_index)
+        profiling.count("scan.attachments", len(library))
+        profiling.count("scan.rescanned_directories", index_cache.rescanned)
+        logging.debug(f"Loaded {len(library)} attachments, rescanned "
+                      f"{index_cache.rescanned} directories")
+        return library
 
     @classmethod
     def from_attachments(cls,
@@ -47,13 +444,51 @@ class AttachmentLibrary:
         Args:
             files (List[Attachment]): A list of paths to files.
 
+        Returns:
+            AttachmentLibrary: The created attachment library.
+        """
+        columns = AttachmentColumns()
+        for attachment in attachments:
+            columns.append(attachment.path, attachment.size)
+        return cls.from_rows(columns, range(len(columns)))
+
+    @classmethod
+    def from_rows(cls,
+                  columns: AttachmentColumns,
+                  rows: Iterable[int],
+                  ordered: bool = True) -> AttachmentLibrary:
+        """Create a new attachment library as a view over existing columns.
+
+        Args:
+            columns (AttachmentColumns): The columns to view.
+            rows (Iterable[int]): The rows of the columns to include.
+            ordered (bool): Whether the rows are in ascending order.
+
         Returns:
             AttachmentLibrary: The created attachment library.
         """
         self = cls.__new__(cls)
-        self.index = attachments
+        self.columns = columns
+        self.rows = rows if isinstance(rows, array) else array("l", rows)
+        self.ordered = ordered
+        self._row_set = None
         return self
 
+    @property
+    def index(self) -> List[Attachment]:
+        """List[Attachment]: The attachments in the library."""
+        return list(self)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __iter__(self) -> Iterator[Attachment]:
+        columns = self.columns
+        prefixes, dirs, names, sizes = (columns.dir_prefixes, columns.dirs,
+                                        columns.names, columns.sizes)
+        for row in self.rows:
+            yield Attachment(prefixes[dirs[row]] + names[row], sizes[row])
+
     def _index(self, library: str) -> None:
         """Walk a single library directory and add it to the index.
 
@@ -64,7 +499,80 @@ class AttachmentLibrary:
             if entry.is_file():
                 file_path = os.path.normpath(entry.path)
                 file_size = entry.stat().st_size
-                self.index.append(Attachment(file_path, file_size))
+                self.columns.append(file_path, file_size)
+
+    def _index_parallel(self, library: str, workers: int) -> None:
+        """Walk a single library directory on a thread pool and add it to the
+        index.
+
+        Args:
+            library (str): The path to the library.
+            workers (int): The number of threads to scan directories with.
+        """
+        def scan(directory: str):
+            record = scan_directory(directory)
+            return record, [path.join(directory, name) for name in record.dirs]
+
+        for directory, record in util.walk_parallel(library, scan, workers):
+            for name, size in record.files:
+                file_path = os.path.normpath(path.join(directory, name))
+                self.columns.append(file_path, size)
+
+    def _index_cached(self, library: str, index_cache: IndexCache,
+                      workers: int) -> None:
+        """Add a single library directory to the index using the index cache.
+
+        Args:
+            library (str): The path to the library.
+            index_cache (IndexCache): The cache to read the library from.
+            workers (int): The number of threads to scan directories with.
+        """
+        for file_path, file_size in index_cache.walk(library, workers):
+            self.columns.append(os.path.normpath(file_path), file_size)
+
+    def query(self) -> AttachmentQuery:
+        """Start a lazy query over this library.
+
+        Returns:
+            AttachmentQuery: A query selecting every attachment in the library.
+        """
+        return AttachmentQuery(self)
+
+    def select(self, mask: Iterable[bool]) -> AttachmentLibrary:
+        """Filter the library using a mask over its rows.
+
+        Args:
+            mask (Iterable[bool]): Whether to keep each row of the library,
+                in index order.
+
+        Returns:
+            AttachmentLibrary: A view of the rows where the mask was true.
+        """
+        return AttachmentLibrary.from_rows(self.columns,
+                                           compress(self.rows, mask),
+                                           self.ordered)
+
+    def intersect(self, rows: Sequence[int]) -> AttachmentLibrary:
+        """Filter the library to the rows that are also in a set of rows,
+        keeping the order of this library.
+
+        Args:
+            rows (Sequence[int]): The rows to keep, in ascending order.
+
+        Returns:
+            AttachmentLibrary: A view of the rows in both.
+        """
+        if self.ordered and len(self.rows) == len(self.columns):
+            # this library contains every row, so the result is just the rows
+            return AttachmentLibrary.from_rows(self.columns, rows)
+        if self.ordered and len(rows) <= len(self.rows):
+            if self._row_set is None:
+                self._row_set = set(self.rows)
+            row_set = self._row_set
+            return AttachmentLibrary.from_rows(
+                self.columns, (row for row in rows if row in row_set))
+        rows = set(rows)
+        return self.select(row in rows for row in self.rows)
 
     def filter_func(self, filter_func: Callable[[Attachment], bool]
                     ) -> AttachmentLibrary:
@@ -78,8 +586,7 @@ class AttachmentLibrary:
         Returns:
             AttachmentLibrary: The library, filtered by the given function.
         """
-        return AttachmentLibrary.from_attachments(
-            [item for item in self.index if filter_func(item)])
+        return self.select(filter_func(item) for item in self)
 
     def get_filename(self, filename: str) -> AttachmentLibrary:
         """Filter the library for all attachments with a given filename.
@@ -90,8 +597,7 @@ class AttachmentLibrary:
         Returns:
             AttachmentLibrary: The library, filtered by filename.
         """
-        return self.filter_func(
-            lambda item: path.basename(item.path) == filename)
+        return self.intersect(self.columns.rows_with_filename(filename))
 
     def get_like(self, search_term: str) -> AttachmentLibrary:
         """Filter the library for all attachments containing a search term.
@@ -102,7 +608,12 @@ class AttachmentLibrary:
         Returns:
             AttachmentLibrary: The library, filtered by search term.
         """
-        return self.filter_func(lambda item: search_term in item.path)
+        rows = self.columns.rows_like(search_term)
+        if rows is not None:
+            return self.intersect(rows)
+        return self.select(
+            map(self.columns.like_test(search_term, len(self.rows)),
+                self.rows))
 
     def get_filetype(self, filetype: str) -> AttachmentLibrary:
         """Filter the library for all attachments with a file type.
@@ -113,8 +624,7 @@ class AttachmentLibrary:
         Returns:
             AttachmentLibrary: The library, filtered by filetype.
         """
-        return self.filter_func(
-            lambda item: path.splitext(item.path)[1][1:] == filetype)
+        return self.intersect(self.columns.rows_with_filetype(filetype))
 
     def get_directory(self, directory: str) -> AttachmentLibrary:
         """Filter the library for all attachments in a certain directory.
@@ -125,12 +635,11 @@ class AttachmentLibrary:
         Returns:
             AttachmentLibrary: The library, filtered by directory.
         """
-        return self.filter_func(
-            lambda item: directory in path.dirname(item.path).split(path.sep))
+        return self.intersect(self.columns.rows_in_directory(directory))
 
     def get_filesize(self, max_bytes: int,
                      min_bytes: int = 0) -> AttachmentLibrary:
-        """Filter the library for all attachments within specified filesize 
+        """Filter the library for all attachments within specified filesize
         bounds.
 
         Args:
@@ -141,26 +650,281 @@ class AttachmentLibrary:
             AttachmentLibrary: The library, filtered by filesize.
         """
         if max_bytes == 0 and min_bytes == 0:
-            return self.filter_func(lambda item: True)
+            return AttachmentLibrary.from_rows(self.columns, self.rows,
+                                               self.ordered)
         elif max_bytes == 0:
-            return self.filter_func(lambda item: item.size > min_bytes)
+            rows = self.columns.rows_with_size(min_bytes,
+                                               float("inf"),
+                                               include_low=False)
         elif min_bytes == 0:
-            return self.filter_func(lambda item: item.size <= max_bytes)
+            rows = self.columns.rows_with_size(float("-inf"), max_bytes)
         else:
-            return self.filter_func(
-                lambda item: min_bytes <= item.size <= max_bytes)
-
-    def random_choice(self, count: int,
-                      seed: Union[int, None] = None) -> AttachmentLibrary:
+            rows = self.columns.rows_with_size(min_bytes, max_bytes)
+        return self.intersect(rows)
+
+    def random_choice(self,
+                      count: int,
+                      seed: Union[int, None] = None,
+                      weights: Weights = None,
+                      rng: random.Random = None) -> AttachmentLibrary:
         """Filter the library to a random choice of files.
 
+        A new random number generator is used for each call, so the global
+        random state (used by Faker and others) isn't touched.
+
+        Args:
+            count (int): The number of random files to pick.
+            seed (int): The random seed to use, for determinism.
+            weights (Weights): How to weight the files, if they shouldn't all
+                be equally likely to be picked.
+            rng (random.Random): The random number generator to use. If not
+                given, a new one is seeded with the seed.
+
+        Returns:
+            AttachmentLibrary: The library, randomly chosen from.
+        """
+        rng = rng or random.Random(seed)
+        if weights is None:
+            rows = rng.sample(self.rows, k=count)
+        else:
+            rows = weighted_sample(self.rows,
+                                   self.columns.weight_func(weights), count,
+                                   rng)
+        return AttachmentLibrary.from_rows(self.columns, rows, ordered=False)
+
+
+Predicate = namedtuple("Predicate", ["kind", "args"])
+"""A single filter of an AttachmentQuery, i.e. Predicate('filetype', ('pdf',))"""
+
+
+class AttachmentQuery:
+    """AttachmentQuery is a lazy chain of filters over an AttachmentLibrary.
+
+    It has the same filtering methods as AttachmentLibrary, but these only
+    record a predicate. The query is planned and run when it is consumed: the
+    most selective indexed predicate picks the candidate rows, and the
+    remaining predicates are checked against each candidate in a single pass.
+
+    Attributes:
+        library (AttachmentLibrary): The library being queried.
+        predicates (Tuple[Predicate]): The filters to apply.
+    """
+    def __init__(self, library: AttachmentLibrary,
+                 predicates: Tuple[Predicate, ...] = ()) -> None:
+        self.library = library
+        self.predicates = predicates
+
+    def where(self, kind: str, *args) -> AttachmentQuery:
+        """Add a predicate to the query.
+
+        Args:
+            kind (str): The kind of predicate, one of 'filename', 'like',
+                'filetype', 'directory' or 'filesize'.
+            args: The arguments of the predicate.
+
+        Returns:
+            AttachmentQuery: A new query with the predicate added.
+        """
+        return AttachmentQuery(self.library,
+                               self.predicates + (Predicate(kind, args), ))
+
+    def get_filename(self, filename: str) -> AttachmentQuery:
+        """Filter the query for all attachments with a given filename."""
+        return self.where("filename", filename)
+
+    def get_like(self, search_term: str) -> AttachmentQuery:
+        """Filter the query for all attachments containing a search term."""
+        return self.where("like", search_term)
+
+    def get_filetype(self, filetype: str) -> AttachmentQuery:
+        """Filter the query for all attachments with a file type."""
+        return self.where("filetype", filetype)
+
+    def get_directory(self, directory: str) -> AttachmentQuery:
+        """Filter the query for all attachments in a certain directory."""
+        return self.where("directory", directory)
+
+    def get_filesize(self, max_bytes: int,
+                     min_bytes: int = 0) -> AttachmentQuery:
+        """Filter the query for all attachments within filesize bounds.
+
+        This has the same semantics as AttachmentLibrary.get_filesize.
+        """
+        if max_bytes == 0 and min_bytes == 0:
+            return self
+        elif max_bytes == 0:
+            return self.where("filesize", min_bytes, float("inf"), False)
+        elif min_bytes == 0:
+            return self.where("filesize", float("-inf"), max_bytes, True)
+        return self.where("filesize", min_bytes, max_bytes, True)
+
+    def execute(self) -> AttachmentLibrary:
+        """Run the query.
+
+        Returns:
+            AttachmentLibrary: A view of the attachments matching the query.
+        """
+        candidates, residual = self._plan()
+        if not residual:
+            return candidates
+        test = self._row_test(residual)
+        return candidates.select(test(row) for row in candidates.rows)
+
+    def random_choice(self,
+                      count: int,
+                      seed: Union[int, None] = None,
+                      weights: Weights = None,
+                      rng: random.Random = None) -> AttachmentLibrary:
+        """Pick a random choice of attachments matching the query.
+
+        Rather than running the whole query and sampling from the result,
+        candidates are drawn in a random order and checked against the query
+        until enough have matched. If most candidates don't match, the rest
+        are streamed through the query into a reservoir sample instead.
+        Weighted picks stream every match through a weighted reservoir.
+
         Args:
             count (int): The number of random files to pick.
             seed (int): The random seed to use, for determinism.
-        
+            weights (Weights): How to weight the files, if they shouldn't all
+                be equally likely to be picked.
+            rng (random.Random): The random number generator to use. If not
+                given, a new one is seeded with the seed.
+
         Returns:
             AttachmentLibrary: The library, randomly chosen from.
         """
-        random.seed(seed)
-        return AttachmentLibrary.from_attachments(
-            [item for item in random.sample(self.index, k=count)])
+        candidates, residual = self._plan()
+        if not residual:
+            return candidates.random_choice(count, seed, weights, rng)
+
+        columns = self.library.columns
+        rng = rng or random.Random(seed)
+        test = self._row_test(residual)
+        rows = candidates.rows
+        if weights is not None:
+            picked = weighted_sample(filter(test, rows),
+                                     columns.weight_func(weights), count, rng)
+            return AttachmentLibrary.from_rows(columns, picked, ordered=False)
+
+        picked = array("l")
+        if count == 0:
+            return AttachmentLibrary.from_rows(columns, picked)
+
+        # a lazy Fisher-Yates shuffle, only swapping the positions we visit
+        swapped: Dict[int, int] = {}
+        num_rows = len(rows)
+        for i in range(num_rows):
+            if i - len(picked) > SHUFFLE_REJECTIONS * count:
+                # the first i positions are a uniform random draw, so a
+                # uniform sample of the rest completes a uniform sample
+                remaining = (rows[swapped.get(j, j)]
+                             for j in range(i, num_rows))
+                picked.extend(
+                    reservoir_sample(filter(test, remaining),
+                                     count - len(picked), rng))
+                break
+            j = rng.randrange(i, num_rows)
+            position = swapped.get(j, j)
+            swapped[j] = swapped.get(i, i)
+            if test(rows[position]):
+                picked.append(rows[position])
+                if len(picked) == count:
+                    break
+        else:
+            raise ValueError("Sample larger than population")
+        return AttachmentLibrary.from_rows(columns, picked, ordered=False)
+
+    @property
+    def index(self) -> List[Attachment]:
+        """List[Attachment]: The attachments matching the query."""
+        return self.execute().index
+
+    def __len__(self) -> int:
+        return len(self.execute())
+
+    def __iter__(self) -> Iterator[Attachment]:
+        return iter(self.execute())
+
+    def _plan(self) -> Tuple[AttachmentLibrary, List[Predicate]]:
+        """Plan the query.
+
+        Returns:
+            Tuple[AttachmentLibrary, List[Predicate]]: The candidates found
+                using the most selective indexed predicate, and the remaining
+                predicates to check them against, cheapest first.
+        """
+        estimates = [(self._estimate(predicate), i)
+                     for i, predicate in enumerate(self.predicates)]
+        indexed = [(estimate, i) for estimate, i in estimates
+                   if estimate is not None]
+        if not indexed:
+            candidates = self.library
+            residual = list(self.predicates)
+        else:
+            _, driver = min(indexed)
+            candidates = self.library.intersect(
+                self._lookup(self.predicates[driver]))
+            residual = [
+                predicate for i, predicate in enumerate(self.predicates)
+                if i != driver
+            ]
+        residual.sort(key=lambda predicate: predicate.kind == "like")
+        return candidates, residual
+
+    def _estimate(self, predicate: Predicate) -> Optional[int]:
+        """Estimate the number of rows matching a predicate from the indexes,
+        or None if the predicate isn't indexed.
+
+        Only the sizes of the index buckets are used, so that just the
+        driving predicate's rows are ever looked up.
+        """
+        columns = self.library.columns
+        if predicate.kind == "filesize":
+            start, end = columns.size_range(*predicate.args)
+            return end - start
+        elif predicate.kind == "like":
+            return columns.like_estimate(predicate.args[0])
+        elif predicate.kind == "directory":
+            return columns.count_in_directory(predicate.args[0])
+        # the filename and filetype lookups are index buckets, not copies
+        return len(self._lookup(predicate))
+
+    def _lookup(self, predicate: Predicate) -> Sequence[int]:
+        """Look up the rows matching an indexed predicate."""
+        columns = self.library.columns
+        return {
+            "filename": columns.rows_with_filename,
+            "filetype": columns.rows_with_filetype,
+            "directory": columns.rows_in_directory,
+            "filesize": columns.rows_with_size,
+            "like": columns.rows_like
+        }[predicate.kind](*predicate.args)
+
+    def _row_test(self, predicates: List[Predicate]) -> Callable[[int], bool]:
+        """Fuse predicates into a single function that tests a row."""
+        columns = self.library.columns
+        names, sizes, exts, dirs = (columns.names, columns.sizes,
+                                    columns.exts, columns.dirs)
+        tests = []
+        for predicate in predicates:
+            if predicate.kind == "filename":
+                filename, = predicate.args
+                tests.append(lambda row, f=filename: names[row] == f)
+            elif predicate.kind == "like":
+                tests.append(columns.like_test(predicate.args[0]))
+            elif predicate.kind == "filetype":
+                code = columns.ext_code(predicate.args[0])
+                tests.append(lambda row, c=code: exts[row] == c)
+            elif predicate.kind == "directory":
+                codes = set(columns.dirs_with_component(predicate.args[0]))
+                tests.append(lambda row, c=codes: dirs[row] in c)
+            elif predicate.kind == "filesize":
+                low, high, include_low = predicate.args
+                if include_low:
+                    tests.append(
+                        lambda row, l=low, h=high: l <= sizes[row] <= h)
+                else:
+                    tests.append(
+                        lambda row, l=low, h=high: l < sizes[row] <= h)
+        return lambda row: all(test(row) for test in tests)
@@ -0,0 +1,215 @@
+"""batch.py
+
+Batch rendering of many messages from a set of specs, spread across a pool of
+worker processes.
+
+Given a run seed, every message is rendered from its own seed derived from the
+run seed and the message's number, so the output doesn't depend on how many
+workers (or machines, with sharding) the batch is spread across, and any single
+message can be reproduced from the run seed and its number.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import os
+from os import path
+import random
+import secrets
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .attachment_cache import EncodedAttachmentCache
+from .attachments import AttachmentLibrary
+from .config import SmokeConfig
+from . import faker_pool
+from . import spec as spc
+from . import template as tmpl
+
+BatchResult = namedtuple("BatchResult",
+                         ["messages", "bytes_written", "seconds"])
+"""The result of a batch render."""
+
+Task = Tuple[str, int, str, Optional[int]]
+"""A render task: the spec name, the number of the message, the file to write
+it to and the seed to render it with."""
+
+_worker_state: Dict[str, object] = {}
+"""The attachment library, encoded attachment cache, compiled templates and
+frozen time of this worker process."""
+
+
+def derive_seed(run_seed: int, number: int) -> int:
+    """Derive the seed of a single message from the seed of the run.
+
+    The seed is a hash of both, so neighbouring messages get unrelated seeds
+    and the result is the same on every platform and Python version.
+
+    Args:
+        run_seed (int): The seed of the batch.
+        number (int): The number of the message within the batch.
+
+    Returns:
+        int: The seed of the message.
+    """
+    digest = hashlib.blake2b(f"{run_seed}:{number}".encode("ascii"),
+                             digest_size=8)
+    return int.from_bytes(digest.digest(), "big")
+
+
+def boundary(seed: int) -> str:
+    """Get the MIME boundary of a message rendered from a seed."""
+    return f"==============={seed:020d}=="
+
+
+def _init_worker(cfg: SmokeConfig,
+                 spec_sources: Dict[str, str],
+                 now: datetime = None) -> None:
+    """Initialise a worker process, loading the attachment library and
+    compiling the templates once for every message the worker renders.
+
+    If the worker was forked from a process that had already initialised,
+    the parent's state is inherited and nothing needs to be loaded. Its
+    random state is inherited too, so it's reseeded, otherwise every worker
+    would render the same unseeded messages.
+    """
+    random.seed()
+    faker_pool.get_faker().seed_instance(secrets.randbits(64))
+    if "library" not in _worker_state:
+        _worker_state["library"] = AttachmentLibrary.from_config(cfg)
+    _worker_state["attachment_cache"] = \
+        EncodedAttachmentCache.from_config(cfg)
+    _worker_state["templates"] = {
+        name: tmpl.compile_template(source)
+        for name, source in spec_sources.items()
+    }
+    _worker_state["now"] = now
+
+
+def render_spec(name: str, seed: int = None) -> spc.Spec:
+    """Render a single spec in this worker.
+
+    Args:
+        name (str): The name of the spec to render.
+        seed (int): If given, the seed to render the spec with.
+
+    Returns:
+        Spec: The rendered spec.
+    """
+    rendered = tmpl.render_structured(_worker_state["templates"][name],
+                                      _worker_state["library"],
+                                      seed=seed,
+                                      now=_worker_state.get("now"))
+    return spc.load(rendered)
+
+
+def _render_one(task: Task) -> int:
+    """Render a single message and write it to a file.
+
+    Args:
+        task (Task): The render task.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    name, _, output_file, seed = task
+    spec = render_spec(name, seed)
+    mime_boundary = None if seed is None else boundary(seed)
+    with open(output_file, "wb") as output_file_handle:
+        return spec.write_mime(output_file_handle,
+                               mime_boundary,
+                               cache=_worker_state["attachment_cache"])
+
+
+def _tasks(spec_names: List[str],
+           count: int,
+           output_dir: str,
+           run_seed: int = None,
+           shard: Tuple[int, int] = (0, 1)) -> Iterator[Task]:
+    """Generate the render tasks of a shard of a batch.
+
+    Messages are numbered across all the specs, and the shard with index k of
+    n gets every nth message starting from the kth. Output files are prefixed
+    with the position of their spec, so specs with the same filename (or the
+    same spec given twice) don't overwrite each other.
+    """
+    shard_index, num_shards = shard
+    for spec_index, name in enumerate(spec_names):
+        stem = path.splitext(path.basename(name))[0]
+        for i in range(count):
+            number = spec_index * count + i
+            if number % num_shards != shard_index:
+                continue
+            seed = None if run_seed is None else derive_seed(run_seed, number)
+            output_file = path.join(output_dir,
+                                    f"{spec_index:03d}-{stem}-{i:06d}.eml")
+            yield name, i, output_file, seed
+
+
+def render_batch(cfg: SmokeConfig,
+                 spec_files: List[str],
+                 count: int,
+                 output_dir: str,
+                 workers: int = None,
+                 run_seed: int = None,
+                 shard: Tuple[int, int] = (0, 1),
+                 now: datetime = None) -> BatchResult:
+    """Render many messages from each of a list of spec files into a
+    directory, in parallel.
+
+    With a run seed and a frozen time, the output is byte-identical
+    regardless of the number of workers, and the shards of a batch rendered
+    on different machines add up to the whole batch.
+
+    Args:
+        cfg (SmokeConfig): The plugin config.
+        spec_files (List[str]): The spec files to render.
+        count (int): How many messages to render from each spec.
+        output_dir (str): The directory to write the messages to.
+        workers (int): The number of worker processes. Defaults to the number
+            of CPUs.
+        run_seed (int): If given, the seed to derive each message's seed
+            from.
+        shard (Tuple[int, int]): The index of the shard to render and the
+            number of shards. Defaults to the whole batch.
+        now (datetime): If given, freeze the time that templates see.
+
+    Raises:
+        ValueError: If the shard is invalid.
+
+    Returns:
+        BatchResult: How many messages and bytes were written, and how long
+            it took.
+    """
+    shard_index, num_shards = shard
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f"invalid shard {shard_index}/{num_shards}")
+
+    spec_sources = {}
+    for spec_file in spec_files:
+        with open(spec_file, "r") as spec_file_handle:
+            spec_sources[spec_file] = spec_file_handle.read()
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+
+    # load the library here first, so the index cache is up to date before
+    # the workers read it (and forked workers can inherit it)
+    _worker_state["library"] = AttachmentLibrary.from_config(cfg)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, min(64, count * len(spec_files) // (workers * 4)))
+
+    messages = 0
+    bytes_written = 0
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(cfg, spec_sources, now)) as executor:
+        tasks = _tasks(spec_files, count, output_dir, run_seed, shard)
+        for written in executor.map(_render_one, tasks, chunksize=chunksize):
+            messages += 1
+            bytes_written += written
+
+    return BatchResult(messages, bytes_written, time.perf_counter() - start)
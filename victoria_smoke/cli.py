@@ -2,38 +2,145 @@
 
 This is the module that contains the Click CLI for the plugin.
 
+Victoria imports every plugin for every command, so this module only imports
+what it needs to define the CLI. The modules that do the work (and their
+dependencies, like Faker, Jinja2 and sremail) are imported by the commands
+that use them.
+
 Author:
     Sam Gibson <sgibson@glasswallsolutions.com>
 """
+from __future__ import annotations
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import logging
+from typing import TYPE_CHECKING, Callable, Iterator, Optional, Tuple
 
 import click
 
-from .attachments import AttachmentLibrary
 from .config import SmokeConfig
-from . import spec as spc
-from . import template as tmpl
+from . import profiling
+
+if TYPE_CHECKING:
+    from .run import RunSummary
+    from .run_store import RunStore
+    from .tracing import LogAnalyticsClient
 
 
 @click.group()
 @click.pass_obj
 def smoke(cfg: SmokeConfig):
     """Perform smoke tests on clusters."""
+    if cfg.template_bytecode_cache:
+        from . import template as tmpl
+        tmpl.enable_bytecode_cache()
+
+
+def profile_options(command: Callable) -> Callable:
+    """Add the options to profile a command, see profiled()."""
+    command = click.option("--metrics-format",
+                           type=click.Choice(profiling.METRICS_FORMATS),
+                           default="json",
+                           show_default=True,
+                           help="The format of the metrics file.")(command)
+    command = click.option(
+        "--metrics-file",
+        help="Write the time spent in each stage to this file as metrics.",
+        metavar="FILE")(command)
+    command = click.option(
+        "--profile",
+        is_flag=True,
+        help="Log a breakdown of the time spent in each stage.")(command)
+    return command
+
+
+@contextmanager
+def profiled(profile: bool, metrics_file: str,
+             metrics_format: str) -> Iterator[None]:
+    """Profile the stages run in the context, if asked to.
+
+    Args:
+        profile (bool): Whether to log a breakdown of the stages.
+        metrics_file (str): If given, write the profile to this file as
+            metrics.
+        metrics_format (str): The format of the metrics file.
+    """
+    if not profile and metrics_file is None:
+        yield
+        return
+
+    profiling.enable()
+    try:
+        yield
+    finally:
+        profiling.disable()
+        result = profiling.snapshot()
+        if profile:
+            for line in profiling.report(result):
+                logging.info(line)
+        if metrics_file is not None:
+            profiling.write_metrics(metrics_file, metrics_format, result)
+            logging.info(f"Wrote {metrics_format} metrics to "
+                         f"'{metrics_file}'")
+
+
+@smoke.group()
+def index():
+    """Manage the attachment library index cache."""
     pass
 
 
+@index.command()
+@click.pass_obj
+def rebuild(cfg: SmokeConfig):
+    """Rebuild the index cache from scratch."""
+    from .attachments import AttachmentLibrary
+    from .index_cache import IndexCache
+    index_cache = IndexCache(cfg.index_cache_path)
+    index_cache.clear()
+    library = AttachmentLibrary(cfg.attachment_libraries, index_cache,
+                                cfg.scan_workers, cfg.trigram_index)
+    logging.info(f"Indexed {len(library)} attachments in "
+                 f"{index_cache.rescanned} directories to "
+                 f"'{index_cache.cache_path}'")
+
+
+@index.command()
+@click.pass_obj
+def info(cfg: SmokeConfig):
+    """Show information about the index cache."""
+    from .index_cache import IndexCache
+    index_cache = IndexCache(cfg.index_cache_path)
+    logging.info(f"Index cache: '{index_cache.cache_path}'")
+    for library in cfg.attachment_libraries:
+        if library not in index_cache.libraries:
+            logging.info(f"- '{library}': not indexed")
+            continue
+        num_dirs, num_files, total_size = index_cache.stats(library)
+        logging.info(f"- '{library}': {num_files} files in {num_dirs} "
+                     f"directories, {total_size} bytes")
+    if index_cache.trigrams is not None:
+        logging.info(f"Trigram index: {len(index_cache.trigrams.postings)} "
+                     "trigrams")
+
+
 @smoke.command()
 @click.argument("spec", nargs=1, required=True, type=str)
 @click.option("--output-file",
               "-o",
               help="The file to output the spec to.",
               metavar="FILE")
+@profile_options
 @click.pass_obj
-def template(cfg: SmokeConfig, spec: str, output_file: str):
+def template(cfg: SmokeConfig, spec: str, output_file: str, profile: bool,
+             metrics_file: str, metrics_format: str):
     """Template a spec file."""
-    attachments = AttachmentLibrary(cfg.attachment_libraries)
-    with open(spec, "r") as spec_file:
-        templated_spec = tmpl.process(spec_file.read(), attachments)
+    from .attachments import AttachmentLibrary
+    from . import template as tmpl
+    with profiled(profile, metrics_file, metrics_format):
+        attachments = AttachmentLibrary.from_config(cfg)
+        with open(spec, "r") as spec_file:
+            templated_spec = tmpl.process(spec_file.read(), attachments)
         if output_file is None:
             logging.info(templated_spec)
         else:
@@ -48,24 +155,228 @@ def template(cfg: SmokeConfig, spec: str, output_file: str):
               "-o",
               help="The file to render the spec to.",
               metavar="FILE")
+@profile_options
 @click.pass_obj
-def render(cfg: SmokeConfig, spec: str, output_file: str):
+def render(cfg: SmokeConfig, spec: str, output_file: str, profile: bool,
+           metrics_file: str, metrics_format: str):
     """Render a spec to MIME."""
-    attachments = AttachmentLibrary(cfg.attachment_libraries)
-    with open(spec, "r") as spec_file:
-        loaded_spec = spc.from_yaml(spec_file.read(), attachments)
-        mime_str = loaded_spec.as_mime().as_string()
+    from .attachments import AttachmentLibrary
+    from . import spec as spc
+    with profiled(profile, metrics_file, metrics_format):
+        attachments = AttachmentLibrary.from_config(cfg)
+        with open(spec, "r") as spec_file:
+            loaded_spec = spc.from_yaml(spec_file.read(), attachments)
         if output_file is None:
-            logging.info(mime_str)
+            mime = loaded_spec.as_mime()
+            with profiling.timed("mime.write"):
+                rendered = mime.as_string()
+            logging.info(rendered)
         else:
-            with open(output_file, "w") as output_file_handle:
-                output_file_handle.write(mime_str)
+            # stream to the file, so large attachments aren't held in memory
+            with open(output_file, "wb") as output_file_handle:
+                loaded_spec.write_mime(output_file_handle)
             logging.info(f"Rendered '{spec}' to file '{output_file}'")
 
 
+def _frozen_time(seed: int, timestamp: str) -> Optional[datetime]:
+    """Get the time to freeze templates at: the given timestamp, or now if
+    there's a seed, so that the render can be reproduced."""
+    try:
+        now = datetime.fromisoformat(timestamp) if timestamp else None
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint="--timestamp")
+    if seed is not None and now is None:
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        logging.info(f"Rendering with seed {seed} at time "
+                     f"'{now.isoformat()}', pass --timestamp to reproduce")
+    return now
+
+
+@smoke.command()
+@click.argument("specs", nargs=-1, required=True, type=str)
+@click.option("--count",
+              "-n",
+              default=1,
+              show_default=True,
+              help="The number of messages to render from each spec.")
+@click.option("--output-dir",
+              "-o",
+              required=True,
+              help="The directory to render the messages to.",
+              metavar="DIR")
+@click.option("--workers",
+              "-w",
+              type=int,
+              help="The number of worker processes. Defaults to CPU count.")
+@click.option("--seed",
+              type=int,
+              help="The run seed. If given, the messages are reproducible.")
+@click.option("--shard",
+              default="0/1",
+              show_default=True,
+              help="Only render shard K of N of the batch.",
+              metavar="K/N")
+@click.option("--timestamp",
+              help="The ISO 8601 time to freeze templates at. "
+              "Defaults to now when a seed is given.")
+@click.pass_obj
+def batch(cfg: SmokeConfig, specs: Tuple[str], count: int, output_dir: str,
+          workers: int, seed: int, shard: str, timestamp: str):
+    """Render many messages from specs into a directory."""
+    from . import batch as btch
+    try:
+        shard_index, num_shards = (int(part) for part in shard.split("/"))
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint="--shard")
+    now = _frozen_time(seed, timestamp)
+
+    result = btch.render_batch(cfg, list(specs), count, output_dir, workers,
+                               seed, (shard_index, num_shards), now)
+    logging.info(f"Rendered {result.messages} messages "
+                 f"({result.bytes_written} bytes) to '{output_dir}' in "
+                 f"{result.seconds:.2f}s: "
+                 f"{result.messages / result.seconds:.1f} messages/s, "
+                 f"{result.bytes_written / result.seconds / 1e6:.2f} MB/s")
+
+
 @smoke.command()
 @click.argument("cluster", nargs=-1, required=True)
+@click.option("--spec",
+              "-s",
+              "specs",
+              multiple=True,
+              help="A spec to send. Defaults to the specs in the config.",
+              metavar="FILE")
+@click.option("--count",
+              "-n",
+              default=1,
+              show_default=True,
+              help="The number of messages to send from each spec.")
+@click.option("--seed",
+              type=int,
+              help="The run seed. If given, the messages are reproducible.")
+@click.option("--timestamp",
+              help="The ISO 8601 time to freeze templates at. "
+              "Defaults to now when a seed is given.")
+@profile_options
 @click.pass_obj
-def test(cfg: SmokeConfig):
+def test(cfg: SmokeConfig, cluster: Tuple[str], specs: Tuple[str], count: int,
+         seed: int, timestamp: str, profile: bool, metrics_file: str,
+         metrics_format: str):
     """Perform a smoke test on a cluster."""
-    pass
\ No newline at end of file
+    import asyncio
+    from . import run as rn
+    from .run_store import RunStore
+    from . import send as snd
+    unknown = [name for name in cluster if name not in cfg.clusters]
+    if unknown:
+        raise click.BadParameter(f"unknown clusters {unknown}",
+                                 param_hint="CLUSTER")
+    specs = list(specs) or cfg.specs
+    if not specs:
+        raise click.UsageError("no specs given or configured")
+
+    now = _frozen_time(seed, timestamp)
+    client = _trace_client(cfg)
+
+    run_id = rn.new_run_id()
+    clusters = {name: cfg.clusters[name] for name in cluster}
+    messages = snd.render_outgoing(cfg, specs, count, seed, now)
+
+    limiters = {}
+    with profiled(profile, metrics_file, metrics_format), \
+            RunStore(cfg.run_store_path) as store:
+        store.start_run(run_id, list(clusters), seed, now=now)
+        summary = asyncio.run(
+            rn.run_smoke_test(cfg,
+                              clusters,
+                              messages,
+                              run_id,
+                              limiters,
+                              client,
+                              store=store))
+    for name, limiter in limiters.items():
+        logging.info(f"- {name}: concurrency {int(limiter.limit)}, "
+                     f"latency {limiter.latency:.2f}s, "
+                     f"error rate {limiter.error_rate:.1%}")
+    _report_run(cfg, run_id, summary, store)
+
+
+def _trace_client(cfg: SmokeConfig) -> Optional[LogAnalyticsClient]:
+    """Create the client to trace messages with, if log analytics is
+    configured, failing before anything is sent if it can't be created."""
+    if cfg.log_analytics is None:
+        return None
+    from . import tracing
+    try:
+        return tracing.create_client(cfg.log_analytics)
+    except ImportError as err:
+        raise click.ClickException(str(err))
+
+
+def _report_run(cfg: SmokeConfig, run_id: str, summary: RunSummary,
+                store: RunStore) -> None:
+    """Log the outcome of a run, failing the command if any messages
+    failed."""
+    logging.info(f"Run {run_id}: sent {summary.sent} messages in "
+                 f"{summary.seconds:.2f}s, {summary.send_failures} failed to "
+                 "send")
+    if cfg.log_analytics is not None:
+        logging.info(f"Traced {summary.traced} messages, "
+                     f"{summary.trace_failures} failed")
+    failed = summary.send_failures + summary.trace_failures
+    if failed:
+        logging.info(f"Saved failed specs to '{store.store_path}', replay "
+                     f"them with 'replay --run {run_id}'")
+        raise click.ClickException(f"{failed} messages failed")
+
+
+@smoke.command()
+@click.option("--run",
+              "run_id",
+              help="Only replay failures from this run.",
+              metavar="RUN")
+@click.option("--cluster",
+              help="Only replay failures in this cluster.",
+              metavar="CLUSTER")
+@click.option("--error",
+              help="Only replay failures whose error contains this.",
+              metavar="TEXT")
+@click.option("--list",
+              "list_only",
+              is_flag=True,
+              help="List the failures instead of replaying them.")
+@click.pass_obj
+def replay(cfg: SmokeConfig, run_id: str, cluster: str, error: str,
+           list_only: bool):
+    """Replay failed messages from earlier smoke tests."""
+    import asyncio
+    from . import run as rn
+    from .run_store import RunStore
+    with RunStore(cfg.run_store_path) as store:
+        failures = store.failures(run_id, cluster, error)
+        if list_only or not failures:
+            for failure in failures:
+                logging.info(f"{failure.run_id} {failure.cluster} "
+                             f"'{failure.spec_name}' message "
+                             f"{failure.number}: {failure.error}")
+            logging.info(f"{len(failures)} failures")
+            return
+
+        client = _trace_client(cfg)
+        replay_id = rn.new_run_id()
+        store.start_run(replay_id,
+                        sorted({failure.cluster
+                                for failure in failures}),
+                        replay_of=run_id)
+        logging.info(f"Replaying {len(failures)} failures as run {replay_id}")
+        try:
+            summary = asyncio.run(
+                rn.replay_failures(cfg,
+                                   failures,
+                                   replay_id,
+                                   client,
+                                   store=store))
+        except ValueError as err:
+            raise click.ClickException(str(err))
+    _report_run(cfg, replay_id, summary, store)
\ No newline at end of file
@@ -6,14 +6,190 @@ schema for validating the config.
 Author:
     Sam Gibson <sgibson@glasswallsolutions.com>
 """
-from typing import List
+from typing import Dict, List, Optional
 
-from marshmallow import Schema, fields, post_load
+from marshmallow import (Schema, ValidationError, fields, post_load,
+                         validate, validates_schema)
+
+
+class ClusterConfigSchema(Schema):
+    """Marshmallow schema for the config of a cluster to smoke test."""
+    smtp_host = fields.Str(required=True)
+    smtp_port = fields.Int(missing=25)
+    use_tls = fields.Bool(missing=False)
+    timeout = fields.Float(missing=60.0)
+    connections = fields.Int(missing=4, validate=validate.Range(min=1))
+    min_connections = fields.Int(missing=1, validate=validate.Range(min=1))
+    initial_connections = fields.Int(missing=1,
+                                     validate=validate.Range(min=1))
+    target_latency = fields.Float(missing=10.0,
+                                  validate=validate.Range(min=0))
+    messages_per_connection = fields.Int(missing=100,
+                                         validate=validate.Range(min=1))
+    tenant_id = fields.Str(missing=None)
+
+    @validates_schema
+    def validate_connections(self, data, **kwargs):
+        """Make sure the number of messages sent at once starts, and can stay,
+        within its bounds."""
+        if data["min_connections"] > data["connections"]:
+            raise ValidationError(
+                "must not be more than connections", "min_connections")
+        if not data["min_connections"] <= data["initial_connections"] \
+                <= data["connections"]:
+            raise ValidationError(
+                "must be between min_connections and connections",
+                "initial_connections")
+
+    @post_load
+    def make_cluster_config(self, data, **kwargs):
+        return ClusterConfig(**data)
+
+
+class ClusterConfig:
+    """ClusterConfig is the config of a cluster to smoke test.
+
+    Attributes:
+        smtp_host (str): The hostname of the cluster's SMTP endpoint.
+        smtp_port (int): The port of the cluster's SMTP endpoint.
+        use_tls (bool): Whether to connect to the SMTP endpoint over TLS.
+        timeout (float): The timeout of SMTP commands, in seconds.
+        connections (int): The maximum number of SMTP connections to keep open
+            to the cluster, and so the most messages sent at once.
+        min_connections (int): The fewest messages sent at once, however
+            degraded the cluster is.
+        initial_connections (int): How many messages to send at once to begin
+            with, before adapting to how the cluster responds.
+        target_latency (float): How long in seconds sending a message should
+            take. Slower sends reduce the number of messages sent at once.
+        messages_per_connection (int): How many messages to send over a single
+            connection before reconnecting.
+        tenant_id (str): The ID of the cluster's tenant.
+    """
+    def __init__(self,
+                 smtp_host: str,
+                 smtp_port: int = 25,
+                 use_tls: bool = False,
+                 timeout: float = 60.0,
+                 connections: int = 4,
+                 messages_per_connection: int = 100,
+                 min_connections: int = 1,
+                 initial_connections: int = 1,
+                 target_latency: float = 10.0,
+                 tenant_id: str = None) -> None:
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.connections = connections
+        self.messages_per_connection = messages_per_connection
+        self.min_connections = min_connections
+        self.initial_connections = initial_connections
+        self.target_latency = target_latency
+        self.tenant_id = tenant_id
+
+
+DEFAULT_TRACE_QUERY = "SmtpTransactions " \
+    "| where Sender in ({senders}) " \
+    "| project Sender, TransactionId, Status"
+"""The default query finding the transactions of a batch of From addresses."""
+
+
+LOG_ANALYTICS_AUTH = ["azure", "none"]
+"""How queries to log analytics can be authorized: with the default Azure
+credential, or not at all, i.e. through an authorizing proxy."""
+
+
+class LogAnalyticsConfigSchema(Schema):
+    """Marshmallow schema for the log analytics config."""
+    workspace_id = fields.Str(required=True)
+    endpoint = fields.Str(missing="https://api.loganalytics.io")
+    auth = fields.Str(missing="azure",
+                      validate=validate.OneOf(LOG_ANALYTICS_AUTH))
+    query = fields.Str(missing=DEFAULT_TRACE_QUERY)
+    sender_column = fields.Str(missing="Sender")
+    transaction_column = fields.Str(missing="TransactionId")
+    status_column = fields.Str(missing="Status")
+    success_statuses = fields.List(fields.Str(), missing=lambda: ["Success"])
+    batch_size = fields.Int(missing=100, validate=validate.Range(min=1))
+    concurrency = fields.Int(missing=4, validate=validate.Range(min=1))
+    poll_interval = fields.Float(missing=10.0, validate=validate.Range(min=0))
+    max_poll_interval = fields.Float(missing=120.0,
+                                     validate=validate.Range(min=0))
+    deadline = fields.Float(missing=900.0, validate=validate.Range(min=0))
+
+    @post_load
+    def make_log_analytics_config(self, data, **kwargs):
+        return LogAnalyticsConfig(**data)
+
+
+class LogAnalyticsConfig:
+    """LogAnalyticsConfig is the config for tracing smoke test messages
+    through the log analytics backend.
+
+    Attributes:
+        workspace_id (str): The ID of the log analytics workspace.
+        endpoint (str): The URL of the log analytics API.
+        auth (str): How queries are authorized, one of LOG_ANALYTICS_AUTH.
+        query (str): The KQL query finding the transactions of a batch of
+            From addresses. '{senders}' is replaced with a comma separated
+            list of the addresses as string literals.
+        sender_column (str): The column of the query with the From address.
+        transaction_column (str): The column with the transaction ID.
+        status_column (str): The column with the status of the transaction.
+        success_statuses (List[str]): The statuses of successful transactions.
+        batch_size (int): How many From addresses to look up in each query.
+        concurrency (int): How many queries to run at once.
+        poll_interval (float): How long to wait between polls, in seconds.
+        max_poll_interval (float): The longest to wait between polls when
+            backing off, in seconds.
+        deadline (float): How long to wait for every transaction to be found,
+            in seconds.
+    """
+    def __init__(self,
+                 workspace_id: str,
+                 endpoint: str = "https://api.loganalytics.io",
+                 auth: str = "azure",
+                 query: str = DEFAULT_TRACE_QUERY,
+                 sender_column: str = "Sender",
+                 transaction_column: str = "TransactionId",
+                 status_column: str = "Status",
+                 success_statuses: List[str] = None,
+                 batch_size: int = 100,
+                 concurrency: int = 4,
+                 poll_interval: float = 10.0,
+                 max_poll_interval: float = 120.0,
+                 deadline: float = 900.0) -> None:
+        self.workspace_id = workspace_id
+        self.endpoint = endpoint
+        self.auth = auth
+        self.query = query
+        self.sender_column = sender_column
+        self.transaction_column = transaction_column
+        self.status_column = status_column
+        self.success_statuses = success_statuses or ["Success"]
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.deadline = deadline
 
 
 class SmokeConfigSchema(Schema):
     """Marshmallow schema for the smoke test plugin config."""
     attachment_libraries = fields.List(fields.Str(), required=True)
+    index_cache_path = fields.Str(missing=None)
+    scan_workers = fields.Int(missing=8, validate=validate.Range(min=1))
+    trigram_index = fields.Bool(missing=False)
+    template_bytecode_cache = fields.Bool(missing=False)
+    attachment_cache_size = fields.Str(missing="64mib")
+    attachment_cache_dir = fields.Str(missing=None)
+    specs = fields.List(fields.Str(), missing=list)
+    clusters = fields.Dict(keys=fields.Str(),
+                           values=fields.Nested(ClusterConfigSchema),
+                           missing=dict)
+    log_analytics = fields.Nested(LogAnalyticsConfigSchema, missing=None)
+    run_store_path = fields.Str(missing=None)
 
     @post_load
     def make_smoke_config(self, data, **kwargs):
@@ -21,6 +197,52 @@ class SmokeConfigSchema(Schema):
 
 
 class SmokeConfig:
-    """SmokeConfig is the config for the smoke testing plugin."""
-    def __init__(self, attachment_libraries: List[str]) -> None:
-        self.attachment_libraries = attachment_libraries
\ No newline at end of file
+    """SmokeConfig is the config for the smoke testing plugin.
+
+    Attributes:
+        attachment_libraries (List[str]): The folders to load attachments from.
+        index_cache_path (str): Where to store the attachment index cache. If
+            None, the default location in the user cache directory is used.
+        scan_workers (int): The number of threads used to scan the attachment
+            libraries.
+        trigram_index (bool): Whether to build a trigram index over the
+            attachment paths to speed up the 'like' filter.
+        template_bytecode_cache (bool): Whether to cache compiled templates on
+            disk between runs.
+        attachment_cache_size (str): How much memory to use for caching
+            encoded attachments, i.e. '64mib'.
+        attachment_cache_dir (str): If given, a directory to spill encoded
+            attachments to when they don't fit in memory. It keeps one
+            entry per attachment, so grows with the library.
+        specs (List[str]): The spec files to send in a smoke test.
+        clusters (Dict[str, ClusterConfig]): The clusters that can be smoke
+            tested, by name.
+        log_analytics (LogAnalyticsConfig): How to trace smoke test messages
+            through the log analytics backend. If None, messages aren't
+            traced.
+        run_store_path (str): Where to store the results of smoke test runs.
+            If None, the default location in the user data directory is used.
+    """
+    def __init__(self,
+                 attachment_libraries: List[str],
+                 index_cache_path: str = None,
+                 scan_workers: int = 8,
+                 trigram_index: bool = False,
+                 template_bytecode_cache: bool = False,
+                 attachment_cache_size: str = "64mib",
+                 attachment_cache_dir: str = None,
+                 specs: List[str] = None,
+                 clusters: Dict[str, ClusterConfig] = None,
+                 log_analytics: Optional[LogAnalyticsConfig] = None,
+                 run_store_path: str = None) -> None:
+        self.attachment_libraries = attachment_libraries
+        self.index_cache_path = index_cache_path
+        self.scan_workers = scan_workers
+        self.trigram_index = trigram_index
+        self.template_bytecode_cache = template_bytecode_cache
+        self.attachment_cache_size = attachment_cache_size
+        self.attachment_cache_dir = attachment_cache_dir
+        self.specs = specs or []
+        self.clusters = clusters or {}
+        self.log_analytics = log_analytics
+        self.run_store_path = run_store_path
@@ -0,0 +1,46 @@
+"""faker_pool.py
+
+Keeps a Faker instance per thread, so templates don't pay the cost of
+constructing Faker (and loading its locale providers) on every render.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import threading
+from typing import Union
+
+from faker import Faker
+
+from .faker_text_provider import TextProvider
+
+_local = threading.local()
+
+
+def create_faker() -> Faker:
+    """Create a new Faker instance with the smoke test providers added."""
+    fake = Faker()
+    fake.add_provider(TextProvider)
+    return fake
+
+
+def get_faker(seed: Union[int, None] = None) -> Faker:
+    """Get the Faker instance for the current thread, creating it if this
+    thread doesn't have one yet.
+
+    Instances aren't shared between threads (or processes), so they can be
+    seeded without affecting renders running elsewhere.
+
+    Args:
+        seed (int): If given, seed the instance, so that what it generates
+            next is deterministic.
+
+    Returns:
+        Faker: The Faker instance.
+    """
+    fake = getattr(_local, "faker", None)
+    if fake is None:
+        fake = create_faker()
+        _local.faker = fake
+    if seed is not None:
+        fake.seed_instance(seed)
+    return fake
@@ -1,11 +1,17 @@
 """faker_text_provider.py
 
 Implements a provider for Faker that can generate fake UTF-8 and ASCII text.
+ASCII is generated a whole buffer of random bytes at a time, and mapped into
+the wanted character set with bytes.translate. Bytes that would make some
+characters likelier than others are rejected, so the output is uniform.
 
 Author:
     Sam Gibson <sgibson@glasswallsolutions.com>
 """
+from collections import namedtuple
+import functools
 import random
+from typing import List
 
 from faker.providers import BaseProvider
 
@@ -53,19 +59,142 @@ UNICODE_RANGES = [(0x0020, 0x007F), (0x00A0, 0x00FF), (0x0100, 0x017F),
                   (0x2F800, 0x2FA1F), (0xE0000, 0xE007F)]
 
 
+PRINTABLE_CHARS = bytes(range(0x20, 0x7F))
+"""The printable ASCII characters."""
+
+CONTROL_CHARS = bytes(range(0x00, 0x20)) + b"\x7f"
+"""The ASCII control characters."""
+
+
+AsciiMode = namedtuple("AsciiMode", ["table", "rejected"])
+"""A table for bytes.translate mapping random bytes into an alphabet, and the
+bytes to delete first so that every character in the alphabet is equally
+likely."""
+
+
+def _ascii_mode(alphabet: bytes) -> AsciiMode:
+    """Map random bytes uniformly into an alphabet, rejecting the bytes past
+    the largest multiple of the alphabet's length."""
+    accepted = len(alphabet) * (256 // len(alphabet))
+    return AsciiMode(
+        bytes(alphabet[b % len(alphabet)] for b in range(256)),
+        bytes(range(accepted, 256)))
+
+
+ASCII_MODES = {
+    # every 7-bit character, the same as taking each byte modulo 128
+    "ascii": _ascii_mode(bytes(range(128))),
+    "printable": _ascii_mode(PRINTABLE_CHARS),
+    # about half control characters, for fuzzing parsers
+    "control": _ascii_mode(CONTROL_CHARS * 3 + PRINTABLE_CHARS)
+}
+"""How random bytes are mapped to each mode of ASCII output."""
+
+
+def random_bytes(rng: random.Random, length: int) -> bytes:
+    """Generate random bytes from a random number generator in one call.
+
+    Args:
+        rng (random.Random): The random number generator to use.
+        length (int): The number of bytes to generate.
+
+    Returns:
+        bytes: The random bytes.
+    """
+    if length <= 0:
+        return b""
+    return rng.getrandbits(length * 8).to_bytes(length, "little")
+
+
+def ascii_bytes(rng: random.Random,
+                length: int,
+                mode: str = "ascii",
+                line_length: int = None) -> bytes:
+    """Generate random ASCII bytes.
+
+    Args:
+        rng (random.Random): The random number generator to use.
+        length (int): The number of characters to generate, not including
+            line breaks.
+        mode (str): The characters to generate: 'ascii' for any 7-bit
+            character, 'printable' for printable characters only, or
+            'control' for text heavy in control characters.
+        line_length (int): If given, insert a CRLF line break after every
+            this many characters.
+
+    Returns:
+        bytes: The generated ASCII.
+    """
+    if mode not in ASCII_MODES:
+        raise ValueError(f"Unknown ASCII mode '{mode}'")
+    table, rejected = ASCII_MODES[mode]
+    text = b""
+    while len(text) < length:
+        # draw enough bytes that there'll usually be enough once some are
+        # rejected
+        missing = length - len(text)
+        draw = -(-missing * 256 // (256 - len(rejected)))
+        text += random_bytes(rng, draw).translate(table, rejected)
+    text = text[:length]
+    if line_length:
+        text = b"\r\n".join(text[i:i + line_length]
+                             for i in range(0, len(text), line_length))
+    return text
+
+
+@functools.lru_cache(maxsize=None)
+def unicode_alphabet() -> str:
+    """Get every character in UNICODE_RANGES as a single string. This is only
+    built once, the first time it's needed."""
+    return "".join(
+        chr(code_point) for current_range in UNICODE_RANGES
+        for code_point in range(current_range[0], current_range[1] + 1))
+
+
 class TextProvider(BaseProvider):
-    """A Faker Provider that can generate fake unicode and ascii."""
+    """A Faker Provider that can generate fake unicode and ascii.
+
+    Text is generated using the Faker generator's random instance, so seeding
+    the generator makes the output reproducible.
+    """
     def unicode(self, length: int):
         """Generate fake unicode text of a given length."""
-        # adapted from: https://stackoverflow.com/questions/1477294/generate-random-utf-8-string-in-python
-        alphabet = [
-            chr(code_point) for current_range in UNICODE_RANGES
-            for code_point in range(current_range[0], current_range[1] + 1)
-        ]
-        return ''.join(random.choice(alphabet) for _ in range(length))
-
-    def ascii(self, length: int):
-        """Generate fake ASCII text of a given length."""
-        return bytes([
-            b % 128 for b in [random.getrandbits(8) for _ in range(length)]
-        ]).decode("ascii")
+        return "".join(
+            self.generator.random.choices(unicode_alphabet(), k=length))
+
+    def unicode_many(self, count: int, length: int) -> List[str]:
+        """Generate many strings of fake unicode text of a given length.
+
+        All of the characters are drawn in one go, which is much quicker
+        than calling unicode() repeatedly.
+
+        Args:
+            count (int): The number of strings to generate.
+            length (int): The length of each string.
+
+        Returns:
+            List[str]: The generated strings.
+        """
+        text = self.unicode(count * length)
+        return [text[i:i + length] for i in range(0, count * length, length)]
+
+    def ascii(self,
+              length: int,
+              mode: str = "ascii",
+              line_length: int = None) -> str:
+        """Generate fake ASCII text of a given length.
+
+        Args:
+            length (int): The number of characters to generate, not including
+                line breaks.
+            mode (str): 'ascii', 'printable' or 'control', see ascii_bytes().
+            line_length (int): If given, wrap the text with CRLF line breaks.
+        """
+        return self.ascii_bytes(length, mode, line_length).decode("ascii")
+
+    def ascii_bytes(self,
+                    length: int,
+                    mode: str = "ascii",
+                    line_length: int = None) -> bytes:
+        """Generate fake ASCII as bytes, see ascii_bytes()."""
+        return ascii_bytes(self.generator.random, length, mode, line_length)
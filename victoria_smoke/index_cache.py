@@ -0,0 +1,234 @@
+"""index_cache.py
+
+IndexCache persists the attachment library index to disk, so that subsequent
+runs only need to rescan the directories that have changed since the last run.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+from collections import namedtuple
+import logging
+import os
+from os import path
+import pickle
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import appdirs
+
+from .trigram import TrigramIndex, fingerprint
+from . import util
+
+APP_NAME = "victoria_smoke"
+"""What the app is called, used for finding the cache directory."""
+
+APP_AUTHOR = "GlasswallSRE"
+"""Who the author of the application is."""
+
+DEFAULT_CACHE_NAME = "attachment_index.pickle"
+"""The default filename of the index cache."""
+
+CACHE_VERSION = 4
+"""The version of the on-disk format. Caches with a different version are
+discarded and rebuilt."""
+
+RACY_WINDOW_NS = 2 * 10**9
+"""How close to the time a directory was scanned its mtime can be before its
+record isn't trusted, in nanoseconds. An entry added in the same mtime tick
+as the scan (up to two seconds on some filesystems) leaves the mtime
+unchanged, so would otherwise be missed for good."""
+
+DirectoryRecord = namedtuple("DirectoryRecord",
+                             ["mtime", "files", "dirs", "scanned"])
+"""The cached contents of a single directory. 'mtime' is the directory's
+st_mtime_ns, 'files' is a list of (name, size) tuples, 'dirs' is a list of
+subdirectory names and 'scanned' is when it was scanned, in nanoseconds since
+the epoch."""
+
+
+def get_cache_loc() -> str:
+    """Get the default path to the index cache file."""
+    return path.join(appdirs.user_cache_dir(APP_NAME, APP_AUTHOR),
+                     DEFAULT_CACHE_NAME)
+
+
+def scan_directory(directory: str, mtime: int = None) -> DirectoryRecord:
+    """Scan a single directory (non-recursively) into a DirectoryRecord.
+
+    The files and subdirectories are sorted by name, so the order of the
+    index doesn't depend on the order the filesystem lists them in. File
+    types come from the data returned by scandir, and each entry's stat
+    result is cached on the DirEntry, so each file is stat-ed at most once
+    (and not at all on Windows, where scandir returns the size).
+
+    Args:
+        directory (str): The directory to scan.
+        mtime (int): The directory's st_mtime_ns, if already known.
+
+    Returns:
+        DirectoryRecord: The files and subdirectories of the directory.
+    """
+    # taken before listing, so entries added while listing are in the window
+    scanned = time.time_ns()
+    if mtime is None:
+        mtime = os.stat(directory).st_mtime_ns
+    files: List[Tuple[str, int]] = []
+    dirs: List[str] = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append((entry.name, entry.stat().st_size))
+    files.sort()
+    dirs.sort()
+    return DirectoryRecord(mtime, files, dirs, scanned)
+
+
+def is_racy(record: DirectoryRecord) -> bool:
+    """Whether a directory was modified so soon before it was scanned that
+    entries may have been added since without changing its mtime."""
+    return record.scanned - record.mtime < RACY_WINDOW_NS
+
+
+class IndexCache:
+    """IndexCache stores a record of every directory in each attachment
+    library, keyed by the directory's path.
+
+    A directory's mtime only changes when entries are added, removed or
+    renamed within it, so unchanged directories are served from the cache
+    without listing them or stat-ing their files. Directories modified just
+    before they were scanned are always rescanned, see RACY_WINDOW_NS. Note
+    that a file that is modified in-place will keep its cached size until the
+    index is rebuilt.
+
+    Attributes:
+        cache_path (str): The path to the cache file on disk.
+        libraries (Dict[str, Dict[str, DirectoryRecord]]): The cached
+            directory records for each library.
+        rescanned (int): The number of directories rescanned since the cache
+            was loaded.
+        trigrams (TrigramIndex): The trigram index built for the libraries,
+            if one was requested.
+    """
+    def __init__(self, cache_path: str = None) -> None:
+        """Create an index cache, loading it from disk if it exists.
+
+        Args:
+            cache_path (str): The path to the cache file. Defaults to a file
+                in the user cache directory.
+        """
+        self.cache_path = cache_path or get_cache_loc()
+        self.libraries: Dict[str, Dict[str, DirectoryRecord]] = {}
+        self.trigrams: Optional[TrigramIndex] = None
+        self.rescanned = 0
+        self._dirty = False
+        self.load()
+
+    def load(self) -> None:
+        """Load the cache from disk. If the cache doesn't exist or can't be
+        read then the cache will start empty."""
+        if not path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "rb") as cache_file:
+                version, *contents = pickle.load(cache_file)
+        except Exception as err:
+            logging.warning(
+                f"unable to read index cache '{self.cache_path}': {err}")
+            return
+        if version != CACHE_VERSION:
+            logging.info(f"index cache '{self.cache_path}' is version "
+                         f"{version}, expected {CACHE_VERSION}, rebuilding")
+            return
+        self.libraries, self.trigrams = contents
+
+    def save(self) -> None:
+        """Save the cache to disk if it has changed since it was loaded."""
+        if not self._dirty:
+            return
+        os.makedirs(path.dirname(self.cache_path) or ".", exist_ok=True)
+
+        # write to a temporary file first so a concurrent reader never sees
+        # a partially written cache
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump((CACHE_VERSION, self.libraries, self.trigrams),
+                        cache_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+        self._dirty = False
+
+    def clear(self) -> None:
+        """Remove all cached directory records."""
+        self.libraries = {}
+        self.trigrams = None
+        self._dirty = True
+
+    def trigram_index(self, paths: Sequence[str]) -> TrigramIndex:
+        """Get a trigram index over a list of paths. The cached index is used
+        if it was built from the same paths, otherwise it's rebuilt.
+
+        Args:
+            paths (Sequence[str]): The paths to index.
+
+        Returns:
+            TrigramIndex: The trigram index.
+        """
+        if self.trigrams is None or \
+                self.trigrams.fingerprint != fingerprint(paths):
+            self.trigrams = TrigramIndex(paths)
+            self._dirty = True
+        return self.trigrams
+
+    def walk(self, library: str,
+             workers: int = 1) -> Iterator[Tuple[str, int]]:
+        """Walk a library, yielding the path and size of each file in it.
+
+        Directories whose mtime has changed since they were cached, or that
+        were modified just before they were cached, are rescanned, the rest
+        are read from the cache.
+
+        Args:
+            library (str): The path to the library.
+            workers (int): The number of threads to scan directories with.
+
+        Yields:
+            Tuple[str, int]: The path and size of each file.
+        """
+        cached = self.libraries.get(library, {})
+
+        def scan(directory: str) -> Tuple[DirectoryRecord, List[str]]:
+            mtime = os.stat(directory).st_mtime_ns
+            record = cached.get(directory)
+            if record is None or record.mtime != mtime or is_racy(record):
+                record = scan_directory(directory, mtime)
+            return record, [path.join(directory, name) for name in record.dirs]
+
+        records: Dict[str, DirectoryRecord] = {}
+        for directory, record in util.walk_parallel(library, scan, workers):
+            if record is not cached.get(directory):
+                self.rescanned += 1
+            records[directory] = record
+            for name, size in record.files:
+                yield path.join(directory, name), size
+
+        if records != cached:
+            self.libraries[library] = records
+            self._dirty = True
+
+    def stats(self, library: str) -> Tuple[int, int, int]:
+        """Get statistics about a cached library.
+
+        Args:
+            library (str): The path to the library.
+
+        Returns:
+            Tuple[int, int, int]: The number of directories, the number of
+                files and the total size in bytes of the library.
+        """
+        records = self.libraries.get(library, {})
+        num_files = sum(len(record.files) for record in records.values())
+        total_size = sum(size for record in records.values()
+                         for _, size in record.files)
+        return len(records), num_files, total_size
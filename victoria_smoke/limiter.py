@@ -0,0 +1,105 @@
+"""limiter.py
+
+An adaptive concurrency limiter, used to send to each cluster as fast as it can
+accept messages without overwhelming it.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import asyncio
+import math
+import time
+
+LATENCY_BACKOFF = 0.9
+"""How much the limit is multiplied by when latency is over target."""
+
+ERROR_BACKOFF = 0.5
+"""How much the limit is multiplied by when a send fails."""
+
+EWMA_WEIGHT = 0.2
+"""The weight of the newest sample in the latency and error rate averages."""
+
+
+class AimdLimiter:
+    """AimdLimiter bounds the number of operations in flight, adjusting the
+    bound with additive increase, multiplicative decrease (AIMD).
+
+    Each operation that completes within the target latency raises the limit
+    by 1/limit, so the limit grows by roughly one every round trip. Operations
+    over the target latency shrink the limit by LATENCY_BACKOFF, and failures
+    by ERROR_BACKOFF. The limit is decreased at most once per round trip, so a
+    burst of failures from a single overload only backs off once.
+
+    Until the first decrease, the limit grows by one for every success (like
+    TCP slow start), to quickly find the capacity of a healthy cluster.
+
+    Attributes:
+        minimum (int): The lowest the limit can go.
+        maximum (int): The highest the limit can go.
+        limit (float): The current limit.
+        target_latency (float): The latency in seconds above which the limit
+            is decreased.
+        in_flight (int): The number of operations in flight.
+        latency (float): The moving average of latency, in seconds.
+        error_rate (float): The moving average of the rate of failures.
+    """
+    def __init__(self, minimum: int, maximum: int, initial: int,
+                 target_latency: float) -> None:
+        """Create a limiter.
+
+        Args:
+            minimum (int): The lowest the limit can go.
+            maximum (int): The highest the limit can go.
+            initial (int): The starting limit.
+            target_latency (float): The latency in seconds above which the
+                limit is decreased.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self._slow_start = True
+        self._last_decrease = -math.inf
+        self._condition = asyncio.Condition()
+
+    def _has_slot(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self) -> None:
+        """Wait until there's room under the limit for another operation."""
+        async with self._condition:
+            await self._condition.wait_for(self._has_slot)
+            self.in_flight += 1
+
+    async def release(self, latency: float, failed: bool = False) -> None:
+        """Finish an operation, adjusting the limit based on how it went.
+
+        Args:
+            latency (float): How long the operation took, in seconds.
+            failed (bool): Whether the operation failed.
+        """
+        self.latency += EWMA_WEIGHT * (latency - self.latency)
+        self.error_rate += EWMA_WEIGHT * (float(failed) - self.error_rate)
+        if failed:
+            self._decrease(ERROR_BACKOFF)
+        elif latency > self.target_latency:
+            self._decrease(LATENCY_BACKOFF)
+        elif self._slow_start:
+            self.limit = min(self.limit + 1, self.maximum)
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _decrease(self, backoff: float) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.latency:
+            return
+        self._slow_start = False
+        self._last_decrease = now
+        self.limit = max(self.limit * backoff, self.minimum)
@@ -0,0 +1,345 @@
+"""mime_writer.py
+
+MimeWriter streams a multipart MIME message to a file or socket part by part,
+so messages with large attachments can be written without ever holding the
+whole message in memory. SerializedMessage holds the parts of a message
+serialized once, so it can be written many times with different headers.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import base64
+from email import policy
+from email.message import Message, MIMEPart
+import mimetypes
+import mmap
+from os import path
+import random
+import sys
+from typing import BinaryIO, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .attachment_cache import EncodedAttachmentCache
+
+CHUNK_SIZE = 57 * 1024
+"""How many bytes of an attachment to encode at a time. base64 encodes each 57
+bytes as one 76 character line, so every chunk is a whole number of lines."""
+
+COALESCE_SIZE = 1 << 20
+"""Writes to a BufferList smaller than this are copied together into a single
+buffer, larger writes are kept as they are."""
+
+
+def encode_file(file_path: str, stream: BinaryIO, linesep: str = "\n") -> int:
+    """Base64-encode a file into a stream, a chunk at a time.
+
+    Args:
+        file_path (str): The path to the file to encode.
+        stream (BinaryIO): The stream to write the encoded file to.
+        linesep (str): The line separator between lines of base64.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    written = 0
+    encoded_linesep = linesep.encode("ascii")
+    with open(file_path, "rb") as source_file:
+        while True:
+            chunk = source_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            encoded = base64.encodebytes(chunk)
+            if encoded_linesep != b"\n":
+                encoded = encoded.replace(b"\n", encoded_linesep)
+            stream.write(encoded)
+            written += len(encoded)
+    return written
+
+
+def make_boundary() -> str:
+    """Make a random MIME boundary, in the same format as the email module."""
+    return f"{'=' * 15}{random.randrange(sys.maxsize):019d}=="
+
+
+def attachment_part(file_path: str) -> MIMEPart:
+    """Get the headers of an attachment as a MIMEPart with no payload.
+
+    Args:
+        file_path (str): The path to the attachment.
+
+    Returns:
+        MIMEPart: The attachment's headers.
+    """
+    # files without a known type (like executables) are a generic stream
+    # of bytes
+    mime_type = mimetypes.guess_type(file_path)[0] or \
+        "application/octet-stream"
+    part = MIMEPart(policy=policy.default)
+    part["Content-Type"] = mime_type
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition",
+                    "attachment",
+                    filename=path.basename(file_path))
+    return part
+
+
+def _close_mapping(mapping: mmap.mmap) -> None:
+    """Close an attachment mapped from the cache's on-disk store once it's
+    written, unless the stream kept a reference to it, i.e. a BufferList, in
+    which case it's closed when the stream's buffers are released."""
+    try:
+        mapping.close()
+    except BufferError:
+        pass
+
+
+class BufferList:
+    """BufferList is a write-only stream that keeps the buffers written to it
+    rather than copying them into one, so large buffers (like attachments
+    mapped from disk) are only referenced. Small writes are coalesced, to keep
+    the number of buffers down for writev()."""
+    def __init__(self) -> None:
+        self.buffers: List[memoryview] = []
+        self._pending = bytearray()
+
+    def write(self, data) -> int:
+        if len(data) >= COALESCE_SIZE:
+            self._flush()
+            self.buffers.append(memoryview(data))
+        else:
+            self._pending += data
+            if len(self._pending) >= COALESCE_SIZE:
+                self._flush()
+        return len(data)
+
+    def getbuffers(self) -> List[memoryview]:
+        """Get every buffer written, in order."""
+        self._flush()
+        return self.buffers
+
+    def _flush(self) -> None:
+        if self._pending:
+            self.buffers.append(memoryview(bytes(self._pending)))
+            self._pending = bytearray()
+
+
+class MimeWriter:
+    """MimeWriter writes a multipart MIME message to a binary stream.
+
+    The top-level headers are written first, then each part in turn, and
+    finally the closing boundary is written by close(). Attachments are read
+    and base64-encoded from their files in chunks of CHUNK_SIZE bytes, so
+    memory use is bounded no matter how large the attachments are.
+
+    To write to a socket, use a stream from socket.makefile("wb").
+
+    Attributes:
+        stream (BinaryIO): The stream being written to.
+        boundary (str): The boundary between parts of the message.
+        policy (email.policy.Policy): The policy used to serialise headers.
+        cache (EncodedAttachmentCache): The cache of encoded attachments, if
+            any.
+        bytes_written (int): The number of bytes written so far.
+    """
+    def __init__(self,
+                 stream: BinaryIO,
+                 boundary: str = None,
+                 linesep: str = "\n",
+                 cache: Optional["EncodedAttachmentCache"] = None) -> None:
+        """Create a writer over a stream.
+
+        Args:
+            stream (BinaryIO): The stream to write to.
+            boundary (str): The boundary between parts. Defaults to a random
+                boundary.
+            linesep (str): The line separator, use "\\r\\n" for SMTP.
+            cache (EncodedAttachmentCache): If given, splice attachments in
+                from this cache rather than encoding them every time.
+        """
+        self.stream = stream
+        self.cache = cache
+        self.boundary = boundary or make_boundary()
+        self.policy = policy.default.clone(linesep=linesep)
+        self.bytes_written = 0
+        self._linesep_str = linesep
+        self._linesep = linesep.encode("ascii")
+        self._delimiter = f"--{self.boundary}".encode("ascii") + self._linesep
+
+    def _write(self, data: bytes) -> None:
+        self.stream.write(data)
+        self.bytes_written += len(data)
+
+    def _write_header_block(self, mime: Message) -> None:
+        for name, value in mime.raw_items():
+            self._write(self.policy.fold_binary(name, value))
+        self._write(self._linesep)
+
+    def fold_headers(self, mime: Message) -> List[Tuple[str, bytes]]:
+        """Serialise the top-level headers of a message without writing them,
+        as (lowercase name, folded header) tuples.
+
+        Args:
+            mime (Message): A message with the headers, see write_headers().
+
+        Returns:
+            List[Tuple[str, bytes]]: The folded headers.
+        """
+        mime.set_boundary(self.boundary)
+        return [(name.lower(), self.policy.fold_binary(name, value))
+                for name, value in mime.raw_items()]
+
+    def write_headers(self, mime: Message) -> None:
+        """Write the top-level headers of the message.
+
+        Args:
+            mime (Message): A message with the headers to write. Its
+                Content-Type should be multipart, and its boundary is replaced
+                with this writer's.
+        """
+        mime.set_boundary(self.boundary)
+        self._write_header_block(mime)
+
+    def write_part(self, part: Message) -> None:
+        """Write an in-memory part of the message, like the body.
+
+        Args:
+            part (Message): The part to write.
+        """
+        self._write(self._delimiter)
+        self._write(part.as_bytes(policy=self.policy))
+        self._write(self._linesep)
+
+    def write_attachment(self, file_path: str) -> None:
+        """Write a file as an attachment, encoding it in chunks.
+
+        Args:
+            file_path (str): The path to the file to attach.
+        """
+        self._write(self._delimiter)
+        self._write_header_block(attachment_part(file_path))
+        encoded = None
+        if self.cache is not None:
+            encoded = self.cache.get(file_path, self._linesep_str)
+        if encoded is not None:
+            self._write(encoded)
+            if isinstance(encoded, mmap.mmap):
+                _close_mapping(encoded)
+        else:
+            self.bytes_written += encode_file(file_path, self.stream,
+                                              self._linesep_str)
+
+    def close(self) -> None:
+        """Write the closing boundary, ending the message."""
+        self._write(f"--{self.boundary}--".encode("ascii") + self._linesep)
+
+
+class SerializedMessage:
+    """SerializedMessage is a multipart MIME message whose parts have been
+    serialized once, so that it can be written out many times with only the
+    header block regenerated each time, i.e. with a different From,
+    Message-ID and Date per cluster.
+
+    The parts are shared between every write: buffers() returns them as
+    memoryviews without copying, ready to be passed to os.writev(),
+    socket.sendmsg() or an asyncio transport's writelines().
+
+    Attributes:
+        headers (List[Tuple[str, bytes]]): The default headers, as
+            (lowercase name, folded header) tuples.
+        payload (List[memoryview]): The serialized parts of the message.
+        policy (email.policy.Policy): The policy used to serialise headers.
+    """
+    def __init__(self, headers: List[Tuple[str, bytes]],
+                 payload: List[memoryview], policy: policy.Policy) -> None:
+        self.headers = headers
+        self.payload = payload
+        self.policy = policy
+        self.payload_size = sum(len(buffer) for buffer in payload)
+
+    @classmethod
+    def build(cls,
+              mime: Message,
+              parts: List[Message],
+              attachments: List[str],
+              boundary: str = None,
+              linesep: str = "\n",
+              cache: Optional["EncodedAttachmentCache"] = None
+              ) -> "SerializedMessage":
+        """Serialize a message.
+
+        Args:
+            mime (Message): A message with the top-level headers.
+            parts (List[Message]): The in-memory parts, written after the
+                attachments.
+            attachments (List[str]): The paths of the files to attach.
+            boundary (str): The boundary between parts. Defaults to a random
+                boundary.
+            linesep (str): The line separator, use "\\r\\n" for SMTP.
+            cache (EncodedAttachmentCache): If given, splice attachments in
+                from this cache rather than encoding them.
+
+        Returns:
+            SerializedMessage: The serialized message.
+        """
+        payload = BufferList()
+        writer = MimeWriter(payload, boundary, linesep, cache)
+        headers = writer.fold_headers(mime)
+        payload.write(writer._linesep)
+        for attachment in attachments:
+            writer.write_attachment(attachment)
+        for part in parts:
+            writer.write_part(part)
+        writer.close()
+        return cls(headers, payload.getbuffers(), writer.policy)
+
+    def header_block(self, overrides: Dict[str, str] = None) -> bytes:
+        """Serialise the header block, replacing some of the headers.
+
+        Args:
+            overrides (Dict[str, str]): Headers to set, replacing the default
+                header of the same name if there is one.
+
+        Returns:
+            bytes: The serialized headers.
+        """
+        if not overrides:
+            return b"".join(folded for _, folded in self.headers)
+        replaced = {name.lower(): name for name in overrides}
+        block = [folded for name, folded in self.headers
+                 if name not in replaced]
+        block.extend(
+            self.policy.fold_binary(name, value)
+            for name, value in overrides.items())
+        return b"".join(block)
+
+    def buffers(self, overrides: Dict[str, str] = None) -> List[memoryview]:
+        """Get the whole message as a list of buffers, the header block
+        followed by the shared payload.
+
+        Args:
+            overrides (Dict[str, str]): Headers to set, see header_block().
+
+        Returns:
+            List[memoryview]: The buffers of the message.
+        """
+        return [memoryview(self.header_block(overrides))] + self.payload
+
+    def write(self, stream: BinaryIO, overrides: Dict[str, str] = None) -> int:
+        """Write the message to a stream.
+
+        Args:
+            stream (BinaryIO): The stream to write to.
+            overrides (Dict[str, str]): Headers to set, see header_block().
+
+        Returns:
+            int: The number of bytes written.
+        """
+        written = 0
+        for buffer in self.buffers(overrides):
+            stream.write(buffer)
+            written += len(buffer)
+        return written
+
+    def as_bytes(self, overrides: Dict[str, str] = None) -> bytes:
+        """Get the whole message as bytes, with the given headers set."""
+        return b"".join(self.buffers(overrides))
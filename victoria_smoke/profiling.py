@@ -0,0 +1,236 @@
+"""profiling.py
+
+Lightweight instrumentation of the stages of templating, rendering and sending
+messages. Stages are timed and events counted only while profiling is enabled,
+otherwise the timers and counters cost next to nothing, so they can be left in
+hot paths.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+from collections import namedtuple
+from contextlib import nullcontext
+import json
+import re
+import threading
+import time
+from typing import ContextManager, Dict, List
+
+METRICS_FORMATS = ["json", "prometheus"]
+"""The formats metrics can be written in."""
+
+METRIC_PREFIX = "victoria_smoke"
+"""The prefix of the names of Prometheus metrics."""
+
+Profile = namedtuple("Profile", ["stages", "counters", "seconds"])
+"""A snapshot of the profile: the StageStats of each stage by name, the value
+of each counter by name, and the seconds since profiling was enabled."""
+
+
+class StageStats:
+    """The time spent in a stage.
+
+    Attributes:
+        calls (int): The number of times the stage ran.
+        seconds (float): The total time spent in the stage, in seconds.
+        max_seconds (float): The longest the stage took, in seconds.
+    """
+    __slots__ = ("calls", "seconds", "max_seconds")
+
+    def __init__(self, calls: int = 0, seconds: float = 0.0,
+                 max_seconds: float = 0.0) -> None:
+        self.calls = calls
+        self.seconds = seconds
+        self.max_seconds = max_seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "max_seconds": self.max_seconds
+        }
+
+
+_enabled = False
+_started = 0.0
+_stages: Dict[str, StageStats] = {}
+_counters: Dict[str, int] = {}
+_lock = threading.Lock()
+
+# timing a stage while profiling is disabled uses this shared context manager,
+# which does nothing
+_DISABLED = nullcontext()
+
+
+class _Timer:
+    """Times a stage, recording it when the stage exits."""
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            stats = _stages.get(self.stage)
+            if stats is None:
+                stats = _stages[self.stage] = StageStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+
+def enable() -> None:
+    """Start profiling, discarding anything recorded before."""
+    global _enabled, _started
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _started = time.perf_counter()
+        _enabled = True
+
+
+def disable() -> None:
+    """Stop profiling. What was recorded is kept until profiling is enabled
+    again."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """Whether profiling is enabled."""
+    return _enabled
+
+
+def timed(stage: str) -> ContextManager:
+    """Time a stage, i.e. 'with timed("spec.yaml"): ...'.
+
+    Nested stages are named with the name of the stage they're in as a
+    prefix, like 'spec.load' and 'spec.load.headers', and their time is
+    counted in both.
+
+    Args:
+        stage (str): The name of the stage.
+
+    Returns:
+        ContextManager: The context manager timing the stage.
+    """
+    if not _enabled:
+        return _DISABLED
+    return _Timer(stage)
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Add to a counter, if profiling is enabled.
+
+    Args:
+        name (str): The name of the counter.
+        amount (int): How much to add.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def snapshot() -> Profile:
+    """Get a copy of everything recorded so far."""
+    with _lock:
+        return Profile(
+            {
+                name: StageStats(stats.calls, stats.seconds,
+                                 stats.max_seconds)
+                for name, stats in _stages.items()
+            }, dict(_counters), time.perf_counter() - _started)
+
+
+def report(profile: Profile) -> List[str]:
+    """Format a profile as a table of the time spent in each stage, followed
+    by the counters.
+
+    Args:
+        profile (Profile): The profile, from snapshot().
+
+    Returns:
+        List[str]: The lines of the report.
+    """
+    lines = [
+        f"{'stage':<28}{'calls':>8}{'total (s)':>12}{'mean (ms)':>12}"
+        f"{'max (ms)':>12}{'% time':>8}"
+    ]
+    for name, stats in sorted(profile.stages.items()):
+        share = stats.seconds / profile.seconds if profile.seconds else 0.0
+        lines.append(f"{name:<28}{stats.calls:>8}{stats.seconds:>12.3f}"
+                     f"{stats.seconds / stats.calls * 1e3:>12.3f}"
+                     f"{stats.max_seconds * 1e3:>12.3f}{share:>8.1%}")
+    lines.append(f"{'wall time':<28}{'':>8}{profile.seconds:>12.3f}")
+    for name, value in sorted(profile.counters.items()):
+        lines.append(f"{name:<28}{value:>8}")
+    return lines
+
+
+def to_json(profile: Profile) -> str:
+    """Format a profile as JSON."""
+    return json.dumps(
+        {
+            "seconds": profile.seconds,
+            "stages": {
+                name: stats.as_dict()
+                for name, stats in sorted(profile.stages.items())
+            },
+            "counters": dict(sorted(profile.counters.items()))
+        },
+        indent=2)
+
+
+def _metric_name(name: str) -> str:
+    """Convert a counter name to a valid Prometheus metric name."""
+    return f"{METRIC_PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+
+
+def to_prometheus(profile: Profile) -> str:
+    """Format a profile in the Prometheus text exposition format."""
+    lines = []
+    for metric, metric_type, description, field in [
+        ("stage_seconds_total", "counter", "Time spent in each stage.",
+         "seconds"),
+        ("stage_calls_total", "counter", "Times each stage ran.", "calls"),
+        ("stage_max_seconds", "gauge", "The longest each stage took.",
+         "max_seconds")
+    ]:
+        lines.append(f"# HELP {METRIC_PREFIX}_{metric} {description}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{metric} {metric_type}")
+        for name, stats in sorted(profile.stages.items()):
+            lines.append(f'{METRIC_PREFIX}_{metric}{{stage="{name}"}} '
+                         f"{getattr(stats, field)}")
+    for name, value in sorted(profile.counters.items()):
+        lines.append(f"# TYPE {_metric_name(name)} counter")
+        lines.append(f"{_metric_name(name)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(file_path: str, metrics_format: str,
+                  profile: Profile) -> None:
+    """Write a profile to a file as metrics.
+
+    Args:
+        file_path (str): The file to write.
+        metrics_format (str): 'json' or 'prometheus'.
+        profile (Profile): The profile, from snapshot().
+
+    Raises:
+        ValueError: If the format isn't known.
+    """
+    if metrics_format == "json":
+        contents = to_json(profile)
+    elif metrics_format == "prometheus":
+        contents = to_prometheus(profile)
+    else:
+        raise ValueError(f"unknown metrics format '{metrics_format}', "
+                         f"expected one of {METRICS_FORMATS}")
+    with open(file_path, "w") as metrics_file:
+        metrics_file.write(contents)
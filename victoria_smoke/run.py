@@ -0,0 +1,202 @@
+"""run.py
+
+Runs a smoke test: sending messages through the clusters, then tracing the
+accepted messages through the log analytics backend, recording the results in
+the run store. Failed messages from earlier runs can be replayed.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import asyncio
+from collections import defaultdict, namedtuple
+from datetime import datetime
+import logging
+import secrets
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from .attachment_cache import EncodedAttachmentCache
+from .config import ClusterConfig, SmokeConfig
+from .limiter import AimdLimiter
+from .run_store import Failure, RunStore
+from . import send as snd
+from . import tracing
+
+RunSummary = namedtuple(
+    "RunSummary",
+    ["sent", "send_failures", "traced", "trace_failures", "seconds"])
+"""The outcome of a smoke test run."""
+
+
+def new_run_id() -> str:
+    """Get the ID of a new run: the time it started, and a random suffix in
+    case two runs start at once."""
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(2)}"
+
+
+async def run_smoke_test(cfg: SmokeConfig,
+                         clusters: Dict[str, ClusterConfig],
+                         messages: Iterator[snd.Outgoing],
+                         run_id: str,
+                         limiters: Dict[str, AimdLimiter] = None,
+                         client: tracing.LogAnalyticsClient = None,
+                         store: RunStore = None) -> RunSummary:
+    """Send messages through clusters and trace them, logging failures.
+
+    Messages are only traced if log analytics is configured.
+
+    Args:
+        cfg (SmokeConfig): The plugin config.
+        clusters (Dict[str, ClusterConfig]): The clusters to test, by name.
+        messages (Iterator[Outgoing]): The messages to send.
+        run_id (str): The ID of the run.
+        limiters (Dict[str, AimdLimiter]): The concurrency limiters of the
+            clusters, see send_all().
+        client (LogAnalyticsClient): The client to trace with. Defaults to
+            one from tracing.create_client().
+        store (RunStore): If given, record the templated specs and the result
+            of each stage in this store. The run must already be started.
+
+    Raises:
+        ImportError: If the default client needs a dependency that isn't
+            installed. This is raised before any messages are sent.
+
+    Returns:
+        RunSummary: The outcome of the run.
+    """
+    if cfg.log_analytics is not None and client is None:
+        client = tracing.create_client(cfg.log_analytics)
+    start = time.perf_counter()
+    rendered: Dict[int, snd.Outgoing] = {}
+
+    def record_rendered(
+            messages: Iterator[snd.Outgoing]) -> Iterator[snd.Outgoing]:
+        # this runs on the rendering thread, so the specs are only written to
+        # the store from the event loop as their results come in
+        for outgoing in messages:
+            rendered[outgoing.number] = outgoing
+            yield outgoing
+
+    if store is not None:
+        messages = record_rendered(messages)
+
+    accepted: Dict[str, snd.SendResult] = {}
+    send_failures = 0
+    async for result in snd.send_all(messages, clusters, run_id, limiters):
+        if store is not None:
+            outgoing = rendered.pop(result.number, None)
+            if outgoing is not None:
+                store.add_spec(run_id, outgoing.number, outgoing.spec_name,
+                               outgoing.seed, outgoing.templated,
+                               outgoing.origin)
+            store.add_result(run_id, result.number, result.cluster, "send",
+                             result.from_address, result.message_id,
+                             error=result.error,
+                             seconds=result.seconds)
+        if result.error is None:
+            accepted[result.from_address] = result
+        else:
+            send_failures += 1
+            logging.error(f"Sending '{result.spec_name}' message "
+                          f"{result.number} through {result.cluster} "
+                          f"failed: {result.error}")
+
+    if store is not None:
+        store.commit()
+
+    traced = trace_failures = 0
+    if cfg.log_analytics is not None and accepted:
+        success_statuses = set(cfg.log_analytics.success_statuses)
+        async for trace_result in tracing.trace(accepted, cfg.log_analytics,
+                                                client):
+            sent = accepted[trace_result.from_address]
+            error = None
+            if trace_result.transaction_id is None:
+                error = "never traced"
+            elif trace_result.status not in success_statuses:
+                error = f"transaction {trace_result.transaction_id} is " \
+                    f"{trace_result.status}"
+
+            if error is None:
+                traced += 1
+                logging.debug(f"'{sent.spec_name}' message {sent.number} "
+                              f"through {sent.cluster} succeeded: "
+                              f"transaction {trace_result.transaction_id}")
+            else:
+                trace_failures += 1
+                logging.error(f"'{sent.spec_name}' message {sent.number} "
+                              f"through {sent.cluster} failed: {error}")
+            if store is not None:
+                store.add_result(run_id, sent.number, sent.cluster, "trace",
+                                 sent.from_address, sent.message_id,
+                                 trace_result.transaction_id,
+                                 trace_result.status, error)
+        if store is not None:
+            store.commit()
+
+    return RunSummary(len(accepted), send_failures, traced, trace_failures,
+                      time.perf_counter() - start)
+
+
+def _replayed(cfg: SmokeConfig,
+              failures: List[Tuple[int, Failure]]) -> Iterator[snd.Outgoing]:
+    """Load failed messages to replay, renumbering them for the replay."""
+    attachment_cache = EncodedAttachmentCache.from_config(cfg)
+    for number, failure in failures:
+        outgoing = snd.outgoing_from_templated(number, failure.spec_name,
+                                               failure.seed,
+                                               failure.templated,
+                                               attachment_cache)
+        yield outgoing._replace(origin=(failure.origin_run_id,
+                                        failure.origin_number))
+
+
+async def replay_failures(cfg: SmokeConfig,
+                          failures: List[Failure],
+                          run_id: str,
+                          client: tracing.LogAnalyticsClient = None,
+                          store: RunStore = None) -> RunSummary:
+    """Replay failed messages through the clusters they failed in.
+
+    Every cluster is replayed at the same time, each as its own smoke test.
+    Messages are numbered afresh in the replay, so messages from different
+    runs can be replayed together.
+
+    Args:
+        cfg (SmokeConfig): The plugin config.
+        failures (List[Failure]): The failed messages to replay.
+        run_id (str): The ID of the replay run.
+        client (LogAnalyticsClient): The client to trace with. Defaults to
+            one from tracing.create_client().
+        store (RunStore): If given, record the replay in this store. The run
+            must already be started.
+
+    Raises:
+        ValueError: If a failure is from a cluster that isn't configured.
+        ImportError: If the default client needs a dependency that isn't
+            installed.
+
+    Returns:
+        RunSummary: The outcome of the replay, across every cluster.
+    """
+    by_cluster = defaultdict(list)
+    for number, failure in enumerate(failures):
+        if failure.cluster not in cfg.clusters:
+            raise ValueError(f"cluster '{failure.cluster}' is not configured")
+        by_cluster[failure.cluster].append((number, failure))
+    if cfg.log_analytics is not None and client is None:
+        # shared by every cluster
+        client = tracing.create_client(cfg.log_analytics)
+
+    summaries = await asyncio.gather(*(run_smoke_test(
+        cfg, {cluster: cfg.clusters[cluster]},
+        _replayed(cfg, cluster_failures),
+        run_id,
+        client=client,
+        store=store) for cluster, cluster_failures in by_cluster.items()))
+    return RunSummary(sum(summary.sent for summary in summaries),
+                      sum(summary.send_failures for summary in summaries),
+                      sum(summary.traced for summary in summaries),
+                      sum(summary.trace_failures for summary in summaries),
+                      max((summary.seconds for summary in summaries),
+                          default=0.0))
@@ -0,0 +1,317 @@
+"""run_store.py
+
+RunStore records every smoke test run in a SQLite database: the templated spec
+and seed of each message, and the result of sending and tracing it through
+each cluster. Failed messages can then be selected and replayed.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+import json
+import os
+from os import path
+import sqlite3
+from typing import List, Optional, Tuple
+
+import appdirs
+
+from .index_cache import APP_AUTHOR, APP_NAME
+
+DEFAULT_STORE_NAME = "runs.sqlite3"
+"""The default filename of the run store."""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started TEXT NOT NULL,
+    run_seed INTEGER,
+    clusters TEXT NOT NULL,
+    replay_of TEXT,
+    frozen_time TEXT
+);
+CREATE TABLE IF NOT EXISTS specs (
+    run_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    spec_name TEXT NOT NULL,
+    seed INTEGER,
+    templated TEXT NOT NULL,
+    origin_run_id TEXT,
+    origin_number INTEGER,
+    PRIMARY KEY (run_id, number)
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    cluster TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    from_address TEXT,
+    message_id TEXT,
+    transaction_id TEXT,
+    status TEXT,
+    error TEXT,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS results_by_run ON results (run_id, cluster);
+CREATE INDEX IF NOT EXISTS failures_by_run ON results (run_id, cluster)
+    WHERE error IS NOT NULL;
+CREATE INDEX IF NOT EXISTS specs_by_origin
+    ON specs (origin_run_id, origin_number);
+"""
+"""The schema of the store. Rows are only ever appended."""
+
+MIGRATIONS = [
+    ("specs", "origin_run_id", "TEXT", None),
+    ("specs", "origin_number", "INTEGER",
+     "UPDATE specs SET origin_run_id = run_id, origin_number = number"),
+    ("runs", "frozen_time", "TEXT", None),
+]
+"""The columns added to the schema since the store was first released, with
+the statement backfilling them, if any, as (table, column, type, backfill)."""
+
+FAILURES_QUERY = """
+WITH attempts AS (
+    SELECT s.origin_run_id, s.origin_number, r.cluster, runs.started,
+        r.run_id, MAX(r.error IS NOT NULL) AS failed
+    FROM results r
+    JOIN specs s ON s.run_id = r.run_id AND s.number = r.number
+    JOIN runs ON runs.run_id = r.run_id
+    GROUP BY r.run_id, r.number, r.cluster
+)
+SELECT r.run_id, r.number, r.cluster, r.stage, r.error, s.spec_name, s.seed,
+    s.templated, s.origin_run_id, s.origin_number
+FROM results r
+JOIN specs s ON s.run_id = r.run_id AND s.number = r.number
+JOIN runs ON runs.run_id = r.run_id
+WHERE {conditions}
+    AND r.rowid = (
+        SELECT MIN(f.rowid) FROM results f
+        WHERE f.run_id = r.run_id AND f.number = r.number
+            AND f.cluster = r.cluster AND f.error IS NOT NULL)
+    AND NOT EXISTS (
+        SELECT 1 FROM attempts a
+        WHERE a.origin_run_id = s.origin_run_id
+            AND a.origin_number = s.origin_number
+            AND a.cluster = r.cluster
+            AND (a.started, a.run_id) > (runs.started, runs.run_id)
+            AND {later_attempts})
+ORDER BY r.run_id, r.number, r.cluster
+"""
+"""Selects the first failed stage of each message in each cluster, unless the
+message was replayed in that cluster later."""
+
+Run = namedtuple(
+    "Run",
+    ["run_id", "started", "run_seed", "clusters", "replay_of", "frozen_time"])
+"""A smoke test run. 'frozen_time' is the time its templates were rendered
+at, if the time was frozen."""
+
+Failure = namedtuple("Failure", [
+    "run_id", "number", "cluster", "stage", "error", "spec_name", "seed",
+    "templated", "origin_run_id", "origin_number"
+])
+"""A message that failed to send or trace through a cluster, with the spec it
+was rendered from. 'origin_run_id' and 'origin_number' identify the message
+first rendered from the spec, if the failed message was a replay."""
+
+
+def get_store_loc() -> str:
+    """Get the default path to the run store."""
+    return path.join(appdirs.user_data_dir(APP_NAME, APP_AUTHOR),
+                     DEFAULT_STORE_NAME)
+
+
+class RunStore:
+    """RunStore is an append-only SQLite database of smoke test runs.
+
+    Writes aren't committed until commit() is called, so recording a result
+    is cheap enough to do for every message.
+
+    Attributes:
+        store_path (str): The path to the database.
+    """
+    def __init__(self, store_path: str = None) -> None:
+        """Open the store, creating it if it doesn't exist.
+
+        Args:
+            store_path (str): The path to the database. Defaults to a file in
+                the user data directory.
+        """
+        self.store_path = store_path or get_store_loc()
+        os.makedirs(path.dirname(self.store_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(self.store_path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._migrate()
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self) -> "RunStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _migrate(self) -> None:
+        """Add any columns missing from a store created by an older version.
+        """
+        for table, column, column_type, backfill in MIGRATIONS:
+            columns = [
+                row[1] for row in self._db.execute(
+                    f"PRAGMA table_info({table})")
+            ]
+            if not columns or column in columns:
+                continue
+            self._db.execute(
+                f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            if backfill is not None:
+                self._db.execute(backfill)
+        self._db.commit()
+
+    def start_run(self,
+                  run_id: str,
+                  clusters: List[str],
+                  run_seed: int = None,
+                  replay_of: str = None,
+                  now: datetime = None) -> None:
+        """Record the start of a run.
+
+        Args:
+            run_id (str): The ID of the run.
+            clusters (List[str]): The clusters tested.
+            run_seed (int): The seed of the run, if any.
+            replay_of (str): The run replayed by this run, if any.
+            now (datetime): The time the run's templates were frozen at, if
+                any.
+        """
+        self._db.execute(
+            "INSERT INTO runs (run_id, started, run_seed, clusters, "
+            "replay_of, frozen_time) VALUES (?, ?, ?, ?, ?, ?)",
+            (run_id, datetime.now(timezone.utc).isoformat(), run_seed,
+             json.dumps(clusters), replay_of,
+             None if now is None else now.isoformat()))
+        self._db.commit()
+
+    def run(self, run_id: str) -> Optional[Run]:
+        """Get a run by its ID, or None if there's no such run."""
+        row = self._db.execute(
+            "SELECT run_id, started, run_seed, clusters, replay_of, "
+            "frozen_time FROM runs WHERE run_id = ?", (run_id, )).fetchone()
+        if row is None:
+            return None
+        run_id, started, run_seed, clusters, replay_of, frozen_time = row
+        return Run(
+            run_id, started, run_seed, json.loads(clusters), replay_of,
+            None
+            if frozen_time is None else datetime.fromisoformat(frozen_time))
+
+    def add_spec(self,
+                 run_id: str,
+                 number: int,
+                 spec_name: str,
+                 seed: Optional[int],
+                 templated: str,
+                 origin: Tuple[str, int] = None) -> None:
+        """Record the templated spec of a message, if it isn't already.
+
+        Args:
+            run_id (str): The ID of the run.
+            number (int): The number of the message in the run.
+            spec_name (str): The name of the spec the message was rendered
+                from.
+            seed (int): The seed the message was rendered with, if any.
+            templated (str): The templated spec.
+            origin (Tuple[str, int]): If the message is a replay, the run ID
+                and number of the message first rendered from the spec.
+        """
+        origin_run_id, origin_number = origin or (run_id, number)
+        self._db.execute(
+            "INSERT OR IGNORE INTO specs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (run_id, number, spec_name, seed, templated, origin_run_id,
+             origin_number))
+
+    def add_result(self,
+                   run_id: str,
+                   number: int,
+                   cluster: str,
+                   stage: str,
+                   from_address: str = None,
+                   message_id: str = None,
+                   transaction_id: str = None,
+                   status: str = None,
+                   error: str = None,
+                   seconds: float = None) -> None:
+        """Record the result of a stage of the smoke test for a message.
+
+        Args:
+            run_id (str): The ID of the run.
+            number (int): The number of the message in the run.
+            cluster (str): The cluster the message was sent through.
+            stage (str): The stage, 'send' or 'trace'.
+            from_address (str): The unique From address of the message.
+            message_id (str): The Message-ID of the message.
+            transaction_id (str): The ID of the message's transaction.
+            status (str): The status of the transaction.
+            error (str): Why the stage failed, or None if it succeeded.
+            seconds (float): How long the stage took.
+        """
+        self._db.execute(
+            "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run_id, number, cluster, stage, from_address, message_id,
+             transaction_id, status, error, seconds))
+
+    def failures(self,
+                 run_id: str = None,
+                 cluster: str = None,
+                 error: str = None) -> List[Failure]:
+        """Select the messages that failed.
+
+        Failures that a later run replayed successfully are left out. Without
+        a run ID, a message that failed again when replayed is only selected
+        from its latest replay, so each failed message is selected once.
+
+        Args:
+            run_id (str): If given, only select failures from this run.
+            cluster (str): If given, only select failures in this cluster.
+            error (str): If given, only select failures whose error contains
+                this.
+
+        Returns:
+            List[Failure]: Each failed message, once per run and cluster,
+                with the error of the first stage that failed.
+        """
+        conditions = ["r.error IS NOT NULL"]
+        params = []
+        if run_id is not None:
+            conditions.append("r.run_id = ?")
+            params.append(run_id)
+        if cluster is not None:
+            conditions.append("r.cluster = ?")
+            params.append(cluster)
+        if error is not None:
+            conditions.append("instr(r.error, ?) > 0")
+            params.append(error)
+        later_attempts = "a.failed = 0" if run_id is not None else "1"
+        rows = self._db.execute(
+            FAILURES_QUERY.format(conditions=" AND ".join(conditions),
+                                  later_attempts=later_attempts), params)
+        return [Failure(*row) for row in rows]
+
+    def runs(self) -> List[tuple]:
+        """Get every run, as (run_id, started, clusters, failures) tuples,
+        most recent first."""
+        return [(run_id, started, json.loads(clusters), failures)
+                for run_id, started, clusters, failures in self._db.execute(
+                    "SELECT runs.run_id, started, clusters, "
+                    "(SELECT COUNT(*) FROM results "
+                    "WHERE results.run_id = runs.run_id "
+                    "AND error IS NOT NULL) "
+                    "FROM runs ORDER BY started DESC")]
+
+    def commit(self) -> None:
+        """Commit everything recorded so far."""
+        self._db.commit()
+
+    def close(self) -> None:
+        """Commit and close the store."""
+        self._db.commit()
+        self._db.close()
@@ -0,0 +1,101 @@
+"""sampling.py
+
+Functions for randomly sampling from streams of items without materialising
+them, used to pick attachments from libraries.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import heapq
+from itertools import islice
+import math
+import random
+from typing import Callable, Iterable, List, TypeVar
+
+T = TypeVar("T")
+
+
+def _random_open(rng: random.Random) -> float:
+    """Get a random float in the open interval (0, 1)."""
+    value = rng.random()
+    while value == 0.0:
+        value = rng.random()
+    return value
+
+
+def reservoir_sample(items: Iterable[T], count: int,
+                     rng: random.Random) -> List[T]:
+    """Uniformly sample items from a stream of unknown length.
+
+    Uses Algorithm L, which skips over items in geometrically distributed
+    jumps, so only O(count * log(n / count)) random numbers are drawn.
+
+    Args:
+        items (Iterable[T]): The items to sample from.
+        count (int): The number of items to sample.
+        rng (random.Random): The random number generator to use.
+
+    Raises:
+        ValueError: If there are fewer items than count.
+
+    Returns:
+        List[T]: The sampled items.
+    """
+    iterator = iter(items)
+    reservoir = list(islice(iterator, count))
+    if len(reservoir) < count:
+        raise ValueError("Sample larger than population")
+    if count == 0:
+        return reservoir
+
+    w = math.exp(math.log(_random_open(rng)) / count)
+    while True:
+        skip = math.floor(math.log(_random_open(rng)) / math.log(1 - w))
+        try:
+            item = next(islice(iterator, skip, None))
+        except StopIteration:
+            return reservoir
+        reservoir[rng.randrange(count)] = item
+        w *= math.exp(math.log(_random_open(rng)) / count)
+
+
+def weighted_sample(items: Iterable[T], weight: Callable[[T], float],
+                    count: int, rng: random.Random) -> List[T]:
+    """Sample items from a stream without replacement, with the probability of
+    picking each item proportional to its weight.
+
+    Uses the A-Res algorithm: each item gets a random key based on its weight
+    and the items with the largest keys are kept in a heap of size count.
+    Items with a weight of 0 or less are never picked.
+
+    Args:
+        items (Iterable[T]): The items to sample from.
+        weight (Callable[[T], float]): Function to get the weight of an item.
+        count (int): The number of items to sample.
+        rng (random.Random): The random number generator to use.
+
+    Raises:
+        ValueError: If there are fewer items with a positive weight than
+            count.
+
+    Returns:
+        List[T]: The sampled items, highest key first.
+    """
+    if count <= 0:
+        return []
+    heap = []
+    for i, item in enumerate(items):
+        item_weight = weight(item)
+        if item_weight <= 0:
+            continue
+        # log(u) / w is a monotonic transform of u^(1/w), and doesn't
+        # underflow for small weights
+        key = math.log(_random_open(rng)) / item_weight
+        entry = (key, i, item)
+        if len(heap) < count:
+            heapq.heappush(heap, entry)
+        elif key > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+    if len(heap) < count:
+        raise ValueError("Sample larger than population")
+    return [item for _, _, item in sorted(heap, reverse=True)]
@@ -0,0 +1,394 @@
+"""send.py
+
+The send engine of the smoke test. Messages are rendered once and sent through
+every cluster at the same time, each over a pool of persistent SMTP
+connections, with a unique From address per cluster so the transaction can be
+found later. The number of messages in flight to each cluster adapts to how
+quickly the cluster accepts them.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.utils import format_datetime, formataddr, formatdate, make_msgid
+import time
+from typing import AsyncIterator, Dict, Iterator, List
+
+import aiosmtplib
+
+from .attachment_cache import EncodedAttachmentCache
+from .attachments import AttachmentLibrary
+from .batch import boundary, derive_seed
+from .config import ClusterConfig, SmokeConfig
+from .limiter import AimdLimiter
+from . import profiling
+from . import spec as spc
+from . import template as tmpl
+
+Outgoing = namedtuple("Outgoing", [
+    "number", "spec_name", "seed", "templated", "message", "sender",
+    "recipients", "origin", "date"
+], defaults=[None, None])
+"""A rendered message waiting to be sent through every cluster. 'templated'
+is the templated spec, 'message' the SerializedMessage, 'sender' the spec's
+From address and 'recipients' the envelope recipients. 'origin' is the run ID
+and number of the message being replayed, if the message is a replay. 'date'
+is the Date to send the message with when the run's time is frozen, otherwise
+the Date is the time the message is sent through each cluster."""
+
+SendResult = namedtuple("SendResult", [
+    "cluster", "number", "spec_name", "seed", "from_address", "message_id",
+    "error", "seconds"
+])
+"""The result of sending a message through a cluster. 'error' is None if the
+message was accepted."""
+
+SEND_ERRORS = (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError)
+"""The errors that fail a single send, rather than the whole run."""
+
+
+def unique_sender(run_id: str, cluster: str, number: int,
+                  domain: str) -> str:
+    """Get the unique From address of a message sent through a cluster, used
+    to find its transaction later."""
+    return f"smoke-{run_id}-{cluster}-{number}@{domain}"
+
+
+class PooledConnection:
+    """An SMTP connection belonging to a pool.
+
+    Attributes:
+        smtp (aiosmtplib.SMTP): The SMTP client.
+        sent (int): The number of messages sent over the connection.
+    """
+    def __init__(self, smtp: aiosmtplib.SMTP) -> None:
+        self.smtp = smtp
+        self.sent = 0
+
+    async def close(self) -> None:
+        """Close the connection, politely if possible."""
+        try:
+            await self.smtp.quit()
+        except SEND_ERRORS:
+            self.smtp.close()
+
+
+class SmtpPool:
+    """SmtpPool keeps a set of persistent SMTP connections open to a cluster,
+    so that many messages are sent over each connection rather than paying
+    for a connection and handshake per message.
+
+    At most 'connections' connections are open at once, which bounds the
+    number of messages in flight to the cluster. Connections are reopened after
+    sending 'messages_per_connection' messages, or after an error.
+
+    Attributes:
+        cluster (ClusterConfig): The cluster to connect to.
+        opened (int): The number of connections opened so far.
+    """
+    def __init__(self, cluster: ClusterConfig) -> None:
+        self.cluster = cluster
+        self.opened = 0
+        self._slots = asyncio.Semaphore(cluster.connections)
+        self._idle: List[PooledConnection] = []
+
+    async def _connect(self) -> PooledConnection:
+        smtp = aiosmtplib.SMTP(hostname=self.cluster.smtp_host,
+                               port=self.cluster.smtp_port,
+                               use_tls=self.cluster.use_tls,
+                               timeout=self.cluster.timeout)
+        with profiling.timed("send.connect"):
+            await smtp.connect()
+        self.opened += 1
+        profiling.count("send.connections")
+        return PooledConnection(smtp)
+
+    async def acquire(self) -> PooledConnection:
+        """Take a connection from the pool, waiting for one to be free if the
+        pool is at its limit and opening a new one if none are idle."""
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                connection = self._idle.pop()
+                if connection.smtp.is_connected:
+                    return connection
+            return await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, connection: PooledConnection,
+                      reuse: bool = True) -> None:
+        """Return a connection to the pool.
+
+        Args:
+            connection (PooledConnection): The connection.
+            reuse (bool): False if the connection shouldn't be used again,
+                i.e. after an error.
+        """
+        try:
+            if reuse and connection.smtp.is_connected and \
+                    connection.sent < self.cluster.messages_per_connection:
+                self._idle.append(connection)
+            else:
+                await connection.close()
+        finally:
+            self._slots.release()
+
+    async def send(self, sender: str, recipients: List[str],
+                   message: bytes) -> None:
+        """Send a message over one of the pool's connections.
+
+        Raises:
+            aiosmtplib.SMTPException: If the message wasn't accepted.
+        """
+        connection = await self.acquire()
+        reuse = False
+        try:
+            await connection.smtp.sendmail(sender, recipients, message)
+            connection.sent += 1
+            reuse = True
+        finally:
+            await self.release(connection, reuse)
+
+    async def close(self) -> None:
+        """Close every idle connection."""
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(connection.close() for connection in idle))
+
+
+def render_outgoing(cfg: SmokeConfig,
+                    spec_files: List[str],
+                    count: int,
+                    run_seed: int = None,
+                    now: datetime = None) -> Iterator[Outgoing]:
+    """Render the messages of a smoke test.
+
+    Messages are numbered and seeded in the same way as a batch render, so a
+    message can be reproduced from the run seed and its number.
+
+    Args:
+        cfg (SmokeConfig): The plugin config.
+        spec_files (List[str]): The spec files to render.
+        count (int): How many messages to render from each spec.
+        run_seed (int): If given, the seed to derive each message's seed
+            from.
+        now (datetime): If given, freeze the time that templates see.
+
+    Yields:
+        Outgoing: Each rendered message.
+    """
+    library = AttachmentLibrary.from_config(cfg)
+    attachment_cache = EncodedAttachmentCache.from_config(cfg)
+    templates = []
+    for spec_file in spec_files:
+        with open(spec_file, "r") as spec_file_handle:
+            templates.append(tmpl.compile_template(spec_file_handle.read()))
+
+    for spec_index, (spec_file,
+                     template) in enumerate(zip(spec_files, templates)):
+        for i in range(count):
+            number = spec_index * count + i
+            seed = None if run_seed is None else derive_seed(run_seed, number)
+            rendered = tmpl.render_structured(template,
+                                              library,
+                                              seed=seed,
+                                              now=now)
+            outgoing = outgoing_from_spec(number, spec_file, seed,
+                                          rendered.text, spc.load(rendered),
+                                          attachment_cache)
+            if now is not None:
+                outgoing = outgoing._replace(date=format_datetime(now))
+            yield outgoing
+
+
+def outgoing_from_templated(number: int,
+                            spec_name: str,
+                            seed: int,
+                            templated: str,
+                            attachment_cache: EncodedAttachmentCache = None
+                            ) -> Outgoing:
+    """Load a templated spec into a message ready to send.
+
+    Args:
+        number (int): The number of the message in the run.
+        spec_name (str): The name of the spec the message was rendered from.
+        seed (int): The seed the message was rendered with, if any.
+        templated (str): The templated spec.
+        attachment_cache (EncodedAttachmentCache): If given, the cache to
+            splice encoded attachments in from.
+
+    Returns:
+        Outgoing: The message.
+    """
+    return outgoing_from_spec(number, spec_name, seed, templated,
+                              spc.parse(templated), attachment_cache)
+
+
+def outgoing_from_spec(number: int,
+                       spec_name: str,
+                       seed: int,
+                       templated: str,
+                       spec: spc.Spec,
+                       attachment_cache: EncodedAttachmentCache = None
+                       ) -> Outgoing:
+    """Serialize a loaded spec into a message ready to send, see
+    outgoing_from_templated().
+
+    Args:
+        spec (Spec): The spec, loaded from the templated spec.
+    """
+    headers = spec.headers
+    recipients = [
+        address.email for field in ("to", "cc", "bcc")
+        for address in headers.get(field) or []
+    ]
+    message = spec.serialize(boundary=None if seed is None else boundary(seed),
+                             linesep="\r\n",
+                             cache=attachment_cache)
+    return Outgoing(number, spec_name, seed, templated, message,
+                    headers["from_addresses"][0], recipients)
+
+
+def cluster_limiter(cluster: ClusterConfig) -> AimdLimiter:
+    """Create the concurrency limiter of a cluster from its config."""
+    return AimdLimiter(cluster.min_connections, cluster.connections,
+                       cluster.initial_connections, cluster.target_latency)
+
+
+async def send_one(pool: SmtpPool, limiter: AimdLimiter, cluster: str,
+                   outgoing: Outgoing, run_id: str) -> SendResult:
+    """Send a message through a cluster with a unique From address, in the
+    domain of the spec's From address.
+
+    Args:
+        pool (SmtpPool): The cluster's connection pool.
+        limiter (AimdLimiter): The cluster's concurrency limiter.
+        cluster (str): The name of the cluster.
+        outgoing (Outgoing): The message.
+        run_id (str): The ID of the run.
+
+    Returns:
+        SendResult: The result of the send.
+    """
+    domain = outgoing.sender.email.rpartition("@")[2]
+    sender = unique_sender(run_id, cluster, outgoing.number, domain)
+    message_id = make_msgid(f"{run_id}.{cluster}.{outgoing.number}", domain)
+    # aiosmtplib normalises line endings and dot-stuffs the whole message as a
+    # single bytes object during DATA, so the header block and the shared
+    # payload are joined here rather than written out as separate buffers
+    message = outgoing.message.as_bytes({
+        "From": formataddr((outgoing.sender.name, sender)),
+        "Message-ID": message_id,
+        "Date": outgoing.date or formatdate(localtime=True)
+    })
+    error = None
+    await limiter.acquire()
+    start = time.perf_counter()
+    try:
+        with profiling.timed("send"):
+            await pool.send(sender, outgoing.recipients, message)
+    except SEND_ERRORS as err:
+        error = str(err) or type(err).__name__
+    finally:
+        seconds = time.perf_counter() - start
+        await limiter.release(seconds, error is not None)
+    if error is None:
+        profiling.count("send.messages")
+        profiling.count("send.bytes", len(message))
+    else:
+        profiling.count("send.failures")
+    return SendResult(cluster, outgoing.number, outgoing.spec_name,
+                      outgoing.seed, sender, message_id, error, seconds)
+
+
+async def send_all(messages: Iterator[Outgoing],
+                   clusters: Dict[str, ClusterConfig],
+                   run_id: str,
+                   limiters: Dict[str, AimdLimiter] = None
+                   ) -> AsyncIterator[SendResult]:
+    """Send messages through every cluster, yielding the results as they
+    complete.
+
+    Messages are taken from the iterator (rendering them) on a separate
+    thread, so rendering overlaps with sending. Each cluster's limiter decides
+    how many messages are in flight to it, and each cluster has a queue of
+    messages waiting to be sent no longer than its maximum connections.
+    Rendering waits for room in every cluster's queue, so it never runs far
+    ahead of the slowest cluster.
+
+    Args:
+        messages (Iterator[Outgoing]): The messages to send.
+        clusters (Dict[str, ClusterConfig]): The clusters to send through, by
+            name.
+        run_id (str): The ID of the run, used in the unique From addresses.
+        limiters (Dict[str, AimdLimiter]): The concurrency limiters of the
+            clusters, by name. Created from the cluster configs if not given.
+
+    Yields:
+        SendResult: The result of each send.
+    """
+    loop = asyncio.get_running_loop()
+    pools = {name: SmtpPool(cluster) for name, cluster in clusters.items()}
+    if limiters is None:
+        limiters = {}
+    for name, cluster in clusters.items():
+        if name not in limiters:
+            limiters[name] = cluster_limiter(cluster)
+    queues = {
+        name: asyncio.Queue(maxsize=cluster.connections)
+        for name, cluster in clusters.items()
+    }
+    results: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def produce() -> None:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                outgoing = await loop.run_in_executor(executor, next,
+                                                      messages, None)
+                if outgoing is None:
+                    break
+                for queue in queues.values():
+                    await queue.put(outgoing)
+        for name, queue in queues.items():
+            for _ in range(clusters[name].connections):
+                await queue.put(None)
+
+    async def consume(name: str) -> None:
+        while True:
+            outgoing = await queues[name].get()
+            if outgoing is None:
+                return
+            results.put_nowait(await send_one(pools[name], limiters[name],
+                                              name, outgoing, run_id))
+
+    tasks = [asyncio.ensure_future(produce())]
+    for name, cluster in clusters.items():
+        tasks.extend(
+            asyncio.ensure_future(consume(name))
+            for _ in range(cluster.connections))
+
+    async def finish() -> None:
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            results.put_nowait(done)
+
+    finisher = asyncio.ensure_future(finish())
+    try:
+        while True:
+            result = await results.get()
+            if result is done:
+                break
+            yield result
+        # raise any error from rendering
+        await finisher
+    finally:
+        for task in tasks + [finisher]:
+            task.cancel()
+        await asyncio.gather(*(pool.close() for pool in pools.values()),
+                             return_exceptions=True)
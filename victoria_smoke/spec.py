@@ -1,13 +1,17 @@
+from collections import namedtuple
 from datetime import datetime
 from email import message
 from email.mime.text import MIMEText
-from typing import List
+from typing import BinaryIO, List, Optional
 
 from marshmallow import Schema, fields, post_load, INCLUDE
 from sremail.message import MessageHeadersSchema, Message, MESSAGE_HEADERS_SCHEMA
 import yaml
 
+from .attachment_cache import EncodedAttachmentCache
 from .attachments import AttachmentLibrary
+from .mime_writer import MimeWriter, SerializedMessage
+from . import profiling
 from . import template
 
 
@@ -23,10 +27,31 @@ class SpecSchema(Schema):
 
 SPEC_SCHEMA = SpecSchema()
 
+try:
+    # libyaml's loader is much quicker, if PyYAML was built with it
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+ArrayRef = namedtuple("ArrayRef", ["index"])
+"""A placeholder for an array kept out of the text of a structured render."""
+
+
+class SpecLoader(_SafeLoader):
+    """The YAML loader of specs, which loads array placeholders from a
+    structured render as ArrayRefs."""
+    pass
+
+
+SpecLoader.add_constructor(
+    template.ARRAY_TAG,
+    lambda loader, node: ArrayRef(int(loader.construct_scalar(node))))
+
 
 class Spec:
     def __init__(self, headers: dict, body: str, attach: List[str]) -> None:
-        self.headers = MESSAGE_HEADERS_SCHEMA.load(headers)
+        with profiling.timed("spec.load.headers"):
+            self.headers = MESSAGE_HEADERS_SCHEMA.load(headers)
         self.body = body
         self.attach = attach
 
@@ -36,17 +61,151 @@ class Spec:
             msg.attach(attachment)
         return msg
 
-    def as_mime(self) -> message.Message:
-        msg = self.as_message()
-        mime = msg.as_mime()
-        body_part = MIMEText(self.body, "plain")
-        mime.attach(body_part)
-        mime["Date"] = datetime.fromisoformat(
-            mime["Date"]).strftime("%a, %d %b %Y %H:%M:%S %z")
-        return mime
+    def as_mime(self, boundary: str = None) -> message.Message:
+        with profiling.timed("mime.build"):
+            msg = self.as_message()
+            mime = msg.as_mime()
+            if boundary is not None:
+                # the boundary is random by default, so set it for
+                # reproducibility
+                mime.set_boundary(boundary)
+            body_part = MIMEText(self.body, "plain")
+            mime.attach(body_part)
+            _format_date(mime)
+            return mime
+
+    def write_mime(self,
+                   stream: BinaryIO,
+                   boundary: str = None,
+                   linesep: str = "\n",
+                   cache: Optional[EncodedAttachmentCache] = None) -> int:
+        """Write the spec as MIME to a stream, without building the whole
+        message in memory first.
+
+        Attachments are encoded straight from their files a chunk at a time,
+        so memory use doesn't depend on how large they are.
+
+        Args:
+            stream (BinaryIO): The stream to write to, like a file opened in
+                binary mode or socket.makefile("wb").
+            boundary (str): The boundary between parts. Defaults to a random
+                boundary.
+            linesep (str): The line separator, use "\\r\\n" for SMTP.
+            cache (EncodedAttachmentCache): If given, splice attachments in
+                from this cache rather than encoding them every time.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        with profiling.timed("mime.write"):
+            headers = Message(**self.headers).as_mime()
+            _format_date(headers)
+            writer = MimeWriter(stream, boundary, linesep, cache)
+            writer.write_headers(headers)
+            for attachment in self.attach:
+                writer.write_attachment(attachment)
+            writer.write_part(MIMEText(self.body, "plain"))
+            writer.close()
+        profiling.count("mime.bytes", writer.bytes_written)
+        return writer.bytes_written
+
+    def serialize(
+            self,
+            boundary: str = None,
+            linesep: str = "\n",
+            cache: Optional[EncodedAttachmentCache] = None
+    ) -> SerializedMessage:
+        """Serialize the body and attachments of the spec once, so it can be
+        written many times with only some headers changed, i.e. with a unique
+        From address for each cluster.
+
+        Args:
+            boundary (str): The boundary between parts. Defaults to a random
+                boundary.
+            linesep (str): The line separator, use "\\r\\n" for SMTP.
+            cache (EncodedAttachmentCache): If given, splice attachments in
+                from this cache rather than encoding them.
+
+        Returns:
+            SerializedMessage: The serialized spec.
+        """
+        with profiling.timed("mime.serialize"):
+            headers = Message(**self.headers).as_mime()
+            _format_date(headers)
+            return SerializedMessage.build(headers,
+                                           [MIMEText(self.body, "plain")],
+                                           self.attach, boundary, linesep,
+                                           cache)
+
+
+def _format_date(mime: message.Message) -> None:
+    """Make sure the Date header of a message is formatted for MIME."""
+    try:
+        mime.replace_header(
+            "Date",
+            datetime.fromisoformat(
+                mime["Date"]).strftime("%a, %d %b %Y %H:%M:%S %z"))
+    except ValueError:
+        # newer versions of sremail already format the date for MIME
+        pass
 
 
 def from_yaml(spec_yaml: str, attachment_library: AttachmentLibrary) -> Spec:
-    templated_yaml = template.process(spec_yaml, attachment_library)
-    raw_spec = yaml.safe_load(templated_yaml)
-    return SPEC_SCHEMA.load(raw_spec)
\ No newline at end of file
+    rendered = template.render_structured(
+        template.compile_template(spec_yaml), attachment_library)
+    return load(rendered)
+
+
+def parse(templated_yaml: str) -> Spec:
+    """Load a spec from YAML that has already been templated."""
+    with profiling.timed("spec.yaml"):
+        raw_spec = yaml.load(templated_yaml, Loader=SpecLoader)
+    with profiling.timed("spec.load"):
+        return SPEC_SCHEMA.load(raw_spec)
+
+
+def load(rendered: template.RenderedTemplate) -> Spec:
+    """Load a spec from a structured render.
+
+    The attachment arrays of the render are put straight into the spec, so
+    they're neither parsed from YAML nor validated again. If an array was
+    rendered anywhere other than the spec's attachments, the spec is parsed
+    from the rendered text instead.
+
+    Args:
+        rendered (RenderedTemplate): The spec, from render_structured().
+
+    Returns:
+        Spec: The loaded spec.
+    """
+    with profiling.timed("spec.yaml"):
+        raw_spec = yaml.load(rendered.source, Loader=SpecLoader)
+
+    attach = raw_spec.get("attach") if isinstance(raw_spec, dict) else None
+    if not isinstance(attach, list):
+        attach = []
+    refs = [item for item in attach if isinstance(item, ArrayRef)]
+    if len(refs) != len(rendered.arrays):
+        return parse(rendered.text)
+    if not refs:
+        with profiling.timed("spec.load"):
+            return SPEC_SCHEMA.load(raw_spec)
+
+    spliced = []
+    for item in attach:
+        if isinstance(item, ArrayRef):
+            spliced.extend(rendered.arrays[item.index])
+        else:
+            spliced.append(item)
+    if not spliced:
+        # the rendered text has no attachments at all, which isn't valid
+        return parse(rendered.text)
+
+    # only validate the attachments that were written in the spec itself
+    raw_spec["attach"] = [
+        item for item in attach if not isinstance(item, ArrayRef)
+    ]
+    with profiling.timed("spec.load"):
+        spec = SPEC_SCHEMA.load(raw_spec)
+    spec.attach = spliced
+    return spec
\ No newline at end of file
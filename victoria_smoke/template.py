@@ -1,23 +1,94 @@
+from collections import OrderedDict
+from contextvars import ContextVar
 from datetime import datetime
 import functools
+import hashlib
+import os
+from os import path
 import random
+import re
 import types
-from typing import List, Union, Iterable
+from typing import List, Optional, Union, Iterable
 import uuid
 
+import appdirs
 from faker import Faker
-from faker.providers import BaseProvider
-from jinja2 import Template, Environment, FunctionLoader
-
-from .attachments import AttachmentLibrary
-from .faker_text_provider import TextProvider
+from jinja2 import (Template, Environment, FunctionLoader,
+                    FileSystemBytecodeCache)
+
+from .attachments import AttachmentLibrary, AttachmentQuery, Weights
+from .faker_text_provider import ASCII_MODES
+from .index_cache import APP_NAME, APP_AUTHOR
+from . import faker_pool
+from . import profiling
 from . import util
 
+TEMPLATE_CACHE_SIZE = 256
+"""How many compiled templates to keep in memory."""
+
+_template_sources: OrderedDict = OrderedDict()
+"""The sources of compiled templates, keyed by the hash of the source."""
+
+_render_random: ContextVar = ContextVar("render_random", default=None)
+"""The random number generator of the seeded render in progress, if any."""
+
+_render_arrays: ContextVar = ContextVar("render_arrays", default=None)
+"""The arrays kept out of the text of the structured render in progress, if
+any."""
+
+ARRAY_TAG = "!victoria_smoke/array"
+"""The YAML tag of the placeholder to_array emits in a structured render."""
+
+_ARRAY_PLACEHOLDER = re.compile(rf"- {re.escape(ARRAY_TAG)} (\d+)")
+
+
+class SeededUUID:
+    """Stands in for the uuid module in seeded renders, so that uuid4() is
+    generated from the render's random number generator."""
+    def __init__(self, rng: random.Random) -> None:
+        self._rng = rng
+
+    def uuid4(self) -> uuid.UUID:
+        return uuid.UUID(int=self._rng.getrandbits(128), version=4)
+
+    def __getattr__(self, name: str):
+        return getattr(uuid, name)
+
+
+def frozen_datetime(now: datetime) -> type:
+    """Get a datetime class whose now() always returns a given time, so that
+    templates using it render the same every time."""
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now if tz is None else now.astimezone(tz)
+
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    return FrozenDatetime
+
+
+def _load_source(name: str):
+    """Load a template source by the hash of its source, for the Jinja loader.
+    A template never goes out of date, as a changed source has a new hash."""
+    source = _template_sources.get(name)
+    if source is None:
+        return None
+    return source, None, lambda: True
+
 
 def create_environment() -> Environment:
     """Create the Jinja environment containing the functionality to render
-    templates."""
-    env = Environment()
+    templates.
+
+    Templates are loaded by the hash of their source, so the environment's
+    LRU cache of compiled templates (and its bytecode cache, if enabled) is
+    keyed by the template contents.
+    """
+    env = Environment(loader=FunctionLoader(_load_source),
+                      cache_size=TEMPLATE_CACHE_SIZE)
 
     # define the filterfunc decorator and patch it into the environment
     # so we can define filters using a decorator
@@ -34,19 +105,54 @@ def create_environment() -> Environment:
 template_env = create_environment()
 
 
+def enable_bytecode_cache(directory: str = None) -> None:
+    """Cache compiled template bytecode on disk, so templates don't need to be
+    recompiled by each new process.
+
+    Args:
+        directory (str): The directory to store bytecode in. Defaults to a
+            directory in the user cache directory.
+    """
+    if directory is None:
+        directory = path.join(appdirs.user_cache_dir(APP_NAME, APP_AUTHOR),
+                              "templates")
+    os.makedirs(directory, exist_ok=True)
+    template_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
 def _emit_yaml_array(strs: List[str]) -> str:
     """Take a list of strings and convert them into YAML array format."""
     return "\n".join([f"- {s}" for s in strs])
 
 
+def _as_query(library, filter_name: str) -> AttachmentQuery:
+    """Get a lazy query for a library, so that chained filters are planned and
+    run together when the result is consumed."""
+    if type(library) == AttachmentLibrary:
+        return library.query()
+    elif type(library) == AttachmentQuery:
+        return library
+    raise TypeError(
+        f"Cannot use '{filter_name}' filter with type '{type(library).__name__}'"
+    )
+
+
 @template_env.filterfunc
 def to_array(library) -> str:
-    """Convert an Attachment library to a YAML array."""
-    if type(library) != AttachmentLibrary:
+    """Convert an Attachment library to a YAML array.
+
+    In a structured render, the paths are kept out of the text, which gets a
+    placeholder array with a single tagged item instead."""
+    if type(library) not in (AttachmentLibrary, AttachmentQuery):
         raise TypeError(
             f"Cannot use 'to_array' filter with type '{type(library).__name__}'"
         )
-    return _emit_yaml_array([item.path for item in library.index])
+    paths = [item.path for item in library]
+    arrays = _render_arrays.get()
+    if arrays is None:
+        return _emit_yaml_array(paths)
+    arrays.append(paths)
+    return f"- {ARRAY_TAG} {len(arrays) - 1}"
 
 
 @template_env.filterfunc
@@ -58,84 +164,181 @@ def collapse(iterable: Iterable, join="\n  ") -> str:
 @template_env.filterfunc
 def to_ascii(byte_arr) -> str:
     """Convert bytes into an ASCII str."""
-    return bytes([b % 128 for b in byte_arr]).decode("ascii")
+    return bytes(byte_arr).translate(
+        ASCII_MODES["ascii"].table).decode("ascii")
 
 
 @template_env.filterfunc
-def filename(library, filename: str) -> AttachmentLibrary:
+def filename(library, filename: str) -> AttachmentQuery:
     """Filter an attachment library by filename."""
-    if type(library) != AttachmentLibrary:
-        raise TypeError(
-            f"Cannot use 'filename' filter with type '{type(library).__name__}'"
-        )
-
-    return library.get_filename(filename)
+    return _as_query(library, "filename").get_filename(filename)
 
 
 @template_env.filterfunc
-def like(library, search_term: str) -> AttachmentLibrary:
+def like(library, search_term: str) -> AttachmentQuery:
     """Filter an attachment library by search term."""
-    if type(library) != AttachmentLibrary:
-        raise TypeError(
-            f"Cannot use 'like' filter with type '{type(library).__name__}'")
-
-    return library.get_like(search_term)
+    return _as_query(library, "like").get_like(search_term)
 
 
 @template_env.filterfunc
-def filetype(library, filetype: str) -> AttachmentLibrary:
+def filetype(library, filetype: str) -> AttachmentQuery:
     """Filter an attachment library by file type."""
-    if type(library) != AttachmentLibrary:
-        raise TypeError(
-            f"Cannot use 'filetype' filter with type '{type(library).__name__}'"
-        )
-
-    return library.get_filetype(filetype)
+    return _as_query(library, "filetype").get_filetype(filetype)
 
 
 @template_env.filterfunc
-def directory(library, directory: str) -> AttachmentLibrary:
+def directory(library, directory: str) -> AttachmentQuery:
     """Filter an attachment library by directory."""
-    if type(library) != AttachmentLibrary:
-        raise TypeError(
-            f"Cannot use 'directory' filter with type '{type(library).__name__}'"
-        )
-
-    return library.get_directory(directory)
+    return _as_query(library, "directory").get_directory(directory)
 
 
 @template_env.filterfunc
 def filesize(library, maximum: str = "0",
-             minimum: str = "0") -> AttachmentLibrary:
+             minimum: str = "0") -> AttachmentQuery:
     """Filter an attachment library by file size."""
-    if type(library) != AttachmentLibrary:
-        raise TypeError(
-            f"Cannot use 'filesize' filter with type '{type(library).__name__}'"
-        )
-
+    query = _as_query(library, "filesize")
     max_bytes = util.filesize_str_to_bytes(maximum)
     min_bytes = util.filesize_str_to_bytes(minimum)
 
-    return library.get_filesize(max_bytes=max_bytes, min_bytes=min_bytes)
+    return query.get_filesize(max_bytes=max_bytes, min_bytes=min_bytes)
 
 
 @template_env.filterfunc
-def randomly_pick(library, count: int,
-                  seed: Union[int, None] = None) -> AttachmentLibrary:
-    """Choose an amount of items from the library at random."""
-    if type(library) != AttachmentLibrary:
-        raise TypeError(
-            f"Cannot use 'randomly_pick' filter with type '{type(library).__name__}'"
-        )
-
-    return library.random_choice(count=count, seed=seed)
-
-
-def process(email_template: str, attachment_library: AttachmentLibrary) -> str:
-    template = template_env.from_string(email_template)
-    fake = Faker()
-    fake.add_provider(TextProvider)
-    return template.render(library=attachment_library,
-                           fake=fake,
-                           datetime=datetime,
-                           uuid=uuid)
+def randomly_pick(library,
+                  count: int,
+                  seed: Union[int, None] = None,
+                  weights: Weights = None) -> AttachmentLibrary:
+    """Choose an amount of items from the library at random, optionally
+    weighted by 'size' or by a dict of file type to weight.
+
+    If no seed is given during a seeded render, the render's random number
+    generator is used."""
+    query = _as_query(library, "randomly_pick")
+    rng = _render_random.get() if seed is None else None
+    return query.random_choice(count=count,
+                               seed=seed,
+                               weights=weights,
+                               rng=rng)
+
+
+def compile_template(email_template: str) -> Template:
+    """Compile a template, or get it from the cache if it was compiled before.
+
+    Args:
+        email_template (str): The source of the template.
+
+    Returns:
+        Template: The compiled template.
+    """
+    with profiling.timed("template.compile"):
+        key = hashlib.sha256(email_template.encode("utf-8")).hexdigest()
+        _template_sources[key] = email_template
+        _template_sources.move_to_end(key)
+        while len(_template_sources) > TEMPLATE_CACHE_SIZE:
+            _template_sources.popitem(last=False)
+        return template_env.get_template(key)
+
+
+def render(template: Template,
+           attachment_library: AttachmentLibrary,
+           fake: Faker = None,
+           seed: Union[int, None] = None,
+           now: datetime = None) -> str:
+    """Render a compiled template.
+
+    If a seed is given, everything random in the render is derived from it:
+    the Faker output, attachments picked with randomly_pick and uuid4().
+    With the time frozen too, the same seed always renders the same output.
+
+    Args:
+        template (Template): The template, from compile_template().
+        attachment_library (AttachmentLibrary): The library to use for
+            attachments.
+        fake (Faker): The Faker instance to generate fake data with. Defaults
+            to this thread's pooled instance.
+        seed (int): If given, the seed to render with.
+        now (datetime): If given, freeze the time that templates see.
+
+    Returns:
+        str: The rendered template.
+    """
+    if fake is None:
+        fake = faker_pool.get_faker(seed)
+    elif seed is not None:
+        fake.seed_instance(seed)
+    rng: Optional[random.Random] = None
+    if seed is not None:
+        rng = random.Random(f"attachments:{seed}")
+
+    token = _render_random.set(rng)
+    try:
+        with profiling.timed("template.render"):
+            return template.render(
+                library=attachment_library,
+                fake=fake,
+                datetime=datetime if now is None else frozen_datetime(now),
+                uuid=uuid if rng is None else SeededUUID(rng))
+    finally:
+        _render_random.reset(token)
+
+
+class RenderedTemplate:
+    """A template rendered with render_structured(), with the arrays from
+    to_array kept out of the rendered text.
+
+    Attributes:
+        source (str): The rendered text, with a placeholder for each array.
+        arrays (List[List[str]]): The arrays, in the order of their
+            placeholders.
+    """
+    def __init__(self, source: str, arrays: List[List[str]]) -> None:
+        self.source = source
+        self.arrays = arrays
+
+    @property
+    def text(self) -> str:
+        """str: The rendered text with the arrays filled in, the same as
+        render() would have rendered."""
+        if not self.arrays:
+            return self.source
+        return _ARRAY_PLACEHOLDER.sub(
+            lambda match: _emit_yaml_array(self.arrays[int(match.group(1))]),
+            self.source)
+
+
+def render_structured(template: Template,
+                      attachment_library: AttachmentLibrary,
+                      fake: Faker = None,
+                      seed: Union[int, None] = None,
+                      now: datetime = None) -> RenderedTemplate:
+    """Render a compiled template, keeping the arrays from to_array out of
+    the rendered text so they can be put straight into a spec, rather than
+    written as YAML only to be parsed again. See render() for the arguments.
+
+    If the template does more with an array than write it out, so that its
+    placeholder isn't in the rendered text as it was emitted, the template is
+    rendered again as text.
+
+    Returns:
+        RenderedTemplate: The rendered template.
+    """
+    arrays: List[List[str]] = []
+    token = _render_arrays.set(arrays)
+    try:
+        source = render(template, attachment_library, fake, seed, now)
+    finally:
+        _render_arrays.reset(token)
+    placeholders = [int(index) for index in _ARRAY_PLACEHOLDER.findall(source)]
+    if placeholders != list(range(len(arrays))):
+        return RenderedTemplate(
+            render(template, attachment_library, fake, seed, now), [])
+    return RenderedTemplate(source, arrays)
+
+
+def process(email_template: str,
+            attachment_library: AttachmentLibrary,
+            fake: Faker = None,
+            seed: Union[int, None] = None,
+            now: datetime = None) -> str:
+    return render(compile_template(email_template), attachment_library, fake,
+                  seed, now)
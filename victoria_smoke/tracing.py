@@ -0,0 +1,225 @@
+"""tracing.py
+
+Traces the messages sent in a smoke test through the log analytics backend,
+finding the transaction of each message by its unique From address.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+import asyncio
+from collections import namedtuple
+import json
+import logging
+import time
+from typing import (Any, AsyncIterator, Callable, Dict, Iterable, List,
+                    Optional)
+import urllib.error
+import urllib.request
+
+from .config import LogAnalyticsConfig
+from . import profiling
+
+TOKEN_SCOPE = "https://api.loganalytics.io/.default"
+"""The scope of the access token used to query log analytics."""
+
+TraceResult = namedtuple("TraceResult",
+                         ["from_address", "transaction_id", "status"])
+"""The transaction of a message sent in a smoke test. 'transaction_id' and
+'status' are None if the transaction wasn't found before the deadline."""
+
+TokenProvider = Callable[[], str]
+"""Gets an access token for the log analytics API."""
+
+
+def azure_token_provider() -> TokenProvider:
+    """Get a token provider using the default Azure credential, i.e. from the
+    environment or the Azure CLI.
+
+    Raises:
+        ImportError: If azure-identity isn't installed.
+    """
+    # azure.identity is slow to import, so only import it when tracing
+    try:
+        from azure.identity import DefaultAzureCredential
+    except ImportError as err:
+        raise ImportError(
+            "tracing with the default Azure credential needs azure-identity, "
+            "install it or set 'auth: none' under log_analytics") from err
+    credential = DefaultAzureCredential()
+    return lambda: credential.get_token(TOKEN_SCOPE).token
+
+
+class QueryError(Exception):
+    """Raised when a log analytics query fails."""
+    pass
+
+
+class LogAnalyticsClient:
+    """LogAnalyticsClient runs queries against a log analytics workspace.
+
+    Requests are made on the event loop's default executor, so queries run
+    concurrently without blocking the event loop.
+
+    Attributes:
+        url (str): The URL of the workspace's query API.
+        token_provider (TokenProvider): Gets the access token for requests,
+            or None to send requests without authorization.
+        timeout (float): The timeout of a request, in seconds.
+    """
+    def __init__(self,
+                 cfg: LogAnalyticsConfig,
+                 token_provider: Optional[TokenProvider] = None,
+                 timeout: float = 30.0) -> None:
+        self.url = f"{cfg.endpoint.rstrip('/')}/v1/workspaces/" \
+            f"{cfg.workspace_id}/query"
+        self.token_provider = token_provider
+        self.timeout = timeout
+
+    def _query(self, query: str) -> List[Dict[str, Any]]:
+        headers = {"Content-Type": "application/json"}
+        if self.token_provider is not None:
+            headers["Authorization"] = f"Bearer {self.token_provider()}"
+        request = urllib.request.Request(self.url,
+                                         data=json.dumps({
+                                             "query": query
+                                         }).encode("utf-8"),
+                                         headers=headers,
+                                         method="POST")
+        try:
+            with profiling.timed("trace.query"):
+                with urllib.request.urlopen(request,
+                                            timeout=self.timeout) as response:
+                    result = json.load(response)
+        except (urllib.error.URLError, OSError, ValueError) as err:
+            profiling.count("trace.query_failures")
+            raise QueryError(f"query failed: {err}") from err
+        profiling.count("trace.queries")
+
+        rows = []
+        for table in result.get("tables", []):
+            columns = [column["name"] for column in table["columns"]]
+            rows.extend(dict(zip(columns, row)) for row in table["rows"])
+        return rows
+
+    async def query(self, query: str) -> List[Dict[str, Any]]:
+        """Run a query.
+
+        Args:
+            query (str): The KQL query.
+
+        Raises:
+            QueryError: If the query failed.
+
+        Returns:
+            List[Dict[str, Any]]: The rows of the result, as dicts of column
+                name to value.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._query, query)
+
+
+def create_client(cfg: LogAnalyticsConfig) -> LogAnalyticsClient:
+    """Create a client authorized as the config says.
+
+    Args:
+        cfg (LogAnalyticsConfig): The log analytics config.
+
+    Raises:
+        ImportError: If the config needs azure-identity and it isn't
+            installed.
+
+    Returns:
+        LogAnalyticsClient: The client.
+    """
+    if cfg.auth == "azure":
+        return LogAnalyticsClient(cfg, azure_token_provider())
+    return LogAnalyticsClient(cfg)
+
+
+def build_query(cfg: LogAnalyticsConfig, from_addresses: List[str]) -> str:
+    """Build the query finding the transactions of a batch of From addresses.
+
+    Args:
+        cfg (LogAnalyticsConfig): The log analytics config, with the query
+            template.
+        from_addresses (List[str]): The From addresses.
+
+    Returns:
+        str: The KQL query.
+    """
+    # JSON strings are valid KQL string literals
+    senders = ", ".join(json.dumps(address) for address in from_addresses)
+    return cfg.query.format(senders=senders)
+
+
+async def trace(from_addresses: Iterable[str],
+                cfg: LogAnalyticsConfig,
+                client: LogAnalyticsClient = None
+                ) -> AsyncIterator[TraceResult]:
+    """Find the transactions of sent messages, yielding them as they're found.
+
+    The From addresses are looked up in batches of 'batch_size', with up to
+    'concurrency' queries running at once. Messages take a while to show up in
+    the logs, so the unresolved addresses are polled again after
+    'poll_interval' seconds, backing off exponentially up to
+    'max_poll_interval' while no new transactions are found, until every
+    address is resolved or 'deadline' seconds have passed.
+
+    Args:
+        from_addresses (Iterable[str]): The From addresses of the messages.
+        cfg (LogAnalyticsConfig): The log analytics config.
+        client (LogAnalyticsClient): The client to query with. Defaults to
+            one from create_client().
+
+    Yields:
+        TraceResult: The transaction of each message as it's found, followed
+            by a result for each message that wasn't found in time.
+    """
+    if client is None:
+        client = create_client(cfg)
+    pending = set(from_addresses)
+    deadline = time.monotonic() + cfg.deadline
+    interval = cfg.poll_interval
+    semaphore = asyncio.Semaphore(cfg.concurrency)
+
+    async def query_batch(batch: List[str]) -> List[Dict[str, Any]]:
+        async with semaphore:
+            try:
+                return await client.query(build_query(cfg, batch))
+            except QueryError as err:
+                logging.warning(f"tracing {len(batch)} messages: {err}")
+                return []
+
+    while pending:
+        addresses = sorted(pending)
+        batches = [
+            addresses[i:i + cfg.batch_size]
+            for i in range(0, len(addresses), cfg.batch_size)
+        ]
+        found = 0
+        for rows in asyncio.as_completed(
+            [query_batch(batch) for batch in batches]):
+            for row in await rows:
+                from_address = row.get(cfg.sender_column)
+                if from_address not in pending:
+                    continue
+                pending.discard(from_address)
+                found += 1
+                profiling.count("trace.found")
+                yield TraceResult(from_address,
+                                  row.get(cfg.transaction_column),
+                                  row.get(cfg.status_column))
+
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            break
+        # poll again quickly while transactions are still turning up
+        if found:
+            interval = cfg.poll_interval
+        await asyncio.sleep(min(interval, remaining))
+        if not found:
+            interval = min(interval * 2, cfg.max_poll_interval)
+
+    profiling.count("trace.not_found", len(pending))
+    for from_address in sorted(pending):
+        yield TraceResult(from_address, None, None)
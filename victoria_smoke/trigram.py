@@ -0,0 +1,100 @@
+"""trigram.py
+
+A trigram inverted index, used to speed up substring searches over the paths
+in an attachment library.
+
+Author:
+    Sam Gibson <sgibson@glasswallsolutions.com>
+"""
+from array import array
+from collections import defaultdict
+import hashlib
+from typing import Dict, Optional, Sequence
+
+N = 3
+"""The length of the n-grams that are indexed."""
+
+INTERSECT_RATIO = 4
+"""How much longer than the working set a postings list can be before it's
+skipped during intersection."""
+
+
+def fingerprint(paths: Sequence[str]) -> str:
+    """Get a fingerprint of a list of paths, used to check whether an index
+    that was built earlier still matches the paths."""
+    digest = hashlib.blake2b(digest_size=16)
+    for file_path in paths:
+        digest.update(file_path.encode("utf-8", "surrogateescape"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class TrigramIndex:
+    """TrigramIndex maps every trigram to the ascending rows of the paths that
+    contain it.
+
+    Any path containing a search term must contain every trigram of the term,
+    so intersecting the postings of the term's trigrams gives a small set of
+    candidates that only then need to be checked with a substring search.
+
+    Attributes:
+        postings (Dict[str, array]): The rows containing each trigram.
+        fingerprint (str): The fingerprint of the paths that were indexed.
+    """
+    def __init__(self, paths: Sequence[str]) -> None:
+        """Build a trigram index over a list of paths.
+
+        Args:
+            paths (Sequence[str]): The paths to index. The index of a path in
+                the list is its row.
+        """
+        postings = defaultdict(lambda: array("l"))
+        for row, file_path in enumerate(paths):
+            for trigram in {
+                    file_path[i:i + N]
+                    for i in range(len(file_path) - N + 1)
+            }:
+                postings[trigram].append(row)
+        self.postings: Dict[str, array] = dict(postings)
+        self.fingerprint = fingerprint(paths)
+
+    def estimate(self, search_term: str) -> Optional[int]:
+        """Get an upper bound of the number of paths containing a search term,
+        or None if the term is too short to use the index."""
+        if len(search_term) < N:
+            return None
+        return min(
+            len(self.postings.get(search_term[i:i + N], ()))
+            for i in range(len(search_term) - N + 1))
+
+    def candidates(self, search_term: str) -> Optional[Sequence[int]]:
+        """Get the rows of the paths that might contain a search term.
+
+        Args:
+            search_term (str): The term to search for.
+
+        Returns:
+            Optional[Sequence[int]]: The candidate rows in ascending order, or
+                None if the term is too short to use the index.
+        """
+        if len(search_term) < N:
+            return None
+        trigrams = {
+            search_term[i:i + N]
+            for i in range(len(search_term) - N + 1)
+        }
+        postings = sorted((self.postings.get(trigram, ())
+                           for trigram in trigrams),
+                          key=len)
+
+        # intersect starting from the shortest postings list, so the working
+        # set only ever shrinks. Once the working set is much smaller than the
+        # next postings list it's cheaper to leave the rest to the substring
+        # check than to keep intersecting
+        rows = postings[0]
+        for posting in postings[1:]:
+            if len(rows) * INTERSECT_RATIO < len(posting):
+                break
+            posting_set = set(posting)
+            rows = [row for row in rows if row in posting_set]
+        return rows
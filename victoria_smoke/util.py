@@ -5,7 +5,12 @@ Various utility functions for the smoke test plugin.
 Author:
     Sam Gibson <sgibson@glasswallsolutions.com>
 """
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
 from os import scandir
+from typing import Callable, Dict, Iterator, List, Tuple, TypeVar
+
+T = TypeVar("T")
 
 FILESIZE_UNITS_MAPPING = {
     "": 1000**0,
@@ -68,9 +73,67 @@ def filesize_str_to_bytes(size: str) -> int:
 
 
 def scantree(path):
-    """Recursively yield DirEntry objects for given directory."""
-    for entry in scandir(path):
-        if entry.is_dir(follow_symlinks=False):
-            yield from scantree(entry.path)
-        else:
-            yield entry
\ No newline at end of file
+    """Recursively yield DirEntry objects for given directory.
+
+    Each directory's entries are yielded in order of name, followed by its
+    subdirectories' in the same order, so the order doesn't depend on the
+    filesystem. The tree is walked with an explicit stack rather than
+    recursion, so very deep trees can't hit the recursion limit.
+    """
+    stack = [path]
+    while stack:
+        subdirs = []
+        for entry in sorted(scandir(stack.pop()), key=lambda e: e.name):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            else:
+                yield entry
+        stack.extend(reversed(subdirs))
+
+
+def walk_parallel(root: str, scan: Callable[[str], Tuple[T, List[str]]],
+                  workers: int) -> Iterator[Tuple[str, T]]:
+    """Walk a directory tree, scanning directories concurrently on a thread
+    pool.
+
+    Each directory is scanned with the given function, which returns a result
+    for that directory and the paths of its subdirectories. Subdirectories are
+    put on the work queue as soon as their parent has been scanned, so the
+    latency of slow (i.e. network) filesystems is overlapped.
+
+    Results are yielded in depth-first order once the whole tree has been
+    scanned, so the output doesn't depend on the number of workers.
+
+    Args:
+        root (str): The directory to start walking from.
+        scan (Callable[[str], Tuple[T, List[str]]]): Function to scan a
+            single directory.
+        workers (int): The number of threads to scan with.
+
+    Yields:
+        Tuple[str, T]: Each directory path and the result of scanning it.
+    """
+    results: Dict[str, Tuple[T, List[str]]] = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = {executor.submit(scan, root): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                try:
+                    result, subdirs = future.result()
+                except OSError as err:
+                    logging.warning(f"unable to scan '{directory}': {err}")
+                    continue
+                results[directory] = (result, subdirs)
+                for subdir in subdirs:
+                    pending[executor.submit(scan, subdir)] = subdir
+
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        if directory not in results:
+            continue
+        result, subdirs = results[directory]
+        yield directory, result
+        stack.extend(reversed(subdirs))
\ No newline at end of file